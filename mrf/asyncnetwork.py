@@ -0,0 +1,477 @@
+"""
+Copyright (c) 2010 Mark Frimston
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+---------------------
+
+Asyncio Networking Module
+
+Versions of the mrf.network client and server classes which run in an asyncio
+event loop rather than in threads of their own. Requires Python 3.
+
+Messages, encoders and the "intercept_" and "handle_" method conventions are
+the same as for mrf.network, and the same client handlers are used, with the
+server's connections wrapped by TransportAdapter in place of their sockets.
+All of the classes here must only be used from the event loop's thread.
+
+    "start" and "process_events" are coroutines.
+    "send" and "stop" act immediately, returning a future which may be awaited
+        to wait until the written data has been accepted by the transport, or
+        until the connection has closed, respectively. The future can equally
+        be ignored, so the methods may still be invoked from ordinary code.
+"""
+
+import asyncio
+import socket
+import sys
+
+from mrf.network import (EventQueue, Node, Server, Client, GameServer, GameClient,
+    GameClientHandler, JsonEncoder, MsgPing, MsgRequestConnect, 
+    MsgPlayerDisconnect, MsgServerShutdown, MsgTransportOptions)
+
+
+def _done_future(loop):
+    f = loop.create_future()
+    f.set_result(None)
+    return f
+
+
+def _gather(loop, futures):
+    # gather with no arguments would pick up whichever loop is current
+    if len(futures) == 0:
+        return _done_future(loop)
+    return asyncio.gather(*futures)
+
+
+class TransportAdapter(object):
+    """
+    Wraps an asyncio transport so that it may be used in place of a socket by
+    the mrf.network client handlers and clients.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def setblocking(self, flag):
+        pass
+
+    def sendall(self, data):
+        self.transport.write(data)
+
+    def send(self, data):
+        # the transport buffers whatever can't be written straight away
+        self.transport.write(data)
+        return len(data)
+
+    def close(self):
+        self.transport.close()
+
+
+class _SignallingQueue(EventQueue):
+    """
+    Event queue which sets an asyncio event when an item is added
+    """
+
+    def __init__(self):
+        EventQueue.__init__(self)
+        self.ready = asyncio.Event()
+
+    def put(self, item):
+        EventQueue.put(self, item)
+        self.ready.set()
+
+
+class _ConnectionProtocol(asyncio.Protocol):
+    """
+    Protocol passing data arriving on a connection to a SocketListener. Keeps
+    track of flow control so that senders can wait for writing to resume.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.listener = None
+        self.paused = False
+        self.drain_waiters = []
+        self.closed = loop.create_future()
+
+    def data_received(self, data):
+        try:
+            self.listener.feed_data(data)
+        except:
+            self.listener.handle_unexpected_error((self.listener.get_connected_to(),
+                sys.exc_info()[1]))
+            self.listener.get_socket().close()
+
+    def connection_lost(self, exc):
+        with self.listener.stopping_lock:
+            stopping = self.listener.stopping
+        if exc is not None:
+            self.listener.handle_network_error((self.listener.get_connected_to(),exc))
+        elif not stopping:
+            self.listener.handle_network_error((self.listener.get_connected_to(),
+                socket.error("Socket closed")))
+        self.resume_writing()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        for f in self.drain_waiters:
+            if not f.done():
+                f.set_result(None)
+        self.drain_waiters = []
+
+    def drained(self):
+        """
+        Returns a future which completes once the transport is accepting writes
+        """
+        if not self.paused:
+            return _done_future(self.loop)
+        f = self.loop.create_future()
+        self.drain_waiters.append(f)
+        return f
+
+
+class _ServerProtocol(_ConnectionProtocol):
+    """
+    Protocol for a single client connected to an AsyncServer. Creates the client
+    handler when the connection is made.
+    """
+
+    def __init__(self, server):
+        _ConnectionProtocol.__init__(self, server.loop)
+        self.server = server
+
+    def connection_made(self, transport):
+        # kept as the key, since resuming a session changes the handler's id
+        self.client_id = self.server.make_client_id()
+        self.listener = self.server.create_handler(TransportAdapter(transport), self.client_id)
+        self.server.protocols[self.client_id] = self
+        self.server.client_arrived(self.client_id)
+
+    def connection_lost(self, exc):
+        _ConnectionProtocol.connection_lost(self, exc)
+        self.server.protocols.pop(self.client_id, None)
+        self.server.client_departed(self.listener.get_connected_to())
+
+
+class AsyncNode(Node):
+    """
+    Base class for nodes running in an asyncio event loop
+    """
+
+    def __init__(self):
+        # replace the node's event queue
+        self.event_queue = _SignallingQueue()
+
+    async def process_events(self, handler=None, timeout=None, max_events=None,
+            max_time=None):
+        """
+        Coroutine which waits for events to arrive, if there are none waiting
+        already, then dispatches them as Node.process_events does. Gives up
+        waiting after "timeout" seconds, if specified. Returns the number of
+        events processed.
+        """
+        if not self.has_events():
+            try:
+                await asyncio.wait_for(self.event_queue.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.flush()
+                return 0
+        self.event_queue.ready.clear()
+        return Node.process_events(self, handler, max_events, max_time)
+
+
+class AsyncServer(AsyncNode, Server):
+    """
+    Server which accepts clients using an asyncio server. After constructed, the
+    "start" coroutine should be awaited to begin listening for clients. The
+    client factory is used to create client handlers as for Server, but the
+    handlers are not started as threads and are given a TransportAdapter in
+    place of a socket.
+    """
+
+    def __init__(self, client_factory, port):
+        Server.__init__(self, client_factory, port)
+        AsyncNode.__init__(self)
+        self._init_async_server()
+
+    def _init_async_server(self):
+        self.loop = None
+        self.aio_server = None
+        self.protocols = {}
+
+    async def start(self):
+        """
+        Coroutine which starts the server listening. Overidden from Server
+        """
+        self.loop = asyncio.get_running_loop()
+        self.next_id = 0
+        self.protocols = {}
+        with self.stopping_lock:
+            self.stopping = False
+        with self.handlers_lock:
+            self.handlers = {}
+        with self.node_groups_lock:
+            self.node_groups.clear()
+            self.node_groups.tag_item(Server.SERVER, Server.GROUP_ALL)
+        self.aio_server = await self.loop.create_server(
+            lambda: _ServerProtocol(self), socket.gethostname(), self.port)
+
+    def send(self, message):
+        """
+        Overidden from Server. Returns a future which completes once the
+        connections written to are accepting writes again.
+        """
+        Server.send(self, message)
+        return self.drained()
+
+    def drained(self):
+        """
+        Returns a future which completes once all client connections are
+        accepting writes
+        """
+        if self.loop is None:
+            return _done_future(asyncio.get_event_loop())
+        return _gather(self.loop, [p.drained() for p in self.protocols.values()])
+
+    def stop(self):
+        """
+        Overidden from Server. Stops listening and closes all client connections,
+        returning a future which completes once they have closed.
+        """
+        with self.stopping_lock:
+            self.stopping = True
+        if self.aio_server is None:
+            return _done_future(asyncio.get_event_loop())
+        self.aio_server.close()
+        closed = [p.closed for p in self.protocols.values()]
+        self.stop_handlers()
+        return _gather(self.loop, [self.loop.create_task(self.aio_server.wait_closed())]+closed)
+
+    def handler_stopped(self, client_id):
+        """
+        Overidden from Server. Closes the connection to the client.
+        """
+        with self.handlers_lock:
+            handler = self.handlers.get(client_id)
+        if handler is not None:
+            handler.get_socket().close()
+
+    def run(self):
+        raise NotImplementedError("AsyncServer does not run in a thread")
+
+
+class _ClientProtocol(_ConnectionProtocol):
+    """
+    Protocol for an AsyncClient's connection to the server
+    """
+
+    def __init__(self, client):
+        _ConnectionProtocol.__init__(self, client.loop)
+        self.listener = client
+
+
+class AsyncClient(AsyncNode, Client):
+    """
+    Client which connects to the server using an asyncio connection. After
+    constructing, the "start" coroutine should be awaited to connect.
+    """
+
+    def __init__(self, host, port, encoder, transport_options=None):
+        Client.__init__(self, host, port, encoder, transport_options)
+        AsyncNode.__init__(self)
+        self._init_async_client()
+
+    def _init_async_client(self):
+        self.loop = None
+        self.protocol = None
+        self.negotiated = None
+
+    async def start(self):
+        """
+        Coroutine which connects to the server. Overidden from Client
+        """
+        self.loop = asyncio.get_running_loop()
+        with self.stopping_lock:
+            self.stopping = False
+        transport,self.protocol = await self.loop.create_connection(
+            lambda: _ClientProtocol(self), self.host, self.port)
+        with self.socket_lock:
+            self.socket = TransportAdapter(transport)
+        if self.transport_options:
+            await self.negotiate_transport()
+        self.after_connect()
+
+    async def negotiate_transport(self):
+        """
+        Coroutine which requests the client's transport options from the server
+        and waits for the reply. Overidden from Client
+        """
+        self.negotiated = self.loop.create_future()
+        self.send(MsgTransportOptions([Server.SERVER],[],-1,self.transport_options))
+        try:
+            await asyncio.wait_for(self.negotiated, Client.NEGOTIATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    def intercept_MsgTransportOptions(self, message):
+        Client.intercept_MsgTransportOptions(self, message)
+        if self.negotiated is not None and not self.negotiated.done():
+            self.negotiated.set_result(True)
+
+    def send(self, message):
+        """
+        Overidden from Client. Returns a future which completes once the
+        connection is accepting writes again.
+        """
+        Client.send(self, message)
+        return self.drained()
+
+    def drained(self):
+        """
+        Returns a future which completes once the connection is accepting writes
+        """
+        if self.protocol is None:
+            return _done_future(asyncio.get_event_loop())
+        return self.protocol.drained()
+
+    def stop(self):
+        """
+        Overidden from Client. Closes the connection, returning a future which
+        completes once it has closed.
+        """
+        with self.stopping_lock:
+            self.stopping = True
+        if self.protocol is None:
+            return _done_future(asyncio.get_event_loop())
+        with self.socket_lock:
+            self.flush()
+            self.socket.close()
+        return self.protocol.closed
+
+    def run(self):
+        raise NotImplementedError("AsyncClient does not run in a thread")
+
+
+class AsyncGameServer(GameServer, AsyncServer):
+    """
+    GameServer running in an asyncio event loop
+    """
+
+    def __init__(self, max_players=4,
+            client_factory=lambda server,socket,client_id: GameClientHandler(server,socket,client_id,JsonEncoder()),
+            port=57810):
+        GameServer.__init__(self, max_players, client_factory, port)
+        AsyncNode.__init__(self)
+        self._init_async_server()
+
+    def send(self, message):
+        """
+        Explicitly send message as AsyncServer does
+        """
+        return AsyncServer.send(self, message)
+
+    def stop(self):
+        """
+        Overidden from GameServer. Informs clients of imminent shutdown then
+        closes their connections.
+        """
+        with self.stopping_lock:
+            should_send = not self.stopping
+        if should_send and self.aio_server is not None:
+            self.send(MsgServerShutdown([GameServer.GROUP_CLIENTS],[],GameServer.SERVER))
+        return AsyncServer.stop(self)
+
+
+class AsyncGameClient(GameClient, AsyncClient):
+    """
+    GameClient running in an asyncio event loop. Pings are sent from a task
+    rather than a thread of their own.
+    """
+
+    def __init__(self, player_info, host, port=57810, encoder=JsonEncoder(),
+            transport_options=None):
+        GameClient.__init__(self, player_info, host, port, encoder, transport_options)
+        AsyncNode.__init__(self)
+        self._init_async_client()
+
+    def send(self, message):
+        return AsyncClient.send(self, message)
+
+    def handle_network_error(self, error_info):
+        """
+        Overidden from GameClient. The async client doesn't resume its session,
+        so errors are always reported.
+        """
+        Client.handle_network_error(self, error_info)
+
+    def after_connect(self):
+        """
+        Overidden from GameClient. Requests entry into the game and starts the
+        ping task.
+        """
+        self.send(MsgRequestConnect([Server.SERVER],[],-1,self.player_info))
+        self.pinger_thread = self.loop.create_task(self.run_ping_sender())
+
+    async def run_ping_sender(self):
+        """
+        Coroutine which pings the server periodically until the client stops
+        """
+        try:
+            while True:
+                with self.stopping_lock:
+                    if self.stopping:
+                        break
+                self.send(MsgPing([Server.SERVER],[],-1,self.get_timestamp()))
+                await asyncio.sleep(self.clock.next_ping_interval())
+        except socket.error as e:
+            self.handle_network_error((self.get_connected_to(),e))
+        except asyncio.CancelledError:
+            pass
+        except:
+            self.handle_unexpected_error((self.get_connected_to(),sys.exc_info()[1]))
+
+    def stop(self):
+        """
+        Overidden from GameClient. Sends disconnect message to server before
+        closing the connection.
+        """
+        if self.is_in_game():
+            with self.stopping_lock:
+                should_send = not self.stopping
+            if should_send:
+                try:
+                    self.send(MsgPlayerDisconnect([Server.SERVER],[],self.client_id,self.client_id,""))
+                except socket.error as e:
+                    self.handle_network_error((Server.SERVER,e))
+        if self.pinger_thread is not None:
+            self.pinger_thread.cancel()
+        return AsyncClient.stop(self)
+
+    def run(self):
+        raise NotImplementedError("AsyncGameClient does not run in a thread")
+
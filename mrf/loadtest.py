@@ -0,0 +1,587 @@
+"""
+Copyright (c) 2010 Mark Frimston
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+---------------------
+
+Load Testing Module
+
+Stress tests a GameServer with many simulated players. Rather than running a
+GameClient, with its threads, for each player, a LoadTest drives lightweight
+SimulatedClients from a single thread, polling all of their sockets together
+as SelectorServer does. The simulated players connect at a steady rate, join
+the game, and then ping the server, chat to one another and broadcast to all
+players at random intervals, at the given average rates per player:
+
+    test = LoadTest("myserver", 57810, num_clients=1000, ping_rate=1.0,
+        chat_rate=0.5, broadcast_rate=0.05)
+    report = test.run(60)
+
+The report gives message and byte throughput, ping round trip times, and the
+time taken to deliver chat messages, as percentiles. The server under test may
+be run in a child process by a LocalServer, in which case its CPU usage and
+tick timings are reported as well. Run as a script to test a local server:
+
+    python -m mrf.loadtest --clients 1000 --duration 30
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import errno
+
+from mrf.network import (Server, GameServer, SelectorGameServer, GameClientHandler,
+    SocketListener, SocketPoller, Histogram, TickLoop, JsonEncoder, BinaryEncoder,
+    MsgRequestConnect, MsgTransportOptions, MsgPing, MsgChat, dispatch_event, lockable_attrs)
+
+
+if hasattr(multiprocessing, "get_context"):
+    _multiprocessing = multiprocessing.get_context("fork")
+else:
+    _multiprocessing = multiprocessing
+
+
+def _timestamp():
+    return time.time()*1000
+
+
+class SimulatedClient(SocketListener):
+    """
+    Lightweight stand-in for a GameClient, which runs no threads of its own but
+    is driven by a LoadTest. Connects, negotiates any transport options and
+    requests to join the game, then reports what it receives to the test.
+    """
+
+    STATE_NEGOTIATING = "negotiating"
+    STATE_CONNECTING = "connecting"
+    STATE_IN_GAME = "in game"
+    STATE_REJECTED = "rejected"
+    STATE_CLOSED = "closed"
+
+    def __init__(self, test, name, encoder):
+        SocketListener.__init__(self, encoder)
+        self.test = test
+        self.name = name
+        self.client_id = -1
+        self.state = None
+        lockable_attrs(self,
+            socket = None
+        )
+
+    def get_socket(self):
+        return self.socket
+
+    def get_socket_lock(self):
+        return self.socket_lock
+
+    def get_connected_to(self):
+        return Server.SERVER
+
+    def connect(self, host, port, timeout, transport_options=None):
+        """
+        Connects to the server and begins joining the game. May raise
+        socket.error.
+        """
+        sock = socket.create_connection((host, port), timeout)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        with self.socket_lock:
+            self.socket = sock
+        # never block the test on a slow connection
+        self.set_outgoing_limit(LoadTest.MAX_OUTGOING)
+        if transport_options:
+            self.state = SimulatedClient.STATE_NEGOTIATING
+            self.send(MsgTransportOptions([Server.SERVER],[],-1,transport_options))
+        else:
+            self.request_connect()
+
+    def request_connect(self):
+        self.state = SimulatedClient.STATE_CONNECTING
+        self.send(MsgRequestConnect([Server.SERVER],[],-1,{"name":self.name}))
+
+    def write_available(self, data):
+        """
+        Overidden from SocketListener. Writes without blocking.
+        """
+        try:
+            with self.get_socket_lock():
+                return self.get_socket().send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def has_backlog(self):
+        return len(self.backlog) > 0
+
+    def is_open(self):
+        return self.socket is not None and self.state not in (
+            SimulatedClient.STATE_CLOSED, SimulatedClient.STATE_REJECTED)
+
+    def close(self):
+        with self.socket_lock:
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+        if self.state != SimulatedClient.STATE_REJECTED:
+            self.state = SimulatedClient.STATE_CLOSED
+
+    def received(self, message):
+        """
+        Overidden from SocketListener. Passes the message to the matching
+        "handle_" method, if any.
+        """
+        dispatch_event(self, message, "handle_")
+
+    def handle_MsgTransportOptions(self, message):
+        self.apply_transport_options(message.options)
+        self.request_connect()
+
+    def handle_MsgAcceptConnect(self, message):
+        self.client_id = message.player_id
+        self.state = SimulatedClient.STATE_IN_GAME
+        self.test.client_joined(self)
+
+    def handle_MsgRejectConnect(self, message):
+        self.state = SimulatedClient.STATE_REJECTED
+        self.test.client_rejected(self)
+
+    def handle_MsgServerShutdown(self, message):
+        self.state = SimulatedClient.STATE_CLOSED
+
+    def handle_MsgPong(self, message):
+        self.test.pong_received(_timestamp() - message.ping_timestamp)
+
+    def handle_MsgChat(self, message):
+        # chat messages begin with the time they were sent
+        sent = float(message.message.split(":",1)[0])
+        self.test.chat_received(_timestamp() - sent)
+
+
+class LoadTest(object):
+    """
+    Simulates "num_clients" players of the game server at the given host and
+    port, connecting "connect_rate" players per second. Once in the game, each
+    player sends pings, chat messages to another player and broadcasts to all
+    players at random, at the given average rates per second. Chat messages
+    are padded to "message_size" characters. The connections use "encoder", and
+    request "transport_options" as GameClient does. If the server is being run
+    by a LocalServer, it may be given as "server" to have its CPU usage
+    reported. "run" runs the test and returns the report.
+    """
+
+    CONNECT_TIMEOUT = 5.0
+    POLL_INTERVAL = 0.01
+    MAX_OUTGOING = 65536
+    LATENCY_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    KIND_PING = "ping"
+    KIND_CHAT = "chat"
+    KIND_BROADCAST = "broadcast"
+
+    def __init__(self, host, port=57810, num_clients=100, connect_rate=100.0, ping_rate=1.0,
+            chat_rate=0.5, broadcast_rate=0.05, message_size=32, encoder=JsonEncoder(),
+            transport_options=None, server=None):
+        self.host = host
+        self.port = port
+        self.num_clients = num_clients
+        self.connect_rate = connect_rate
+        self.rates = {
+            LoadTest.KIND_PING : ping_rate,
+            LoadTest.KIND_CHAT : chat_rate,
+            LoadTest.KIND_BROADCAST : broadcast_rate
+        }
+        self.message_size = message_size
+        self.encoder = encoder
+        self.transport_options = transport_options
+        self.server = server
+        self.clients = []
+        self.joined_ids = []
+        # heap of (due time, sequence, client, kind) for messages to send
+        self.schedule = []
+        self.schedule_seq = 0
+        self.poller = None
+        self.failed = 0
+        self.rejected = 0
+        self.disconnected = 0
+        self.connect_times = Histogram(LoadTest.LATENCY_BOUNDS)
+        self.ping_times = Histogram(LoadTest.LATENCY_BOUNDS)
+        self.chat_times = Histogram(LoadTest.LATENCY_BOUNDS)
+        self.connect_started = {}
+
+    def run(self, duration):
+        """
+        Runs the test for "duration" seconds, then disconnects the simulated
+        players and returns the report
+        """
+        self.poller = SocketPoller()
+        server_before = self.server.sample() if self.server is not None else None
+        cpu_before = os.times()
+        start = time.time()
+        next_connect = start
+        try:
+            while True:
+                now = time.time()
+                if now - start >= duration:
+                    break
+                while len(self.clients) < self.num_clients and next_connect <= now:
+                    self.connect_client()
+                    next_connect += 1.0/self.connect_rate
+                self.send_due_messages(now)
+                for client in self.clients:
+                    if client.has_backlog() and client.is_open():
+                        self.write_to(client)
+                timeout = LoadTest.POLL_INTERVAL
+                if len(self.schedule) > 0:
+                    timeout = max(0, min(timeout, self.schedule[0][0] - time.time()))
+                for client in self.poller.poll(timeout):
+                    self.read_from(client)
+            elapsed = time.time() - start
+            cpu_after = os.times()
+            server_after = self.server.sample() if self.server is not None else None
+        finally:
+            for client in self.clients:
+                if client.get_socket() is not None:
+                    self.poller.unregister(client.get_socket())
+                    client.close()
+            self.poller.close()
+        report = self.get_report(elapsed, (cpu_after[0]+cpu_after[1]) - (cpu_before[0]+cpu_before[1]))
+        if server_before is not None:
+            report["server"] = LocalServer.compare(server_before, server_after)
+        return report
+
+    def connect_client(self):
+        client = SimulatedClient(self, "loadtest%d" % len(self.clients), self.encoder)
+        self.clients.append(client)
+        self.connect_started[client] = time.time()
+        try:
+            client.connect(self.host, self.port, LoadTest.CONNECT_TIMEOUT, self.transport_options)
+        except socket.error:
+            client.close()
+            self.failed += 1
+            return
+        self.poller.register(client.get_socket(), client)
+
+    def read_from(self, client):
+        try:
+            client.receive_available()
+        except socket.error:
+            self.drop_client(client)
+        if not client.is_open():
+            self.drop_client(client)
+
+    def write_to(self, client):
+        try:
+            client.flush()
+        except socket.error:
+            self.drop_client(client)
+
+    def drop_client(self, client):
+        """
+        Closes the connection of a client which the server has rejected or
+        disconnected
+        """
+        if client.get_socket() is None:
+            return
+        self.poller.unregister(client.get_socket())
+        if client.state != SimulatedClient.STATE_REJECTED:
+            self.disconnected += 1
+        client.close()
+        if client.client_id in self.joined_ids:
+            self.joined_ids.remove(client.client_id)
+
+    def schedule_message(self, client, kind, now):
+        rate = self.rates[kind]
+        if rate > 0:
+            self.schedule_seq += 1
+            heapq.heappush(self.schedule, (now + random.expovariate(rate), self.schedule_seq,
+                client, kind))
+
+    def send_due_messages(self, now):
+        while len(self.schedule) > 0 and self.schedule[0][0] <= now:
+            due,seq,client,kind = heapq.heappop(self.schedule)
+            if not client.is_open():
+                continue
+            try:
+                self.send_message(client, kind)
+            except socket.error:
+                self.drop_client(client)
+                continue
+            self.schedule_message(client, kind, due)
+
+    def send_message(self, client, kind):
+        if kind == LoadTest.KIND_PING:
+            client.send(MsgPing([Server.SERVER],[],client.client_id,_timestamp()))
+            return
+        text = "%.3f:" % _timestamp()
+        text += "x"*max(0, self.message_size - len(text))
+        if kind == LoadTest.KIND_CHAT:
+            others = [i for i in random.sample(self.joined_ids, min(2, len(self.joined_ids)))
+                if i != client.client_id]
+            if len(others) == 0:
+                return
+            recipients = others[:1]
+        else:
+            recipients = [GameServer.GROUP_PLAYERS]
+        client.send(MsgChat(recipients,[client.client_id],client.client_id,text))
+
+    def client_joined(self, client):
+        now = time.time()
+        self.connect_times.add((now - self.connect_started.pop(client))*1000)
+        self.joined_ids.append(client.client_id)
+        for kind in self.rates:
+            self.schedule_message(client, kind, now)
+
+    def client_rejected(self, client):
+        self.connect_started.pop(client, None)
+        self.rejected += 1
+
+    def pong_received(self, round_trip):
+        self.ping_times.add(round_trip)
+
+    def chat_received(self, delivery_time):
+        self.chat_times.add(delivery_time)
+
+    def get_report(self, elapsed, cpu_time):
+        """
+        Returns a dictionary of the test's results: the number of players which
+        joined, were rejected, failed to connect or were disconnected; message
+        and byte counts and rates; and times, in milliseconds, to join the game,
+        for ping round trips and for chat messages to be delivered.
+        """
+        report = {
+            "duration" : elapsed,
+            "clients" : len(self.clients),
+            "joined" : len(self.joined_ids),
+            "rejected" : self.rejected,
+            "failed" : self.failed,
+            "disconnected" : self.disconnected,
+            "cpu_percent" : 100.0*cpu_time/elapsed if elapsed > 0 else 0.0,
+            "join_ms" : self.connect_times.snapshot(),
+            "ping_ms" : self.ping_times.snapshot(),
+            "chat_ms" : self.chat_times.snapshot()
+        }
+        for k in ("messages_out","messages_in","bytes_out","bytes_in","dropped_out"):
+            report[k] = sum([c.stats.snapshot()[k] for c in self.clients])
+        for k in ("messages_out","messages_in","bytes_out","bytes_in"):
+            report[k+"_per_s"] = report[k]/elapsed if elapsed > 0 else 0.0
+        return report
+
+
+class LocalServer(object):
+    """
+    Runs a game server in a child process for a LoadTest, so that the server's
+    CPU usage can be measured apart from that of the simulated players.
+    "server_factory" is invoked in the child process to create the server,
+    which is run in a TickLoop at "rate" ticks per second. Requires a platform
+    which can fork processes.
+    """
+
+    START_TIMEOUT = 5.0
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, server_factory, rate=30):
+        self.server_factory = server_factory
+        self.rate = rate
+        self.process = None
+        self.connection = None
+
+    def start(self):
+        """
+        Starts the server, raising any error with which it failed to start
+        """
+        self.connection,child_connection = _multiprocessing.Pipe()
+        self.process = _multiprocessing.Process(target=self.run_server, args=(child_connection,))
+        self.process.daemon = True
+        self.process.start()
+        if not self.connection.poll(LocalServer.START_TIMEOUT):
+            self.stop()
+            raise RuntimeError("Server did not start")
+        error = self.connection.recv()
+        if error is not None:
+            self.stop()
+            raise error
+
+    def run_server(self, connection):
+        """
+        Invoked in the child process. Runs the server, answering requests for
+        samples until asked to stop.
+        """
+        try:
+            server = self.server_factory()
+            server.start()
+        except Exception as e:
+            connection.send(e)
+            return
+        loop = TickLoop(server, self.rate)
+        def answer_requests():
+            try:
+                while True:
+                    request = connection.recv()
+                    connection.send(LocalServer.take_sample(server, loop))
+                    if request == "stop":
+                        break
+            finally:
+                loop.stop()
+        thread = threading.Thread(target=answer_requests)
+        thread.daemon = True
+        thread.start()
+        connection.send(None)
+        try:
+            loop.run()
+        finally:
+            server.stop()
+
+    @staticmethod
+    def take_sample(server, loop):
+        times = os.times()
+        stats = server.get_stats()
+        del(stats["clients"])
+        return {
+            "time" : time.time(),
+            "cpu_time" : times[0] + times[1],
+            "num_clients" : server.get_num_clients(),
+            "stats" : stats,
+            "loop" : loop.get_stats()
+        }
+
+    def sample(self):
+        """
+        Returns the server's CPU time used so far, its statistics and those of
+        its TickLoop
+        """
+        self.connection.send("sample")
+        return self.connection.recv()
+
+    @staticmethod
+    def compare(before, after):
+        """
+        Returns the server's CPU usage and throughput between two samples
+        """
+        elapsed = after["time"] - before["time"]
+        report = {
+            "cpu_percent" : 100.0*(after["cpu_time"]-before["cpu_time"])/elapsed if elapsed > 0 else 0.0,
+            "num_clients" : after["num_clients"],
+            "tick_ms" : after["loop"]["tick_ms"],
+        }
+        for k in ("overruns","skipped","carried"):
+            report[k] = after["loop"][k] - before["loop"][k]
+        for k in ("messages_in","messages_out","bytes_in","bytes_out","dropped_out","throttled_in"):
+            report[k] = after["stats"][k] - before["stats"][k]
+        report["event_queue"] = after["stats"]["event_queue"]
+        return report
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            if self.process.is_alive():
+                self.connection.send("stop")
+                if self.connection.poll(LocalServer.STOP_TIMEOUT):
+                    self.connection.recv()
+        except (IOError, EOFError):
+            pass
+        self.process.join(LocalServer.STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+        self.connection.close()
+
+
+def format_report(report):
+    """
+    Returns a LoadTest report as readable text
+    """
+    def times(name, hist):
+        return "%-8s n=%-7d mean %7.1f  p50 %6g  p90 %6g  p99 %6g  max %7.1f ms" % (
+            name, hist["count"], hist["mean"], hist["p50"], hist["p90"], hist["p99"], hist["max"])
+    lines = [
+        "Players:  %d joined, %d rejected, %d failed, %d disconnected in %.1fs" % (
+            report["joined"], report["rejected"], report["failed"], report["disconnected"],
+            report["duration"]),
+        "Sent:     %d messages (%.0f/s), %d bytes (%.0f/s), %d dropped" % (
+            report["messages_out"], report["messages_out_per_s"], report["bytes_out"],
+            report["bytes_out_per_s"], report["dropped_out"]),
+        "Received: %d messages (%.0f/s), %d bytes (%.0f/s)" % (
+            report["messages_in"], report["messages_in_per_s"], report["bytes_in"],
+            report["bytes_in_per_s"]),
+        times("Join", report["join_ms"]),
+        times("Ping", report["ping_ms"]),
+        times("Chat", report["chat_ms"]),
+        "Load test CPU: %.0f%%" % report["cpu_percent"]
+    ]
+    if "server" in report:
+        server = report["server"]
+        lines += [
+            "Server CPU: %.0f%%, %d messages in, %d out, %d dropped, %d throttled" % (
+                server["cpu_percent"], server["messages_in"], server["messages_out"],
+                server["dropped_out"], server["throttled_in"]),
+            times("Tick", server["tick_ms"]),
+            "Ticks overran %d, skipped %d, carried events %d, event queue %d" % (
+                server["overruns"], server["skipped"], server["carried"], server["event_queue"])
+        ]
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load tests a GameServer with simulated players")
+    parser.add_argument("--host", help="server to test - by default, one is started locally")
+    parser.add_argument("--port", type=int, default=57810)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--connect-rate", type=float, default=100.0)
+    parser.add_argument("--ping-rate", type=float, default=1.0)
+    parser.add_argument("--chat-rate", type=float, default=0.5)
+    parser.add_argument("--broadcast-rate", type=float, default=0.05)
+    parser.add_argument("--message-size", type=int, default=32)
+    parser.add_argument("--encoder", choices=("json","binary"), default="json")
+    parser.add_argument("--server", choices=("selector","threaded"), default="selector",
+        help="kind of local server to start")
+    parser.add_argument("--tick-rate", type=float, default=30)
+    args = parser.parse_args()
+
+    encoder_class = BinaryEncoder if args.encoder == "binary" else JsonEncoder
+    server_class = SelectorGameServer if args.server == "selector" else GameServer
+
+    local = None
+    host = args.host
+    if host is None:
+        host = socket.gethostname()
+        local = LocalServer(lambda: server_class(args.clients,
+            lambda server,sock,client_id: GameClientHandler(server,sock,client_id,encoder_class()),
+            args.port), args.tick_rate)
+        local.start()
+    try:
+        test = LoadTest(host, args.port, args.clients, args.connect_rate, args.ping_rate,
+            args.chat_rate, args.broadcast_rate, args.message_size, encoder_class(),
+            server=local)
+        print(format_report(test.run(args.duration)))
+    finally:
+        if local is not None:
+            local.stop()
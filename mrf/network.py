@@ -36,18 +36,35 @@ import json
 import sys
 import time
 import copy
+import errno
+import struct
+import random
+import types
+import collections
+import zlib
+import re
+import keyword
 try:
-    import Queue
+    import selectors
 except ImportError:
-    import queue as Queue
+    selectors = None
+try:
+    zlib.compressobj(zdict=b" ")
+    _zlib_has_zdict = True
+except TypeError:
+    _zlib_has_zdict = False
 from mrf.statemachine import StateMachineBase, statemethod
-from mrf.structs import TagLookup
-from mrf.mathutil import deviation, mean
+from mrf.structs import TagLookup, SpatialGrid, IntrospectType
+from mrf.codegen import FunctionDefiner
 
 try:
+    basestring
     unicode
+    long
 except NameError:
+    basestring = str
     unicode = str
+    long = int
 
 """    
 TODO: Structure diagram
@@ -67,6 +84,13 @@ TODO: Refactor telnet module to use generic client/server classes
     '--2----. |1 '--1---. |2          |                    
           GameServer   GameClient  GameClHandler
 
+   SelectorServer extends Server, multiplexing all of its client handlers' 
+   sockets in its own thread rather than running each handler in a thread of
+   its own. SelectorGameServer combines it with GameServer.
+
+   GameServer and GameClient may also open a UdpChannel, over which messages
+   marked as unreliable are sent as datagrams, alongside the TCP connection.
+
 """
     
 def lockable_attrs(obj, **kargs):
@@ -82,6 +106,16 @@ class NetworkThread(threading.Thread):
         lockable_attrs(self,
             stopping = False
         )
+        # pair of sockets used to wake the thread when it is asked to stop
+        self.wakeup_sockets = None
+
+    def start(self):
+        """    
+        Overidden from Thread. Opens the thread's wake-up sockets before 
+        starting it.
+        """
+        self.wakeup_sockets = _make_wakeup_sockets()
+        threading.Thread.start(self)
 
     def run(self):
         """    
@@ -92,16 +126,51 @@ class NetworkThread(threading.Thread):
                 if self.stopping:
                     break
 
+    def get_wakeup_socket(self):
+        """    
+        Returns a socket which becomes readable once the thread is asked to 
+        stop, to be waited on along with the thread's own sockets so that it 
+        stops straight away. Returns None if the thread has no wake-up sockets.
+        """
+        pair = self.wakeup_sockets
+        return pair[0] if pair is not None else None
+
+    def signal_stop(self):
+        """    
+        Asks this network thread to stop, waking it if it is waiting on its 
+        sockets, without waiting for it to finish.
+        """
+        with self.stopping_lock:
+            self.stopping = True
+            if self.wakeup_sockets is not None:
+                try:
+                    self.wakeup_sockets[1].send(b"x")
+                except socket.error:
+                    # already woken
+                    pass
+
     def stop(self):
         """    
         May be used to stop this network thread. Blocks until the thread has stopped
         running. Should be overidden to perform any other cleanup tasks required 
         to shut down the thread.
         """
-        with self.stopping_lock:
-            self.stopping = True
+        self.signal_stop()
         if self.is_alive():
             self.join()
+        self.close_wakeup_sockets()
+
+    def close_wakeup_sockets(self):
+        """    
+        Closes the thread's wake-up sockets. Should be invoked by the thread 
+        as it finishes running.
+        """
+        with self.stopping_lock:
+            pair = self.wakeup_sockets
+            self.wakeup_sockets = None
+        if pair is not None:
+            for s in pair:
+                s.close()
     
     def handle_network_error(self, error_info):
         """    
@@ -121,12 +190,62 @@ class NetworkThread(threading.Thread):
 class NoEventHandlerError(Exception): pass    
 
 
+# released events kept for reuse, by class
+_event_pools = {}
+
+
 class Event(object):
     """    
     Base class for network events which are added to the event queue for game
-    loop to process.
+    loop to process. Classes which set "pool_size" are pooled: up to that 
+    many released instances are kept and reused by "acquire", rather than 
+    allocating a new instance for every event. Instances of pooled classes are
+    released by "process_events" once handled, so handlers must not keep 
+    references to them - they should copy out any data they need.
     """
-    pass
+    
+    __slots__ = ()
+
+    pool_size = 0
+
+    @classmethod
+    def acquire(cls, *args, **kargs):
+        """    
+        Returns an instance of the class initialised with the given arguments,
+        reusing a released instance if there is one
+        """
+        if cls.pool_size:
+            pool = _event_pools.get(cls)
+            if pool:
+                try:
+                    event = pool.pop()
+                except IndexError:
+                    # another thread took the last one
+                    pass
+                else:
+                    event.__init__(*args, **kargs)
+                    return event
+        return cls(*args, **kargs)
+
+    def release(self):
+        """    
+        Returns the event to its class's pool, if the class is pooled. The 
+        event must not be used afterwards, and must be released only once.
+        """
+        cls = self.__class__
+        if cls.pool_size:
+            pool = _event_pools.setdefault(cls, [])
+            if len(pool) < cls.pool_size:
+                self.reset()
+                pool.append(self)
+
+    def reset(self):
+        """    
+        Invoked when a pooled event is released. May be overidden to drop 
+        references to large data held by the event, so that it isn't kept 
+        alive by the pool. The event is initialised again when reused.
+        """
+        pass
 
 
 class EvtFatalError(Event):
@@ -170,13 +289,385 @@ class EvtClientDeparted(Event):
         self.client_id = client_id
 
 
+class EventQueue(object):
+    """    
+    Thread-safe queue of events which are taken all at once. Adding and taking 
+    events each hold the lock only to append to or swap the underlying deque.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+
+    def take_all(self):
+        """    
+        Removes and returns all of the waiting events
+        """
+        with self.lock:
+            items = self.items
+            self.items = collections.deque()
+        return items
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return len(self.items) == 0
+
+
+class Histogram(object):
+    """    
+    Counts values in buckets with the given upper bounds, plus an overflow 
+    bucket, keeping the count, total, minimum and maximum as well.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.clear()
+
+    def clear(self):
+        self.counts = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        i = 0
+        for b in self.bounds:
+            if value <= b:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, p):
+        """    
+        Returns the upper bound of the bucket containing the given percentile,
+        or the maximum value if it falls in the overflow bucket
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for i,c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c > 0:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        buckets = {}
+        for i,c in enumerate(self.counts):
+            buckets["le_%g" % self.bounds[i] if i < len(self.bounds) else "inf"] = c
+        return {
+            "count" : self.count,
+            "mean" : self.mean(),
+            "min" : self.min if self.min is not None else 0.0,
+            "max" : self.max if self.max is not None else 0.0,
+            "p50" : self.percentile(50),
+            "p90" : self.percentile(90),
+            "p99" : self.percentile(99),
+            "buckets" : buckets
+        }
+
+
+class NetworkStats(object):
+    """    
+    Counters for a connection - bytes and messages in and out, outgoing 
+    messages dropped and incoming ones refused by a rate limit, counts and 
+    encode/decode times per message type, time spent waiting for the socket 
+    lock to send, and latency and jitter from ping round trips. Times are in
+    milliseconds. "snapshot" returns them as a dictionary.
+    """
+
+    LOCK_WAIT_BOUNDS = (0.01, 0.1, 1, 10, 100)
+    LATENCY_BOUNDS = (5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.messages_in = 0
+            self.messages_out = 0
+            self.dropped_out = 0
+            self.throttled_in = 0
+            self.types = {}
+            self.lock_wait = Histogram(NetworkStats.LOCK_WAIT_BOUNDS)
+            self.latency = Histogram(NetworkStats.LATENCY_BOUNDS)
+            self.jitter = Histogram(NetworkStats.LATENCY_BOUNDS)
+            self.last_latency = None
+
+    def _type_stats(self, message_type):
+        name = message_type.__name__
+        stats = self.types.get(name)
+        if stats is None:
+            stats = {"in":0, "out":0, "encode_ms":0.0, "decode_ms":0.0}
+            self.types[name] = stats
+        return stats
+
+    def sent(self, message_type, encode_time):
+        with self.lock:
+            self.messages_out += 1
+            stats = self._type_stats(message_type)
+            stats["out"] += 1
+            stats["encode_ms"] += encode_time*1000
+
+    def received(self, message_type, decode_time):
+        with self.lock:
+            self.messages_in += 1
+            stats = self._type_stats(message_type)
+            stats["in"] += 1
+            stats["decode_ms"] += decode_time*1000
+
+    def wrote(self, num_bytes):
+        with self.lock:
+            self.bytes_out += num_bytes
+
+    def read(self, num_bytes):
+        with self.lock:
+            self.bytes_in += num_bytes
+
+    def dropped(self, count=1):
+        with self.lock:
+            self.dropped_out += count
+
+    def throttled(self):
+        with self.lock:
+            self.throttled_in += 1
+
+    def lock_waited(self, wait_time):
+        with self.lock:
+            self.lock_wait.add(wait_time*1000)
+
+    def round_trip(self, latency):
+        """    
+        Records the one-way latency, in milliseconds, measured from a ping, and
+        the jitter since the previous measurement
+        """
+        with self.lock:
+            self.latency.add(latency)
+            if self.last_latency is not None:
+                self.jitter.add(abs(latency - self.last_latency))
+            self.last_latency = latency
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "bytes_in" : self.bytes_in,
+                "bytes_out" : self.bytes_out,
+                "messages_in" : self.messages_in,
+                "messages_out" : self.messages_out,
+                "dropped_out" : self.dropped_out,
+                "throttled_in" : self.throttled_in,
+                "types" : dict([(k,dict(v)) for k,v in self.types.items()]),
+                "lock_wait_ms" : self.lock_wait.snapshot(),
+                "latency_ms" : self.latency.snapshot(),
+                "jitter_ms" : self.jitter.snapshot()
+            }
+
+
+class TokenBucket(object):
+    """    
+    Rate limiter allowing "rate" actions per second on average, in bursts of
+    up to "burst" actions
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def consume(self, n=1):
+        """    
+        Returns True, using up "n" tokens, if there are that many available
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+
+class OutgoingQueue(object):
+    """    
+    Queue of entries waiting to be written to a connection, held in a lane for
+    each message priority. Entries are taken in weighted turns: in each round
+    lane i gives up to "weights[i]" entries, the most urgent lanes first, so
+    that urgent entries overtake the rest without the others being starved.
+    An entry which has been partly written can be "pinned" at the head, so
+    that nothing overtakes it. Iterating gives the entries in the order they
+    would be taken.
+    """
+
+    def __init__(self, weights):
+        self.weights = tuple(weights)
+        self.lanes = [collections.deque() for w in self.weights]
+        self.credits = list(self.weights)
+        self.head = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count + (1 if self.head is not None else 0)
+
+    def __iter__(self):
+        if self.head is not None:
+            yield self.head
+        credits = list(self.credits)
+        waiting = [len(l) for l in self.lanes]
+        iters = [iter(l) for l in self.lanes]
+        for i in range(self.count):
+            lane = self._choose_lane(credits, waiting)
+            credits[lane] -= 1
+            waiting[lane] -= 1
+            yield next(iters[lane])
+
+    def _choose_lane(self, credits, waiting):
+        """    
+        Returns the lane to take from next, starting a new round if each lane
+        with entries has had its turns
+        """
+        for i in range(len(waiting)):
+            if waiting[i] > 0 and credits[i] > 0:
+                return i
+        credits[:] = self.weights
+        for i in range(len(waiting)):
+            if waiting[i] > 0:
+                return i
+
+    def append(self, entry, lane):
+        self.lanes[lane].append(entry)
+        self.count += 1
+
+    def popleft(self):
+        if self.head is not None:
+            entry = self.head
+            self.head = None
+            return entry
+        if self.count == 0:
+            raise IndexError("pop from empty queue")
+        lane = self._choose_lane(self.credits, [len(l) for l in self.lanes])
+        self.credits[lane] -= 1
+        self.count -= 1
+        return self.lanes[lane].popleft()
+
+    def pin(self):
+        """    
+        Fixes the next entry at the head of the queue
+        """
+        if self.head is None and self.count > 0:
+            self.head = self.popleft()
+
+    def discard(self, predicate):
+        """    
+        Removes the entries for which the given function returns True, except
+        a pinned one. Lanes are visited least urgent first, and entries oldest
+        first. Returns the removed entries.
+        """
+        removed = []
+        for i in reversed(range(len(self.lanes))):
+            kept = collections.deque()
+            for entry in self.lanes[i]:
+                if predicate(entry):
+                    removed.append(entry)
+                else:
+                    kept.append(entry)
+            self.lanes[i] = kept
+        self.count -= len(removed)
+        return removed
+
+    def clear(self):
+        for l in self.lanes:
+            l.clear()
+        self.credits = list(self.weights)
+        self.head = None
+        self.count = 0
+
+
+# cached lookups of event handler methods by (class, event class, prefix)
+_handler_methods = {}
+
+def _find_handler_method(cls, name):
+    """    
+    Returns the function implementing the named method of the given class, 
+    None if there is no such method, or the name itself if the method can only
+    be looked up on the instance.
+    """
+    if (not isinstance(cls, type) or cls.__getattribute__ is not object.__getattribute__
+            or hasattr(cls, "__getattr__")):
+        # attributes may be computed per instance
+        return name
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            attr = klass.__dict__[name]
+            if isinstance(attr, types.FunctionType):
+                return attr
+            # some other kind of descriptor
+            return name
+    return None
+
+def dispatch_event(obj, event, prefix):
+    """    
+    Invokes the method of "obj" named with the given prefix followed by the 
+    event's class name, e.g. "handle_MsgChat", if it has one. Returns True if 
+    the method was found. Methods of the object's class are looked up once for
+    each class of object and event; one assigned to the object itself is used 
+    in its place.
+    """
+    key = (obj.__class__, event.__class__, prefix)
+    try:
+        method,name = _handler_methods[key]
+    except KeyError:
+        name = prefix+event.__class__.__name__
+        method = _find_handler_method(obj.__class__, name)
+        _handler_methods[key] = method,name
+    attrs = getattr(obj, "__dict__", None)
+    if attrs and name in attrs:
+        attrs[name](event)
+        return True
+    if method is None:
+        return False
+    if isinstance(method, str):
+        bound = getattr(obj, method, None)
+        if bound is None:
+            return False
+        bound(event)
+        return True
+    method(obj, event)
+    return True
+
+
 class Node(object):
     """    
     Base class for all nodes in the network i.e. clients and server
     """
     
     def __init__(self):
-        self.event_queue = Queue.Queue()
+        self.event_queue = EventQueue()
+        # events taken from the queue but left unprocessed by a limited 
+        # "process_events", to be processed first next time
+        self.carried_events = collections.deque()
+        # object with a "record" method, passed each message queued
+        self.recorder = None
 
     def send(self, message):
         """    
@@ -191,12 +682,12 @@ class Node(object):
         Attempts to locate interceptor method called "intercept_<messagetype>" 
         and if found, the message is handled by it. If no intercept method is 
         found, the message is simply added to the event queue to be picked up 
-        by the game loop, which is how most messages should be handled.
+        by the game loop, which is how most messages should be handled. Queued
+        messages are passed to the node's recorder first, if it has one.
         """
-        hname = "intercept_"+message.__class__.__name__
-        if hasattr(self, hname):
-            getattr(self, hname)(message)
-        else:
+        if not dispatch_event(self, message, "intercept_"):
+            if self.recorder is not None:
+                self.recorder.record(message)
             self.event_queue.put(message)
 
     def get_node_id(self):
@@ -213,18 +704,12 @@ class Node(object):
         """    
         Removes and returns waiting events from the event queue.
         """
-        events = []
-        num = self.event_queue.qsize()
-        for i in range(num):
-            try:
-                events.append(self.event_queue.get(block=False))
-            except Queue.Empty:
-                # qsize is not exact, so we might try to get one more items than 
-                # exist in the queue. Can safely ignore exception
-                pass
+        events = list(self.carried_events)
+        self.carried_events.clear()
+        events.extend(self.event_queue.take_all())
         return events
     
-    def process_events(self, handler=None):
+    def process_events(self, handler=None, max_events=None, max_time=None):
         """    
         Takes waiting events from the queue and dispatches them to their handler
         methods. Should be invoked in the Node's game loop. A method named 
@@ -233,25 +718,71 @@ class Node(object):
         "handler" object, if found. Thus events may be handled both internally
         and by the application. If an event is not handled after checking 
         internally and in the handler object, a NoEventHandlerError is raised.
+        Handled events of pooled classes are then released for reuse. At most
+        "max_events" events are processed, or as many as can be in "max_time"
+        seconds, if specified - the rest are carried over to the next 
+        invocation. Messages sent while handling the events are then flushed.
+        Returns the number of events processed.
         """
-        for event in self.take_events():
-            handled = False
-            hname = "handle_"+event.__class__.__name__
+        count = self.dispatch_events(handler, max_events, max_time)
+        # send anything queued up while handling the events
+        self.flush()
+        return count
+
+    def dispatch_events(self, handler=None, max_events=None, max_time=None):
+        """    
+        Dispatches waiting events as "process_events" does, but without 
+        flushing afterwards. Returns the number of events processed.
+        """
+        events = self.carried_events
+        events.extend(self.event_queue.take_all())
+        if max_time is not None:
+            deadline = time.time() + max_time
+        count = 0
+        while len(events) > 0:
+            if max_events is not None and count >= max_events:
+                break
+            if max_time is not None and count > 0 and time.time() >= deadline:
+                break
+            event = events.popleft()
+            count += 1
             
             # dispatch to internal handler method using naming convention            
-            if hasattr(self, hname):
-                getattr(self, hname)(event)
-                handled = True
-            else:
-                handled = self.delegate_event(event, hname)
+            handled = dispatch_event(self, event, "handle_")
+            if not handled:
+                handled = self.delegate_event(event, "handle_"+event.__class__.__name__)
             
             # dispatch to application handler method
-            if handler!=None and hasattr(handler,hname):
-                getattr(handler,hname)(event)
+            if handler is not None and dispatch_event(handler, event, "handle_"):
                 handled = True
                 
             if not handled:
-                raise NoEventHandlerError(hname)            
+                raise NoEventHandlerError("handle_"+event.__class__.__name__)
+
+            # finished with the event
+            event.release()
+
+        return count
+
+    def has_events(self):
+        """    
+        Returns True if there are events waiting to be processed
+        """
+        return len(self.carried_events) > 0 or not self.event_queue.empty()
+
+    def flush(self):
+        """    
+        Writes any messages waiting in outgoing queues. Invoked at the end of 
+        "process_events". Should be overidden in subclasses which batch their
+        outgoing messages.
+        """
+        pass
+
+    def get_stats(self):
+        """    
+        Returns a dictionary of statistics about the node, for monitoring
+        """
+        return { "event_queue" : self.event_queue.qsize() + len(self.carried_events) }
     
     def delegate_event(self, event, handler_name):
         """    
@@ -262,11 +793,221 @@ class Node(object):
         return False
     
 
-def wait_for_data(socket, timeout):
-    rlist,wlist,xlist = select.select([socket],[],[],timeout)
+def _make_wakeup_sockets():
+    """    
+    Returns a connected pair of sockets with which to wake a thread waiting on
+    its sockets, or None on platforms without socketpair
+    """
+    if not hasattr(socket, "socketpair"):
+        return None
+    try:
+        pair = socket.socketpair()
+    except socket.error:
+        return None
+    for s in pair:
+        s.setblocking(False)
+    return pair
+
+def wait_for_data(socket, timeout, wakeup=None):
+    """    
+    Waits for the socket to become readable, returning whether it is. Returns
+    early if the "wakeup" socket, if given, becomes readable.
+    """
+    rlist,wlist,xlist = select.select([socket] if wakeup is None else [socket,wakeup],
+        [],[],timeout)
     return socket in rlist
+
+def open_listen_socket(port, backlog):
+    """    
+    Returns a new non-blocking socket listening on the given port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # turn off nagle's algorithm to favour low latency over bandwidth
+        sock.setsockopt(socket.SOL_TCP,socket.TCP_NODELAY,1)
+        # allow a restarted server to listen on the port straight away. On 
+        # windows this would let another process steal the port instead
+        if sys.platform != "win32":
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.setblocking(False)
+        sock.bind((socket.gethostname(),port))
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def wait_for_socket(socket, timeout, write=False, wakeup=None):
+    """    
+    Waits for the socket to become readable, or writable too if "write" is 
+    True, returning whether it is readable and whether it is writable. Returns
+    early if the "wakeup" socket, if given, becomes readable.
+    """
+    rlist,wlist,xlist = select.select([socket] if wakeup is None else [socket,wakeup],
+        [socket] if write else [],[],timeout)
+    return socket in rlist, socket in wlist
     
 
+class SocketPoller(object):
+    """    
+    Waits for data on many sockets at once. Uses the "selectors" module where
+    available, falling back to epoll, or plain select on platforms without it.
+    Each socket is registered along with an arbitrary data object, which is
+    returned by "poll" when the socket becomes readable.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.sockets = {}
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+            self.epoll = None
+        elif hasattr(select, "epoll"):
+            self.selector = None
+            self.epoll = select.epoll()
+        else:
+            self.selector = None
+            self.epoll = None
+
+    def register(self, sock, data):
+        if self.selector is not None:
+            self.selector.register(sock, selectors.EVENT_READ, data)
+        elif self.epoll is not None:
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+        self.data[sock.fileno()] = data
+        self.sockets[sock.fileno()] = sock
+
+    def unregister(self, sock):
+        """    
+        Stops polling the given socket. Must be invoked before the socket is 
+        closed - a socket already closed is assumed to have been unregistered.
+        """
+        try:
+            fd = sock.fileno()
+        except socket.error:
+            return
+        if not fd in self.data:
+            return
+        if self.selector is not None:
+            self.selector.unregister(sock)
+        elif self.epoll is not None:
+            self.epoll.unregister(fd)
+        del(self.data[fd])
+        del(self.sockets[fd])
+
+    def poll(self, timeout):
+        """    
+        Blocks for up to "timeout" seconds until at least one socket is readable, 
+        returning the data objects of the readable sockets.
+        """
+        if self.selector is not None:
+            return [k.data for k,ev in self.selector.select(timeout)]
+        elif self.epoll is not None:
+            try:
+                return [self.data[fd] for fd,ev in self.epoll.poll(timeout) if fd in self.data]
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+        else:
+            rlist,wlist,xlist = select.select(list(self.sockets.values()),[],[],timeout)
+            return [self.data[s.fileno()] for s in rlist]
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+        elif self.epoll is not None:
+            self.epoll.close()
+        self.data = {}
+        self.sockets = {}
+
+
+def seq_newer(seq, last):
+    """    
+    Returns True if 32 bit sequence number "seq" is newer than "last", allowing
+    for wrap-around.
+    """
+    return seq != last and ((seq - last) & 0xffffffff) < 0x80000000
+
+
+class UdpChannel(NetworkThread):
+    """    
+    A datagram socket used alongside TCP connections for unreliable messages. 
+    Each datagram carries a header of its kind, the token identifying the 
+    connection it belongs to and a sequence number. After constructing, "start"
+    should be invoked to bind the socket and begin receiving datagrams in a 
+    thread of its own, which are passed to the receiver's "datagram_received"
+    method as (kind, token, seq, payload, address).
+    """
+
+    HEADER = struct.Struct(">BQI")
+    KIND_HELLO = 0
+    KIND_HELLO_ACK = 1
+    KIND_MESSAGE = 2
+    READ_POLL_INTERVAL = 0.5
+    # larger messages are sent over TCP to avoid IP fragmentation
+    MAX_PAYLOAD_SIZE = 1200
+
+    def __init__(self, receiver, address, connected_to):
+        NetworkThread.__init__(self)
+        self.receiver = receiver
+        self.address = address
+        self.connected_to = connected_to
+        lockable_attrs(self,
+            socket = None
+        )
+
+    def start(self):
+        with self.socket_lock:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self.socket.bind(self.address)
+                self.socket.setblocking(False)
+            except:
+                self.socket.close()
+                raise
+        NetworkThread.start(self)
+
+    def run(self):
+        while True:
+            with self.stopping_lock:
+                if self.stopping:
+                    break
+            try:
+                if not wait_for_data(self.socket, UdpChannel.READ_POLL_INTERVAL, 
+                        self.get_wakeup_socket()):
+                    continue
+                data,address = self.socket.recvfrom(65536)
+            except socket.error as e:
+                # datagrams may be refused or dropped without harming the channel
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED):
+                    continue
+                self.receiver.handle_network_error((self.connected_to,e))
+                break
+            if len(data) < UdpChannel.HEADER.size:
+                continue
+            kind,token,seq = UdpChannel.HEADER.unpack_from(data)
+            try:
+                self.receiver.datagram_received(kind, token, seq, 
+                    data[UdpChannel.HEADER.size:], address)
+            except:
+                self.receiver.handle_unexpected_error((self.connected_to,sys.exc_info()[1]))
+
+    def send_datagram(self, kind, token, seq, payload, address):
+        with self.socket_lock:
+            self.socket.sendto(UdpChannel.HEADER.pack(kind, token, seq) + payload, address)
+
+    def get_port(self):
+        with self.socket_lock:
+            return self.socket.getsockname()[1]
+
+    def stop(self):
+        NetworkThread.stop(self)
+        with self.socket_lock:
+            if self.socket is not None:
+                self.socket.close()
+
+
 class Server(Node, NetworkThread):    
     """    
     A socket server. After constructed, the "start" method should be invoked to begin
@@ -274,9 +1015,12 @@ class Server(Node, NetworkThread):
     """
     
     ACCEPT_POLL_INTERVAL = 0.5
+    LISTEN_BACKLOG = 128
     SERVER = -1
     GROUP_ALL = "all"
     GROUP_CLIENTS = "clients"
+    INTEREST_CELL_SIZE = 100.0
+    RECIPIENTS_MEMO_SIZE = 256
 
     def __init__(self, client_factory, port):
         """    
@@ -293,28 +1037,89 @@ class Server(Node, NetworkThread):
         
         self.listen_socket = None
         self.next_id = 0
+        self.batch_window = None
+        self.rate_limit = None
+        self.outgoing_limit = None
         lockable_attrs(self,
             handlers = {},        
             node_groups = TagLookup()
         )
+        # client positions, for area recipients. Guarded by node_groups_lock
+        self.interest_grid = SpatialGrid(Server.INTEREST_CELL_SIZE)
+        # resolved recipients of recently sent messages, while groups unchanged
+        self.recipients_memo = {}
+        self.recipients_memo_version = None
 
     def make_client_id(self):
         id = self.next_id
         self.next_id += 1
         return id
 
+    def create_handler(self, conn, client_id):
+        """    
+        Creates a client handler for the given connection using the client 
+        factory and adds it to the server's handlers.
+        """
+        handler = self.client_factory(self,conn,client_id)
+        handler.set_batch_window(self.batch_window)
+        if self.rate_limit is not None:
+            handler.set_rate_limit(*self.rate_limit)
+        if self.outgoing_limit is not None:
+            handler.set_outgoing_limit(*self.outgoing_limit)
+        with self.handlers_lock:
+            self.handlers[client_id] = handler
+        return handler
+
+    def set_batch_window(self, window):
+        """    
+        Sets the batch window used by the client handlers - see 
+        SocketListener.set_batch_window
+        """
+        self.batch_window = window
+        with self.handlers_lock:
+            for c in self.handlers:
+                self.handlers[c].set_batch_window(window)
+
+    def set_rate_limit(self, rate, burst=None):
+        """    
+        Limits the rate at which each client may send messages - see 
+        ClientHandler.set_rate_limit
+        """
+        self.rate_limit = (rate, burst)
+        with self.handlers_lock:
+            for c in self.handlers:
+                self.handlers[c].set_rate_limit(rate, burst)
+
+    def set_outgoing_limit(self, max_bytes, policy="drop-oldest"):
+        """    
+        Bounds the data waiting to be written to each client - see 
+        SocketListener.set_outgoing_limit
+        """
+        self.outgoing_limit = (max_bytes, policy)
+        with self.handlers_lock:
+            for c in self.handlers:
+                self.handlers[c].set_outgoing_limit(max_bytes, policy)
+
+    def flush(self):
+        """    
+        Writes the messages waiting in the client handlers' outgoing queues
+        """
+        with self.handlers_lock:
+            templist = list(self.handlers.items())
+        for c,handler in templist:
+            try:
+                handler.flush()
+            except socket.error as e:
+                self.handle_network_error((c,e))
+            except:
+                self.handle_unexpected_error((c,sys.exc_info()[1]))
+
     def start(self):
         """    
         Starts the server. Overidden from NetworkThread
         """
         try:
-            # open listen socket
-            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # turn off nagle's algorithm to favour low latency over bandwidth
-            self.listen_socket.setsockopt(socket.SOL_TCP,socket.TCP_NODELAY,1)
-            self.listen_socket.setblocking(False)
-            self.listen_socket.bind((socket.gethostname(),self.port))
-            self.listen_socket.listen(1)
+            self.listen_socket = self.open_listen_socket()
         
             # initialise variables
             self.next_id = 0
@@ -323,6 +1128,9 @@ class Server(Node, NetworkThread):
             with self.node_groups_lock:
                 self.node_groups = TagLookup()
                 self.node_groups.tag_item(Server.SERVER, Server.GROUP_ALL)
+                self.interest_grid.clear()
+                self.recipients_memo = {}
+                self.recipients_memo_version = None
         
             # begin running in thread
             NetworkThread.start(self)
@@ -335,6 +1143,12 @@ class Server(Node, NetworkThread):
             raise
                 
 
+    def open_listen_socket(self):
+        """    
+        Returns a new non-blocking socket listening on the server's port
+        """
+        return open_listen_socket(self.port, Server.LISTEN_BACKLOG)
+
     def run(self):
         """    
         Overridden from NetworkThread - runs the server, listening on the specified port for 
@@ -348,12 +1162,16 @@ class Server(Node, NetworkThread):
                     if self.stopping:
                         break
                                 
-                if wait_for_data(self.listen_socket, Server.ACCEPT_POLL_INTERVAL):
-                    conn,addr = self.listen_socket.accept()
-                    new_id = self.make_client_id()
-                    handler = self.client_factory(self,conn,new_id)
-                    with self.handlers_lock:
-                        self.handlers[new_id] = handler
+                if wait_for_data(self.listen_socket, Server.ACCEPT_POLL_INTERVAL, 
+                        self.get_wakeup_socket()):
+                    try:
+                        conn,addr = self.listen_socket.accept()
+                    except socket.error as e:
+                        # another process sharing the socket may have beaten us to it
+                        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                        raise
+                    handler = self.create_handler(conn, self.make_client_id())
                     handler.start()
                 
         except socket.error as e:    
@@ -370,6 +1188,7 @@ class Server(Node, NetworkThread):
                 self.listen_socket.close()
             # stop client handler threads
             self.stop_handlers()
+            self.close_wakeup_sockets()
     
     def handle_network_error(self, error_info):
         # add event to queue to notify application
@@ -394,15 +1213,27 @@ class Server(Node, NetworkThread):
     def stop_handlers(self):
         """    
         Invoked when the server is shutting down. Stops the client handler threads.
+        All of the handlers are asked to stop before waiting for any of them, 
+        so that they shut down together.
         """
         templist = []
         with self.handlers_lock:
             for c in self.handlers:
                 templist.append(self.handlers[c])
                 
+        for handler in templist:
+            handler.signal_stop()
         for handler in templist:
             handler.stop()
 
+    def handler_stopped(self, client_id):
+        """    
+        Invoked by a client handler when it is asked to stop. Handlers running
+        in their own threads close their own sockets, so nothing need be done 
+        here.
+        """
+        pass
+
     def client_arrived(self, client_id):
         """    
         Client with given id has connected. Invoked by client handler on startup.
@@ -413,7 +1244,7 @@ class Server(Node, NetworkThread):
             self.node_groups.tag_item(client_id, Server.GROUP_CLIENTS)
             
         # add event to queue
-        self.event_queue.put(EvtClientArrived(client_id))
+        self.event_queue.put(EvtClientArrived.acquire(client_id))
         
     def client_departed(self, client_id):
         """    
@@ -423,52 +1254,122 @@ class Server(Node, NetworkThread):
         # remove from groups
         with self.node_groups_lock:
             self.node_groups.remove_item(client_id)
+            self.interest_grid.remove_item(client_id)
             
         # remove the stopped handler from the dictionary
         with self.handlers_lock:        
             del(self.handlers[client_id])
             
         # add event to queue
-        self.event_queue.put(EvtClientDeparted(client_id))
+        self.event_queue.put(EvtClientDeparted.acquire(client_id))
 
     def send(self, message):
         """    
-        Request appropriate handlers send message to their clients
+        Request appropriate handlers send message to their clients. The message
+        is encoded once and the same data written to each client.
         """
         recips = self.resolve_message_recipients(message)
 
+        self.send_to_handlers(message, recips)
+
+        # queued last, as a pooled message may be released once handled
         if Server.SERVER in recips:
-            recips.remove(Server.SERVER)
             self.received(message)
 
+    def send_to_handlers(self, message, recips):
+        """    
+        Sends the message to those of the given recipients which are clients 
+        of this server, encoding it once for all of them.
+        """
+        cache = {}
         for r in recips:
+            if r == Server.SERVER:
+                continue
             with self.handlers_lock:
-                if self.handlers.has_key(r):
+                if r in self.handlers:
                     try:
-                        self.handlers[r].send(message)
+                        self.handlers[r].send(message, cache)
                         
                     except socket.error as e:
                         self.handle_network_error((r,e))
                     except:
                         self.handle_unexpected_error((r,sys.exc_info()[1]))
 
+    @staticmethod
+    def area(x, y, radius):
+        """    
+        Returns a recipient (or exclude) denoting every client whose position 
+        has been set within "radius" of the given point
+        """
+        return {"x":x, "y":y, "radius":radius}
+
+    def set_client_position(self, client_id, x, y):
+        """    
+        Records the given client's position, used to resolve area recipients
+        """
+        with self.node_groups_lock:
+            self.interest_grid.set_position(client_id, x, y)
+
+    def get_clients_within(self, x, y, radius):
+        with self.node_groups_lock:
+            return self.interest_grid.get_items_within(x, y, radius)
+
     def resolve_message_recipients(self, message):
+        """    
+        Returns a frozenset of the ids of the nodes the given message is for. 
+        Results for messages addressed only by ids and group names are kept, 
+        until the groups next change, so that repeated sends to the same 
+        recipients don't repeat the work.
+        """
+        recipients = message.get_recipients()
+        excludes = message.get_excludes()
+        try:
+            key = (tuple(recipients), tuple(excludes))
+            hash(key)
+        except TypeError:
+            # areas can't be remembered, as clients move
+            key = None
+
         with self.node_groups_lock:
-            exclude = set()
-            for ex in message.get_excludes():
-                if isinstance(ex, basestring):
-                    exclude = exclude.union(self.node_groups.get_tag_items(ex))
-                else:
-                    exclude.add(ex)
-            
-            recips = set()
-            for rec in message.get_recipients():
-                if isinstance(rec, basestring):
-                    recips = recips.union(self.node_groups.get_tag_items(rec))
-                else:
-                    recips.add(rec)
+            version = self.node_groups.version
+            if key is not None and self.recipients_memo_version == version:
+                resolved = self.recipients_memo.get(key)
+                if resolved is not None:
+                    return resolved
+
+            # common case of a single group needs no set building at all
+            if (len(excludes) == 0 and len(recipients) == 1 
+                    and isinstance(recipients[0], basestring)):
+                resolved = self.node_groups.get_tag_snapshot(recipients[0])
+            else:
+                exclude = set()
+                for ex in excludes:
+                    if isinstance(ex, basestring):
+                        exclude.update(self.node_groups.get_tag_snapshot(ex))
+                    elif isinstance(ex, dict):
+                        exclude.update(self.interest_grid.get_items_within(
+                            ex["x"], ex["y"], ex["radius"]))
+                    else:
+                        exclude.add(ex)
                 
-            return recips.difference(exclude)
+                recips = set()
+                for rec in recipients:
+                    if isinstance(rec, basestring):
+                        recips.update(self.node_groups.get_tag_snapshot(rec))
+                    elif isinstance(rec, dict):
+                        recips.update(self.interest_grid.get_items_within(
+                            rec["x"], rec["y"], rec["radius"]))
+                    else:
+                        recips.add(rec)
+                resolved = frozenset(recips.difference(exclude))
+
+            if key is not None:
+                if self.recipients_memo_version != version:
+                    self.recipients_memo = {}
+                    self.recipients_memo_version = version
+                if len(self.recipients_memo) < Server.RECIPIENTS_MEMO_SIZE:
+                    self.recipients_memo[key] = resolved
+            return resolved
 
     def get_node_id(self):
         return Server.SERVER
@@ -480,6 +1381,151 @@ class Server(Node, NetworkThread):
         with self.handlers_lock:
             return len(self.handlers)
 
+    def get_stats(self):
+        """    
+        Overidden from Node. Includes the statistics of each client connection,
+        and their totals.
+        """
+        stats = Node.get_stats(self)
+        with self.handlers_lock:
+            templist = list(self.handlers.items())
+        clients = {}
+        for c,handler in templist:
+            clients[c] = handler.get_stats()
+        stats["clients"] = clients
+        for k in ("bytes_in","bytes_out","messages_in","messages_out","dropped_out",
+                "throttled_in","outgoing_queue"):
+            stats[k] = sum([clients[c][k] for c in clients])
+        return stats
+
+
+class SelectorServer(Server):
+    """    
+    A socket server which services all of its clients from a single thread. 
+    Rather than starting each client handler in a thread of its own, the 
+    handlers' sockets are polled together and "receive_available" is invoked on
+    a handler whenever its socket has data. Client handlers are created by the
+    client factory as for Server, but are never started. After constructed, the
+    "start" method should be invoked to begin the server in its own thread.
+    """
+
+    def start(self):
+        """    
+        Starts the server. Overidden from Server
+        """
+        lockable_attrs(self,
+            closing = set()
+        )
+        Server.start(self)
+
+    def run(self):
+        """    
+        Overidden from Server - runs the server, accepting new clients and 
+        reading from the sockets of connected clients as data arrives.
+        """
+        poller = SocketPoller()
+        try:
+            poller.register(self.listen_socket, None)
+            # the server itself stands for its wake-up socket
+            if self.get_wakeup_socket() is not None:
+                poller.register(self.get_wakeup_socket(), self)
+            while True:
+                # exit loop if shutting down
+                with self.stopping_lock:
+                    if self.stopping:
+                        break
+
+                for handler in poller.poll(Server.ACCEPT_POLL_INTERVAL):
+                    if handler is None:
+                        self.accept_client(poller)
+                    elif handler is self:
+                        continue
+                    else:
+                        self.read_from_handler(poller, handler)
+
+                # clean up handlers which have been asked to stop
+                with self.closing_lock:
+                    closing = self.closing
+                    self.closing = set()
+                for client_id in closing:
+                    self.close_handler(poller, client_id)
+
+        except socket.error as e:    
+            # handle socket error        
+            self.handle_network_error((Server.SERVER,e))
+                                
+        except:
+            # handle all other errors
+            self.handle_unexpected_error((Server.SERVER,sys.exc_info()[1]))
+        
+        finally:
+            # close socket
+            if self.listen_socket != None:
+                poller.unregister(self.listen_socket)
+                self.listen_socket.close()
+            # stop and close client handlers
+            self.stop_handlers()
+            with self.handlers_lock:
+                client_ids = list(self.handlers.keys())
+            for client_id in client_ids:
+                self.close_handler(poller, client_id)
+            poller.close()
+            self.close_wakeup_sockets()
+
+    def accept_client(self, poller):
+        """    
+        Accepts a waiting client connection, creating a handler for it
+        """
+        try:
+            conn,addr = self.listen_socket.accept()
+        except socket.error as e:
+            # another thread or a dropped connection may have beaten us to it
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        new_id = self.make_client_id()
+        handler = self.create_handler(conn, new_id)
+        self.client_arrived(new_id)
+        poller.register(conn, handler)
+
+    def read_from_handler(self, poller, handler):
+        """    
+        Has the given handler read the data waiting on its socket. If the 
+        connection fails, the handler is closed.
+        """
+        try:
+            handler.receive_available()
+        except socket.error as e:
+            handler.handle_network_error((handler.get_connected_to(),e))
+            self.close_handler(poller, handler.get_connected_to())
+        except:
+            handler.handle_unexpected_error((handler.get_connected_to(),sys.exc_info()[1]))
+            self.close_handler(poller, handler.get_connected_to())
+
+    def close_handler(self, poller, client_id):
+        """    
+        Closes the socket of the client handler with the given id and removes
+        the handler.
+        """
+        with self.handlers_lock:
+            handler = self.handlers.get(client_id)
+        if handler is None:
+            return
+        with handler.stopping_lock:
+            handler.stopping = True
+        with handler.get_socket_lock():
+            poller.unregister(handler.get_socket())
+            handler.get_socket().close()
+        self.client_departed(client_id)
+
+    def handler_stopped(self, client_id):
+        """    
+        Overidden from Server. The handler's socket is closed by the server 
+        thread on its next pass.
+        """
+        with self.closing_lock:
+            self.closing.add(client_id)
+
 
 class SocketListener(NetworkThread):
     """    
@@ -488,12 +1534,83 @@ class SocketListener(NetworkThread):
     """
 
     READ_POLL_INTERVAL = 0.5
+    READ_BUFFER_SIZE = 65536
     ENVELOPE_SIZE_FIELD_LENGTH = 2
 
+    # Envelope modes. Connections begin using the short envelope: a 2 byte 
+    # message length. The long (4 byte) and varint envelopes may be negotiated 
+    # when connecting, and encode the length shifted left by 2 bits, with the 
+    # lowest 2 bits giving the kind of frame - a whole message, or a fragment 
+    # of a large message.
+    ENVELOPE_SHORT = "short"
+    ENVELOPE_LONG = "long"
+    ENVELOPE_VARINT = "varint"
+    SUPPORTED_ENVELOPES = (ENVELOPE_VARINT, ENVELOPE_LONG, ENVELOPE_SHORT)
+    LONG_ENVELOPE_FORMAT = struct.Struct(">I")
+    FRAME_WHOLE = 0
+    FRAME_PART = 1
+    FRAME_LAST = 2
+    FRAGMENT_SIZE = 16384
+    MAX_MESSAGE_SIZE = 1<<26
+    MAX_BATCH_SIZE = 65536
+
+    # Compression modes, which may be negotiated when connecting. Each message
+    # payload is then preceded by a byte saying whether it is compressed - 
+    # those smaller than COMPRESSION_THRESHOLD, or which don't get any smaller,
+    # are not. "zlib-dict" primes zlib with a dictionary of strings common in 
+    # encoded messages, and requires Python 3.3 or later.
+    COMPRESSION_ZLIB = "zlib"
+    COMPRESSION_ZLIB_DICT = "zlib-dict"
+    if _zlib_has_zdict:
+        SUPPORTED_COMPRESSION = (COMPRESSION_ZLIB_DICT, COMPRESSION_ZLIB)
+    else:
+        SUPPORTED_COMPRESSION = (COMPRESSION_ZLIB,)
+    COMPRESSION_THRESHOLD = 128
+    COMPRESSION_LEVEL = 6
+    COMPRESSION_DICTIONARY = (b'"sname": "s", "sscore": , "scolour": [, "splayer_info": {'
+        b'"splayers_info": {"splayer_id": , "sreason": "s, "sping_timestamp": '
+        b'"spong_timestamp": , "smessage": "smrf.network.MsgPlayerConnect", '
+        b'"ssender": -1, "sdata": {}}{"stype": "smrf.network.Msg'
+        b'", "srecipients": ["players"], "sexcludes": [], "ssender": ')
+    PAYLOAD_RAW = 0
+    PAYLOAD_ZLIB = 1
+
+    # What to do when a bounded outgoing queue is full - see set_outgoing_limit
+    OVERFLOW_DROP_OLDEST = "drop-oldest"
+    OVERFLOW_COALESCE = "coalesce"
+    OVERFLOW_DISCONNECT = "disconnect"
+
+    # Turns per round given to each message priority's lane of the bounded 
+    # outgoing queue - see OutgoingQueue
+    LANE_WEIGHTS = (8, 4, 1)
+
     def __init__(self, encoder):
         NetworkThread.__init__(self)
         self.encoder = encoder
         self.decoder = encoder
+        self.envelope = SocketListener.ENVELOPE_SHORT
+        self.compression = None
+        # received data is kept in read_buffer between read_start and read_end
+        self.read_buffer = bytearray(SocketListener.READ_BUFFER_SIZE)
+        self.read_start = 0
+        self.read_end = 0
+        self.read_fragments = []
+        self.read_fragments_size = 0
+        # held while writing the fragments of a large message
+        self.stream_lock = threading.RLock()
+        self.stats = NetworkStats()
+        # outgoing data waiting to be written, when batching
+        self.batch_window = None
+        self.outgoing = []
+        self.outgoing_size = 0
+        self.outgoing_since = 0
+        # bounded queue of [data, coalesce key, droppable] not yet written, 
+        # the first of which may be partly written
+        self.max_outgoing = None
+        self.overflow_policy = None
+        self.backlog = OutgoingQueue(self.LANE_WEIGHTS)
+        self.backlog_size = 0
+        self.backlog_offset = 0
 
     def get_socket(self):
         """    
@@ -515,23 +1632,28 @@ class SocketListener(NetworkThread):
 
     def _encode_data_length(self, length):
         l = length
-        e = ""
+        e = bytearray()
         for i in range(SocketListener.ENVELOPE_SIZE_FIELD_LENGTH):
-            e = chr(l%256) + e
-            l = l/256
-        return e
+            e.insert(0, l%256)
+            l = l//256
+        return bytes(e)
         
-    def _decode_data_length(self, bytes):
+    def _decode_data_length(self, data):
+        data = bytearray(data)
         l = 0
         for i in range(SocketListener.ENVELOPE_SIZE_FIELD_LENGTH):
-            l += ord(bytes[-(i+1)]) << (8*i)
+            l += data[-(i+1)] << (8*i)
         return l
 
-    def send(self, message):
+    def send(self, message, cache=None, droppable=True):
         """    
         Encodes the given message and sends it down the socket. Won't send if 
         the SocketListener is stopping. May raise socket.error if the socket
-        has closed or is otherwise unwritable.
+        has closed or is otherwise unwritable. When the same message is sent
+        by several listeners, a dictionary may be passed as "cache" in which 
+        the encoded message is kept, so that it is encoded just once for each
+        kind of encoder, compression and envelope. If "droppable" is False, 
+        the message is never discarded by the outgoing limit.
         """
         # don't send if stopping
         should_send = True
@@ -540,17 +1662,403 @@ class SocketListener(NetworkThread):
                 should_send = False    
         
         if should_send:
-            data = self.encoder.encode(message)
-            length = len(data)
-            if length >= (1<<(8*SocketListener.ENVELOPE_SIZE_FIELD_LENGTH)):
-                raise MessageError("Message too long: %d" % length)
-            length_encoded = self._encode_data_length(length)
-            sent = 0
-            # need to acquire lock to write to socket
-            with self.get_socket_lock():
+            start = time.time()
+            compression = self.compression
+            if cache is None:
+                data = self.encoder.encode(message)
+                if compression is not None:
+                    data = self._compress(data, compression)
+            else:
+                key = self.encoder.__class__
+                if key not in cache:
+                    cache[key] = self.encoder.encode(message)
+                data = cache[key]
+                if compression is not None:
+                    key = (key, compression)
+                    if key not in cache:
+                        cache[key] = self._compress(data, compression)
+                    data = cache[key]
+            self.stats.sent(message.__class__, time.time()-start)
+            self.send_data(data, cache, message.get_coalesce_key(), message.get_priority(),
+                message.keeps_order(), droppable)
+
+    def _compress(self, data, compression):
+        """    
+        Returns the given encoded message prefixed with a flag byte, compressed
+        if it is large enough to be worthwhile
+        """
+        if len(data) >= SocketListener.COMPRESSION_THRESHOLD:
+            if compression == SocketListener.COMPRESSION_ZLIB_DICT:
+                compressor = zlib.compressobj(SocketListener.COMPRESSION_LEVEL, 
+                    zdict=SocketListener.COMPRESSION_DICTIONARY)
+                packed = compressor.compress(data) + compressor.flush()
+            else:
+                packed = zlib.compress(data, SocketListener.COMPRESSION_LEVEL)
+            if len(packed) < len(data):
+                return struct.pack(">B", SocketListener.PAYLOAD_ZLIB) + packed
+        return struct.pack(">B", SocketListener.PAYLOAD_RAW) + data
+
+    def _decompress(self, data):
+        """    
+        Returns the encoded message from the given flagged payload
+        """
+        flag = bytearray(data[0:1])[0]
+        if flag == SocketListener.PAYLOAD_RAW:
+            return data[1:]
+        elif flag == SocketListener.PAYLOAD_ZLIB:
+            if self.compression == SocketListener.COMPRESSION_ZLIB_DICT:
+                decompressor = zlib.decompressobj(zdict=SocketListener.COMPRESSION_DICTIONARY)
+            else:
+                decompressor = zlib.decompressobj()
+            try:
+                unpacked = decompressor.decompress(data[1:], SocketListener.MAX_MESSAGE_SIZE)
+            except zlib.error as e:
+                raise MessageError("Malformed compressed message: %s" % e)
+            if decompressor.unconsumed_tail:
+                raise MessageError("Message too long")
+            return unpacked
+        else:
+            raise MessageError("Unknown payload flag: %d" % flag)
+
+    def send_data(self, data, cache=None, coalesce_key=None, priority=None, ordered=True,
+            droppable=True):
+        """    
+        Writes the given encoded message to the socket, wrapped in an envelope
+        describing its size. Where the envelope mode allows, large messages are 
+        written in fragments, between which other messages may be written to 
+        the socket. The enveloped message is kept in "cache", if given. 
+        "coalesce_key", "priority" and "ordered" are as returned by 
+        Message.get_coalesce_key, Message.get_priority and Message.keeps_order,
+        and "droppable" is as for queue_data. Fragments are always kept in 
+        order, so that those of different messages can't be interleaved.
+        """
+        if len(data) > SocketListener.FRAGMENT_SIZE and self.envelope != SocketListener.ENVELOPE_SHORT:
+            # only one fragmented message may be written at once
+            with self.stream_lock:
+                for i in range(0, len(data), SocketListener.FRAGMENT_SIZE):
+                    fragment = data[i:i+SocketListener.FRAGMENT_SIZE]
+                    if i + SocketListener.FRAGMENT_SIZE >= len(data):
+                        kind = SocketListener.FRAME_LAST
+                    else:
+                        kind = SocketListener.FRAME_PART
+                    lock = self.get_socket_lock()
+                    start = time.time()
+                    with lock:
+                        self.stats.lock_waited(time.time()-start)
+                        self.queue_data(self._encode_envelope(len(fragment), kind) + fragment,
+                            droppable=False, priority=priority)
+        else:
+            # hold lock so envelope mode can't change before data is written
+            lock = self.get_socket_lock()
+            start = time.time()
+            with lock:
+                self.stats.lock_waited(time.time()-start)
                 # send x bytes describing the message size
                 # send the message itself
-                self.get_socket().sendall(length_encoded + data)
+                if cache is None:
+                    self.queue_data(self._encode_envelope(len(data), SocketListener.FRAME_WHOLE) + data,
+                        coalesce_key, droppable, priority, ordered)
+                else:
+                    key = (self.encoder.__class__, self.compression, self.envelope)
+                    if key not in cache:
+                        cache[key] = self._encode_envelope(len(data), SocketListener.FRAME_WHOLE) + data
+                    self.queue_data(cache[key], coalesce_key, droppable, priority, ordered)
+
+    def set_batch_window(self, window):
+        """    
+        Sets how outgoing messages are batched. If None, the default, each 
+        message is written to the socket as soon as it is sent. Otherwise 
+        messages are collected in an outgoing queue and written together when 
+        "flush" is invoked - as it is at the end of "process_events" - or on 
+        sending a message once the oldest queued message has waited "window" 
+        seconds, or when MAX_BATCH_SIZE bytes are waiting. Messages of 
+        Message.PRIORITY_HIGH are written straight away, with those waiting.
+        """
+        with self.get_socket_lock():
+            self.batch_window = window
+            if window is None:
+                self.flush()
+
+    def set_outgoing_limit(self, max_bytes, policy=OVERFLOW_DROP_OLDEST):
+        """    
+        Bounds the outgoing queue to "max_bytes" bytes of data. Data is then 
+        written only as fast as the socket will take it without blocking, the
+        rest waiting in the queue to be written by "flush". If the queue would
+        grow beyond its limit, the overflow policy decides what happens: 
+        OVERFLOW_DROP_OLDEST discards the oldest messages of the lowest 
+        priority, OVERFLOW_COALESCE also replaces waiting messages with newer
+        ones having the same coalesce key (see Message.get_coalesce_key) even
+        within the limit, and OVERFLOW_DISCONNECT drops the connection. 
+        Fragments of large messages are never dropped. Waiting messages which
+        may be reordered (see Message.keeps_order) are written in order of 
+        priority, taking turns with the rest according to LANE_WEIGHTS. If 
+        "max_bytes" is None, the queue is unbounded and writes block, as by 
+        default.
+        """
+        with self.get_socket_lock():
+            self.flush()
+            if max_bytes is None and len(self.backlog) > 0:
+                self._write_backlog(True)
+            self.max_outgoing = max_bytes
+            self.overflow_policy = policy
+
+    def queue_data(self, data, coalesce_key=None, droppable=True, priority=None, 
+            ordered=True):
+        """    
+        Writes the given enveloped data to the socket, or adds it to the 
+        outgoing queue if batching or the connection is backlogged. 
+        "droppable" is False for data which may not be discarded when a 
+        bounded queue overflows or coalesced with newer data. "priority" is one of the Message priorities,
+        PRIORITY_NORMAL if None. Data which is "ordered" is written in the 
+        order queued, whatever its priority, so only other data may overtake 
+        or fall behind it.
+        """
+        if priority is None:
+            priority = Message.PRIORITY_NORMAL
+        urgent = priority == Message.PRIORITY_HIGH
+        lane = Message.PRIORITY_NORMAL if ordered else priority
+        with self.get_socket_lock():
+            if self.max_outgoing is not None:
+                if len(self.backlog) == 0:
+                    self.outgoing_since = time.time()
+                self._add_to_backlog(data, coalesce_key, droppable, lane)
+                if (self.batch_window is None or urgent or self.backlog_size >= SocketListener.MAX_BATCH_SIZE
+                        or time.time() - self.outgoing_since >= self.batch_window):
+                    self._write_backlog()
+                return
+            if self.batch_window is None:
+                self.write_data(data)
+                self.stats.wrote(len(data))
+                return
+            if len(self.outgoing) == 0:
+                self.outgoing_since = time.time()
+            self.outgoing.append(data)
+            self.outgoing_size += len(data)
+            if (urgent or self.outgoing_size >= SocketListener.MAX_BATCH_SIZE
+                    or time.time() - self.outgoing_since >= self.batch_window):
+                self.flush()
+
+    def flush(self):
+        """    
+        Writes the messages waiting in the outgoing queue to the socket at once
+        """
+        with self.get_socket_lock():
+            if len(self.backlog) > 0:
+                self._write_backlog()
+            if len(self.outgoing) == 0:
+                return
+            data = b"".join(self.outgoing)
+            self.outgoing = []
+            self.outgoing_size = 0
+            self.write_data(data)
+            self.stats.wrote(len(data))
+
+    def get_stats(self):
+        """    
+        Returns a dictionary of the connection's statistics, for monitoring
+        """
+        stats = self.stats.snapshot()
+        stats["outgoing_queue"] = len(self.outgoing) + len(self.backlog)
+        return stats
+
+    def _add_to_backlog(self, data, coalesce_key, droppable, lane):
+        """    
+        Adds data to the bounded outgoing queue, applying the overflow policy
+        """
+        if coalesce_key is not None and self.overflow_policy == SocketListener.OVERFLOW_COALESCE:
+            self._discard_from_backlog(lambda entry: entry[2] and entry[1] == coalesce_key)
+        self.backlog.append([data, coalesce_key, droppable], lane)
+        self.backlog_size += len(data)
+        if self.backlog_size - self.backlog_offset > self.max_outgoing:
+            if self.overflow_policy == SocketListener.OVERFLOW_DISCONNECT:
+                self.backlog.clear()
+                self.backlog_size = 0
+                self.backlog_offset = 0
+                self.handle_overflow()
+                raise socket.error("Outgoing queue full")
+            excess = [self.backlog_size - self.backlog_offset - self.max_outgoing]
+            def oldest(entry):
+                if excess[0] <= 0 or not entry[2]:
+                    return False
+                excess[0] -= len(entry[0])
+                return True
+            self._discard_from_backlog(oldest)
+
+    def _discard_from_backlog(self, predicate):
+        """    
+        Removes the queued entries, lowest priority and oldest first, for which
+        the given function returns True - except for one which has been partly
+        written
+        """
+        dropped = self.backlog.discard(predicate)
+        for entry in dropped:
+            self.backlog_size -= len(entry[0])
+        if len(dropped) > 0:
+            self.stats.dropped(len(dropped))
+
+    def _write_backlog(self, blocking=False):
+        """    
+        Writes as much of the bounded outgoing queue as the socket will take, 
+        or all of it if "blocking". Entries are joined and written about 
+        MAX_BATCH_SIZE bytes at a time, rather than copying a long queue for 
+        each write.
+        """
+        while len(self.backlog) > 0:
+            entries = []
+            size = -self.backlog_offset
+            for entry in self.backlog:
+                entries.append(entry)
+                size += len(entry[0])
+                if size >= SocketListener.MAX_BATCH_SIZE:
+                    break
+            data = b"".join([entry[0] for entry in entries])[self.backlog_offset:]
+            if blocking:
+                self.write_data(data)
+                written = len(data)
+            else:
+                written = self.write_available(data)
+            self.stats.wrote(written)
+            full = written < len(data)
+            written += self.backlog_offset
+            for entry in entries:
+                if written < len(entry[0]):
+                    break
+                written -= len(entry[0])
+                self.backlog_size -= len(entry[0])
+                self.backlog.popleft()
+            if written > 0:
+                # nothing may overtake the rest of a partly written entry
+                self.backlog.pin()
+            self.backlog_offset = written
+            if full:
+                break
+
+    def write_available(self, data):
+        """    
+        Writes as much of the given data as the socket will take without 
+        blocking, returning the number of bytes written. By default, writes 
+        all of it.
+        """
+        self.write_data(data)
+        return len(data)
+
+    def handle_overflow(self):
+        """    
+        Invoked when the bounded outgoing queue overflows and the overflow 
+        policy is to disconnect. Stops the listener by default.
+        """
+        with self.stopping_lock:
+            self.stopping = True
+
+    def _encode_envelope(self, length, kind):
+        if self.envelope == SocketListener.ENVELOPE_SHORT:
+            if length >= (1<<(8*SocketListener.ENVELOPE_SIZE_FIELD_LENGTH)):
+                raise MessageError("Message too long: %d" % length)
+            return self._encode_data_length(length)
+        value = (length << 2) | kind
+        if self.envelope == SocketListener.ENVELOPE_LONG:
+            if value >= 1<<32:
+                raise MessageError("Message too long: %d" % length)
+            return SocketListener.LONG_ENVELOPE_FORMAT.pack(value)
+        else:
+            out = bytearray()
+            _write_varint(out, value)
+            return bytes(out)
+
+    def _decode_envelope(self, start, waiting):
+        """    
+        Decodes the envelope at the given position in the read buffer, returning
+        the envelope's size, the message length and the frame kind, or None if
+        the whole envelope has not yet arrived.
+        """
+        buf = self.read_buffer
+        if self.envelope == SocketListener.ENVELOPE_SHORT:
+            size = SocketListener.ENVELOPE_SIZE_FIELD_LENGTH
+            if waiting < size:
+                return None
+            return size,self._decode_data_length(buf[start:start+size]),SocketListener.FRAME_WHOLE
+        elif self.envelope == SocketListener.ENVELOPE_LONG:
+            if waiting < 4:
+                return None
+            value = SocketListener.LONG_ENVELOPE_FORMAT.unpack_from(buf, start)[0]
+            size = 4
+        else:
+            value = 0
+            shift = 0
+            pos = start
+            while True:
+                if pos - start >= waiting:
+                    return None
+                b = buf[pos]
+                pos += 1
+                value |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+                if shift > 63:
+                    raise MessageError("Malformed envelope")
+            size = pos - start
+        return size,value >> 2,value & 3
+
+    def choose_transport_options(self, requested):
+        """    
+        Given a dictionary of transport options requested by the other end of 
+        the connection, each a list of acceptable values in order of preference, 
+        returns a dictionary of the values to be used for those options which 
+        are supported.
+        """
+        chosen = {}
+        for env in requested.get("envelope", []):
+            if env in SocketListener.SUPPORTED_ENVELOPES:
+                chosen["envelope"] = env
+                break
+        for comp in requested.get("compression", []):
+            if comp in SocketListener.SUPPORTED_COMPRESSION:
+                chosen["compression"] = comp
+                break
+        return chosen
+
+    def apply_transport_options(self, options):
+        """    
+        Begins using the given dictionary of negotiated transport options.
+        """
+        with self.get_socket_lock():
+            # data already queued uses the old options, so mustn't be overtaken
+            # by urgent data using the new ones
+            if len(self.backlog) > 0:
+                self._write_backlog(True)
+            if "envelope" in options:
+                self.envelope = options["envelope"]
+            if "compression" in options:
+                self.compression = options["compression"]
+
+    def reset_transport(self):
+        """    
+        Returns the listener to the state of a new connection, discarding any
+        data part read or waiting to be written, and the negotiated transport
+        options.
+        """
+        with self.get_socket_lock():
+            self.envelope = SocketListener.ENVELOPE_SHORT
+            self.compression = None
+            self.read_start = 0
+            self.read_end = 0
+            self.read_fragments = []
+            self.read_fragments_size = 0
+            self.outgoing = []
+            self.outgoing_size = 0
+            self.backlog.clear()
+            self.backlog_size = 0
+            self.backlog_offset = 0
+
+    def write_data(self, data):
+        """    
+        Writes the given encoded data to the socket. May raise socket.error if
+        the socket has closed or is otherwise unwritable.
+        """
+        # need to acquire lock to write to socket
+        with self.get_socket_lock():
+            self.get_socket().sendall(data)
 
     def received(self, message):
         """    
@@ -558,6 +2066,20 @@ class SocketListener(NetworkThread):
         """
         pass
 
+    def signal_stop(self):
+        """    
+        Overidden from NetworkThread. Writes any queued messages before asking
+        the listener to stop
+        """
+        try:
+            with self.get_socket_lock():
+                if self.get_socket() is not None:
+                    self.flush()
+        except socket.error:
+            # connection is going away anyway
+            pass
+        NetworkThread.signal_stop(self)
+
     def run(self):
         """    
         Overidden from Thread. Just invokes listen_on_socket. Should be
@@ -569,9 +2091,6 @@ class SocketListener(NetworkThread):
         """    
         Blocks, waiting for messages on the socket.
         """
-        data = ""
-        length = 0
-        reading_message = False
         try:
             while True:
                 # exit loop if shutting down
@@ -580,30 +2099,17 @@ class SocketListener(NetworkThread):
                         break
                 
                 # dont need to lock read from socket
-                if wait_for_data(self.get_socket(), SocketListener.READ_POLL_INTERVAL):
-                    if not reading_message:
-                        # receive some more of the message length
-                        got = self.get_socket().recv(SocketListener.ENVELOPE_SIZE_FIELD_LENGTH-len(data))
-                        if len(got) == 0:
-                            raise socket.error("Socket closed")
-                        data += got
-                        assert len(data) <= SocketListener.ENVELOPE_SIZE_FIELD_LENGTH
-                        if len(data) == SocketListener.ENVELOPE_SIZE_FIELD_LENGTH:
-                            length = self._decode_data_length(data)
-                            data = ""
-                            reading_message = True
-                    else:
-                        # receive some more of the message body
-                        got = self.get_socket().recv(length-len(data))
-                        if len(got) == 0:
-                            raise socket.error("Socket closed")
-                        data += got
-                        assert len(data) <= length
-                        if len(data) == length:
-                            message = self.decoder.decode(data)
-                            self.received(message)
-                            data = ""
-                            reading_message = False
+                if len(self.backlog) > 0:
+                    # also wait to finish writing the backlog
+                    readable,writable = wait_for_socket(self.get_socket(), 
+                        SocketListener.READ_POLL_INTERVAL, True, self.get_wakeup_socket())
+                    if writable:
+                        self.flush()
+                else:
+                    readable = wait_for_data(self.get_socket(), SocketListener.READ_POLL_INTERVAL,
+                        self.get_wakeup_socket())
+                if readable:
+                    self.receive_available()
                 
         except socket.error as e:
             # catch socket errors            
@@ -619,6 +2125,113 @@ class SocketListener(NetworkThread):
                 if self.get_socket() != None:
                     self.get_socket().close()
 
+    def receive_available(self):
+        """    
+        Reads the data waiting on the socket, invoking "received" for each 
+        message which has fully arrived. Should only be invoked when the socket
+        is known to be readable. Raises socket.error if the socket has closed.
+        """
+        if self.read_end == len(self.read_buffer):
+            self._make_read_space(1)
+        # read straight into the free end of the buffer
+        got = self.get_socket().recv_into(memoryview(self.read_buffer)[self.read_end:])
+        if got == 0:
+            raise socket.error("Socket closed")
+        self.stats.read(got)
+        self.read_end += got
+        self._read_messages()
+
+    def feed_data(self, data):
+        """    
+        Adds data read from the connection to that already received, invoking 
+        "received" for each message which is now complete.
+        """
+        self.stats.read(len(data))
+        if self.read_end + len(data) > len(self.read_buffer):
+            self._make_read_space(len(data))
+        self.read_buffer[self.read_end:self.read_end+len(data)] = data
+        self.read_end += len(data)
+        self._read_messages()
+
+    def _make_read_space(self, size):
+        """    
+        Makes room for at least "size" more bytes at the end of the read buffer,
+        by moving the unprocessed data to the front, or else by replacing the 
+        buffer with a larger one.
+        """
+        waiting = self.read_end - self.read_start
+        if waiting + size <= len(self.read_buffer):
+            self.read_buffer[0:waiting] = self.read_buffer[self.read_start:self.read_end]
+        else:
+            new_buffer = bytearray(max(waiting + size, len(self.read_buffer)*2))
+            new_buffer[0:waiting] = self.read_buffer[self.read_start:self.read_end]
+            self.read_buffer = new_buffer
+        self.read_start = 0
+        self.read_end = waiting
+
+    def _read_messages(self):
+        """    
+        Decodes and dispatches every complete message in the read buffer
+        """
+        while True:
+            start = self.read_start
+            waiting = self.read_end - start
+            envelope = self._decode_envelope(start, waiting)
+            if envelope is None:
+                break
+            header_size,length,kind = envelope
+            if length > SocketListener.MAX_MESSAGE_SIZE:
+                raise MessageError("Message too long: %d" % length)
+            if waiting < header_size + length:
+                # make sure the whole message will fit once it arrives
+                if header_size + length > len(self.read_buffer) - start:
+                    self._make_read_space(header_size + length - waiting)
+                break
+            body_start = start + header_size
+            self.read_start = body_start + length
+            decode_start = time.time()
+            if kind == SocketListener.FRAME_WHOLE:
+                message = self._decode_from_buffer(body_start, self.read_start)
+            else:
+                # collect fragments until the last one arrives
+                self.read_fragments.append(bytes(self.read_buffer[body_start:self.read_start]))
+                self.read_fragments_size += length
+                if self.read_fragments_size > SocketListener.MAX_MESSAGE_SIZE:
+                    raise MessageError("Message too long: %d" % self.read_fragments_size)
+                if kind != SocketListener.FRAME_LAST:
+                    continue
+                data = b"".join(self.read_fragments)
+                self.read_fragments = []
+                self.read_fragments_size = 0
+                if self.compression is not None:
+                    data = self._decompress(data)
+                message = self.decoder.decode(data)
+            self.stats.received(message.__class__, time.time()-decode_start)
+            self.received(message)
+        if self.read_start == self.read_end:
+            # buffer is empty - start again from the beginning
+            self.read_start = 0
+            self.read_end = 0
+            if len(self.read_buffer) > SocketListener.READ_BUFFER_SIZE:
+                # don't keep the memory taken by an unusually large message
+                self.read_buffer = bytearray(SocketListener.READ_BUFFER_SIZE)
+
+    def _decode_from_buffer(self, start, end):
+        """    
+        Decodes the message occupying the given region of the read buffer. 
+        Decoders implementing "decode_buffer" can decode in place, otherwise
+        the message data is copied out of the buffer.
+        """
+        if self.compression is not None:
+            if self.read_buffer[start] != SocketListener.PAYLOAD_RAW:
+                data = memoryview(self.read_buffer)[start:end].tobytes()
+                return self.decoder.decode(self._decompress(data))
+            start += 1
+        if hasattr(self.decoder, "decode_buffer"):
+            return self.decoder.decode_buffer(self.read_buffer, start, end)
+        else:
+            return self.decoder.decode(memoryview(self.read_buffer)[start:end].tobytes())
+
 
 class ClientHandler(SocketListener):
     """    
@@ -631,6 +2244,7 @@ class ClientHandler(SocketListener):
         SocketListener.__init__(self, encoder)
         self.server = server        
         self.id = id        
+        self.rate_limit = None
         lockable_attrs(self,
             socket = socket
         )
@@ -645,6 +2259,37 @@ class ClientHandler(SocketListener):
     def get_connected_to(self):
         return self.id
 
+    def set_rate_limit(self, rate, burst=None):
+        """    
+        Limits the client to sending "rate" messages per second on average, in
+        bursts of up to "burst" messages - by default, the same as "rate". 
+        Messages beyond the limit are discarded. If "rate" is None, there is no
+        limit.
+        """
+        if rate is None:
+            self.rate_limit = None
+        else:
+            self.rate_limit = TokenBucket(rate, burst if burst is not None else rate)
+
+    def write_available(self, data):
+        """    
+        Overidden from SocketListener. Writes without blocking.
+        """
+        try:
+            with self.get_socket_lock():
+                return self.get_socket().send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def handle_overflow(self):
+        """    
+        Overidden from SocketListener. Has the server close the connection.
+        """
+        SocketListener.handle_overflow(self)
+        self.server.handler_stopped(self.id)
+
     def start(self):
         """    
         Starts the client handler. Overidden from SocketListener
@@ -659,16 +2304,43 @@ class ClientHandler(SocketListener):
         try:
             self.listen_on_socket()
         finally:
+            self.close_wakeup_sockets()
             self.server.client_departed(self.id)
 
+    def stop(self):
+        """    
+        Overidden from SocketListener. Also notifies the server, in case the 
+        server is looking after the handler's socket itself.
+        """
+        SocketListener.stop(self)
+        self.server.handler_stopped(self.id)
+
     def received(self, message):
         """    
         When the client handler receives a message from its socket, it
         passes it on to the server for dispatching to its intended recipients.
         The handler ensures that the message's "sender" field is set correctly.
+        Messages concerning the connection itself are intercepted by the handler
+        using "intercept_<messagetype>" methods, as Node does.
         """
         message.sender = self.id
-        self.server.send(message)
+        if self.rate_limit is not None and not self.rate_limit.consume():
+            self.stats.throttled()
+            return
+        if not dispatch_event(self, message, "intercept_"):
+            self.server.send(message)
+
+    def intercept_MsgTransportOptions(self, message):
+        """    
+        The client has requested transport options when connecting. Reply with
+        the options chosen and begin using them straight away - the client waits 
+        for the reply before sending anything else.
+        """
+        chosen = self.choose_transport_options(message.options)
+        with self.get_socket_lock():
+            self.send(MsgTransportOptions([self.id],[],Server.SERVER,chosen))
+            self.flush()
+            self.apply_transport_options(chosen)
         
     def handle_network_error(self, error_info):
         # add to server's event queue
@@ -682,14 +2354,22 @@ class ClientHandler(SocketListener):
 class Client(SocketListener, Node):
     """    
     Socket client. After constructing, "start" method should be invoked in order
-    to start the client running in its own thread.
+    to start the client running in its own thread. Transport options may be
+    given as a dictionary of option names to lists of acceptable values in order
+    of preference, e.g. {"envelope": ["varint","long"]}, to be negotiated with
+    the server on connecting. Compression may be requested with 
+    {"compression": SocketListener.SUPPORTED_COMPRESSION}.
     """
 
-    def __init__(self, host, port, encoder):
+    NEGOTIATE_TIMEOUT = 5.0
+
+    def __init__(self, host, port, encoder, transport_options=None):
         SocketListener.__init__(self, encoder)
         Node.__init__(self)
         self.host = host
         self.port  = port
+        self.transport_options = transport_options
+        self.transport_negotiated = False
         
         # client doesn't know its id yet
         self.client_id = -1
@@ -702,15 +2382,10 @@ class Client(SocketListener, Node):
         Starts the client. Overidden from SocketListener
         """
         try:
-            with self.socket_lock:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # turn off nagle's algorithm to favour low latency over bandwidth
-                self.socket.setsockopt(socket.SOL_TCP,socket.TCP_NODELAY,1)
-                # connect using blocking call                
-                self.socket.setblocking(True)
-                self.socket.connect((self.host, self.port))
-                # then set to non-blocking ready for reads.
-                self.socket.setblocking(False)
+            self.connect()
+
+            if self.transport_options:
+                self.negotiate_transport()
                 
             self.after_connect()
             
@@ -724,6 +2399,21 @@ class Client(SocketListener, Node):
                     self.socket.close()
             raise
 
+    def connect(self, timeout=None):
+        """    
+        Opens the connection to the server, giving up after "timeout" seconds 
+        if specified. Raises socket.error if the connection fails.
+        """
+        with self.socket_lock:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # turn off nagle's algorithm to favour low latency over bandwidth
+            self.socket.setsockopt(socket.SOL_TCP,socket.TCP_NODELAY,1)
+            # connect using blocking call                
+            self.socket.settimeout(timeout)
+            self.socket.connect((self.host, self.port))
+            # then set to non-blocking ready for reads.
+            self.socket.setblocking(False)
+
     def run(self):
         """    
         Overidden from SocketListener. Listens for
@@ -778,12 +2468,44 @@ class Client(SocketListener, Node):
     def recipient_to_next_node(self, recipient):
         return Server.SERVER
 
+    def get_stats(self):
+        """    
+        Both SocketListener and Node have a "get_stats" method! Here we combine
+        the two.
+        """
+        stats = SocketListener.get_stats(self)
+        stats.update(Node.get_stats(self))
+        return stats
+
     def after_connect(self):
         """    
         Invoked just after client connects to server and before client starts 
         listening to messages
         """
         pass
+
+    def negotiate_transport(self):
+        """    
+        Requests the client's transport options from the server and waits for 
+        the reply, before anything else is sent. Servers which don't understand
+        the request will not reply, in which case the defaults continue to be 
+        used once the timeout expires.
+        """
+        self.send(MsgTransportOptions([Server.SERVER],[],-1,self.transport_options))
+        end_time = time.time() + Client.NEGOTIATE_TIMEOUT
+        while not self.transport_negotiated:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            if wait_for_data(self.socket, remaining):
+                self.receive_available()
+
+    def intercept_MsgTransportOptions(self, message):
+        """    
+        Server has replied with the transport options to use
+        """
+        self.apply_transport_options(message.options)
+        self.transport_negotiated = True
     
     def handle_network_error(self, error_info):
         # add to event queue
@@ -794,12 +2516,142 @@ class Client(SocketListener, Node):
         self.event_queue.put(EvtFatalError(*error_info))
         
 
-class Message(Event):
+class _Code(object):
+    """    
+    Stands for a python expression when building functions with 
+    FunctionDefiner, for use inside literals.
+    """
+    
+    def __init__(self, code):
+        self.code = code
+        
+    def __repr__(self):
+        return self.code
+
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+# Declare using 2/3 compatible metaclass use
+_MessageBase = IntrospectType("_MessageBase", (Event,), {
+    "__slots__" : (),
+    "_class_init" : classmethod(lambda cls: None)
+})
+
+
+class Message(_MessageBase):
     """    
-    Base class for network messages. Subclasses should implement "to_dict" to
-    allow the message to be encoded for transport.
+    Base class for network messages. Subclasses should declare their data as
+    "fields", a sequence of (name, type) pairs such as 
+    (("player_id",int),("reason",unicode)), to allow the message to be encoded
+    for transport. Functions to read and write the fields are generated once, 
+    when the class is defined. Subclasses extending another's fields should 
+    repeat them, e.g. fields = MsgBase.fields + (("extra",int),). Subclasses 
+    may instead implement "to_dict" and "from_dict" themselves - a subclass 
+    overriding only "to_dict" has its data read back by the generic 
+    "from_dict", which sets an attribute for each item. Subclasses may define
+    "__slots__" naming their fields, saving memory per message. 
+    Subclasses which set "reliable" to False, such as frequent position 
+    updates, may be sent over a UdpChannel where one has been established, in
+    which case they may be lost, and are discarded if they arrive after a newer
+    message of the same type. "priority" decides which messages waiting to be 
+    written to a connection go first, of those which needn't keep their order,
+    and may be overidden for a single message with "set_priority".
     """
 
+    __slots__ = ("recipients","excludes","sender","send_priority")
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    reliable = True
+    priority = PRIORITY_NORMAL
+    fields = None
+    # whether the data may be encoded as a list of field values - set when the
+    # class is created
+    encodes_values = False
+
+    @classmethod
+    def _class_init(cls):
+        # called by metaclass when class created
+        if "fields" in cls.__dict__ and cls.fields is not None:
+            cls._compile_fields()
+        generated = [getattr(getattr(cls, n, None), "generated_for", None)
+            for n in ("to_dict","from_dict","to_values","from_values")]
+        if generated[0] is None and generated[1] is not None:
+            # data from an implemented "to_dict" can't be read by the generated
+            # "from_dict"
+            cls.from_dict = Message.__dict__["from_dict"]
+            generated[1] = None
+        if generated[0] is None:
+            # nor are a base class's field values those of the subclass
+            for i,n in ((2,"to_values"),(3,"from_values")):
+                if generated[i] is not None and generated[i] is not cls:
+                    setattr(cls, n, Message.__dict__[n])
+                    generated[i] = None
+        cls.encodes_values = generated[0] is not None and all(
+            [g is generated[0] for g in generated])
+
+    @classmethod
+    def _compile_fields(cls):
+        """    
+        Generates "to_dict", "from_dict", "to_values" and "from_values" for the
+        class's fields, unless the class implements them itself
+        """
+        names = []
+        for field in cls.fields:
+            if len(field) != 2 or not isinstance(field[1], type):
+                raise MessageError("Field of %s should be a (name, type) pair: %r" 
+                    % (cls.__name__, field))
+            name = field[0]
+            if (not isinstance(name, str) or not _IDENTIFIER.match(name) 
+                    or keyword.iskeyword(name) or name in names):
+                raise MessageError("Invalid field name for %s: %r" % (cls.__name__, name))
+            names.append(name)
+
+        functions = {}
+        d = FunctionDefiner()
+        with d.def_("to_dict", ["self"], {}, {}, functions) as f:
+            f.return_(dict([(n,_Code("self.%s" % n)) for n in names]))
+        d = FunctionDefiner()
+        with d.def_("from_dict", ["self","data"], {}, {}, functions) as f:
+            for n in names:
+                # fields missing from the data keep their default values
+                with f.if_(_Code("%r in data" % n)):
+                    setattr(f.self, n, f.data[n])
+            if not names:
+                f.pass_
+        d = FunctionDefiner()
+        with d.def_("to_values", ["self"], {}, {}, functions) as f:
+            f.return_([_Code("self.%s" % n) for n in names])
+        d = FunctionDefiner()
+        with d.def_("from_values", ["self","values"], {}, {}, functions) as f:
+            for i,n in enumerate(names):
+                setattr(f.self, n, f.values[i])
+            if not names:
+                f.pass_
+
+        for name in functions:
+            if name not in cls.__dict__:
+                functions[name].generated_for = cls
+                setattr(cls, name, functions[name])
+
+    def __getstate__(self):
+        """    
+        Returns the message's attributes, whether slots or not, for pickling
+        """
+        state = dict(getattr(self, "__dict__", {}))
+        for klass in self.__class__.__mro__:
+            for name in klass.__dict__.get("__slots__", ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for k in state:
+            setattr(self, k, state[k])
+
     def __init__(self, recipients, excludes, sender=Server.SERVER):
         """    
         Initializes the message with the given recipient list and 
@@ -809,24 +2661,61 @@ class Message(Event):
         self.recipients = recipients
         self.excludes = excludes
         self.sender = sender
+        self.send_priority = None
 
     def get_recipients(self):
         """    
         Returns the list of recipients, which may consist of a mixture of client
-        id numbers and strings naming node groups.
+        id numbers, strings naming node groups and areas made by Server.area.
         """
         return self.recipients
     
     def get_excludes(self):
         """    
         Returns the list of excludes - clients which should be excluded from the 
-        recipient list - which may consist of a mixture of client id numbers and 
-        strings naming node groups.
+        recipient list - which may consist of a mixture of client id numbers, 
+        strings naming node groups and areas made by Server.area.
         """
         return self.excludes
 
     def get_sender(self):
         return self.sender
+
+    def get_coalesce_key(self):
+        """    
+        Returns a key shared by messages which supersede one another, so that 
+        only the latest need be sent to a backlogged client, or None if the 
+        message must always be sent. By default unreliable messages supersede 
+        earlier ones of the same type from the same sender.
+        """
+        if self.reliable:
+            return None
+        return (self.__class__, self.sender)
+
+    def set_priority(self, priority):
+        """    
+        Sets the priority for sending this message, in place of its class's
+        "priority". Not sent with the message.
+        """
+        self.send_priority = priority
+
+    def get_priority(self):
+        """    
+        Returns the priority of the message in outgoing queues: PRIORITY_HIGH,
+        PRIORITY_NORMAL or PRIORITY_LOW
+        """
+        if self.send_priority is not None:
+            return self.send_priority
+        return self.priority
+
+    def keeps_order(self):
+        """    
+        Returns whether the message must arrive in the order sent, relative to
+        other such messages - true of reliable messages, except for those which
+        are superseded by newer ones, such as pings. Only other messages may be
+        reordered by priority, and resumable sessions count only these.
+        """
+        return self.reliable and not isinstance(self, _STALE_MESSAGES)
         
     def _get_attrs(self, names):
         """    
@@ -839,20 +2728,38 @@ class Message(Event):
 
     def to_dict(self):
         """    
-        Should be implemented to convert the message data to a dictionary for subsequent
-        serialisation for transport. Need not include the message type, recipients or sender.
+        Converts the message data to a dictionary for subsequent serialisation 
+        for transport. Need not include the message type, recipients or sender.
+        Generated from "fields", or else should be implemented.
         """
         return self._get_attrs(())
     
 
     def from_dict(self, dict):
         """    
-        Should be implemented to populate the message instance with the data from the 
-        given dictionary.
+        Populates the message instance with the data from the given dictionary.
+        Generated from "fields".
         """
         for k in dict:
             setattr(self, k, dict[k])
 
+    def to_values(self):
+        """    
+        Returns the values of the message's fields as a list, in the order the
+        fields are declared. Generated from "fields", or else the values from 
+        "to_dict" in order of their keys.
+        """
+        data = self.to_dict()
+        return [data[k] for k in sorted(data)]
+
+    def from_values(self, values):
+        """    
+        Populates the message instance from a list of its field values. 
+        Generated from "fields", or else the values are matched to the keys 
+        from "to_dict" in order.
+        """
+        self.from_dict(dict(zip(sorted(self.to_dict()), values)))
+
 
 class MessageError(Exception):
     pass
@@ -874,7 +2781,10 @@ class JsonEncoder(object):
             "sender" : message.get_sender(),
             "data" : data
         }
-        return json.dumps(self._encode_val(dict))
+        data = json.dumps(self._encode_val(dict))
+        if not isinstance(data, bytes):
+            data = data.encode("ascii")
+        return data
 
     def decode(self, data):
         dict = self._decode_val(json.loads(data))
@@ -883,7 +2793,7 @@ class JsonEncoder(object):
         classname = typename.split(".")[-1]
         modname = ".".join(typename.split(".")[:-1])
 
-        if not sys.modules.has_key(modname):
+        if not modname in sys.modules:
             raise MessageError("Module for message type %s not loaded" % typename)
         mod = sys.modules[modname]
         if not hasattr(mod, classname):
@@ -892,10 +2802,16 @@ class JsonEncoder(object):
         if not issubclass(cls,Message):
             raise MessageError("Message type %s is not a Message" % typename)
 
-        message = cls(dict["recipients"], dict["excludes"], dict["sender"])
+        message = cls.acquire(dict["recipients"], dict["excludes"], dict["sender"])
         message.from_dict(dict["data"])
         return message
 
+    def decode_buffer(self, buf, start, end):
+        """    
+        Decodes the message occupying the given region of bytearray "buf". 
+        """
+        return self.decode(memoryview(buf)[start:end].tobytes())
+
     def _encode_val(self, val):
         """    
         Use special encoding of dictionary keys because json format only allows string
@@ -934,18 +2850,217 @@ class JsonEncoder(object):
                 return t.__name__[0]+unicode(val)
                 
 
+def _write_varint(out, n):
+    """    
+    Appends the given non-negative integer to bytearray "out" in base 128, 
+    least significant group first, with the top bit of each byte set if more
+    bytes follow.
+    """
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(buf, pos):
+    """    
+    Reads an integer written by _write_varint from bytearray "buf" at the given
+    position. Returns the integer and the position following it.
+    """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n,pos
+        shift += 7
+
+
+class BinaryEncoder(object):
+    """    
+    Encodes Message objects in a compact binary format. Rather than naming the
+    message's class, the encoded message begins with a small integer id, so each 
+    message class must first be registered with an id using "register". The 
+    messages in this module are registered with ids below 100. The data of 
+    messages declaring "fields" is written as a list of values, without the 
+    field names. Message data may
+    consist of None, bools, ints, floats, strings, bytes, lists, tuples and 
+    dictionaries. Tuples are decoded as lists.
+    """
+
+    registry = {}
+    type_ids = {}
+
+    TAG_NONE = 0
+    TAG_TRUE = 1
+    TAG_FALSE = 2
+    TAG_INT = 3
+    TAG_FLOAT = 4
+    TAG_STR = 5
+    TAG_BYTES = 6
+    TAG_LIST = 7
+    TAG_DICT = 8
+
+    FLOAT_FORMAT = struct.Struct(">d")
+
+    @classmethod
+    def register(cls, type_id, message_class):
+        """    
+        Registers the given Message subclass with the given integer id. Both
+        ends of a connection must use the same ids.
+        """
+        if type_id in cls.registry and cls.registry[type_id] is not message_class:
+            raise MessageError("Message type id %d already used by %s" 
+                % (type_id, cls.registry[type_id].__name__))
+        cls.registry[type_id] = message_class
+        cls.type_ids[message_class] = type_id
+
+    def encode(self, message):
+        type_id = BinaryEncoder.type_ids.get(message.__class__)
+        if type_id is None:
+            raise MessageError("Message type %s not registered" % message.__class__.__name__)
+        out = bytearray()
+        _write_varint(out, type_id)
+        self._encode_val(out, message.get_recipients())
+        self._encode_val(out, message.get_excludes())
+        self._encode_val(out, message.get_sender())
+        if message.encodes_values:
+            # the decoder knows the fields' names from the class
+            self._encode_val(out, message.to_values())
+        else:
+            self._encode_val(out, message.to_dict())
+        return bytes(out)
+
+    def decode(self, data):
+        buf = data if isinstance(data, bytearray) else bytearray(data)
+        return self.decode_buffer(buf, 0, len(buf))
+
+    def decode_buffer(self, buf, start, end):
+        """    
+        Decodes the message occupying the given region of bytearray "buf", 
+        without copying it out first.
+        """
+        type_id,pos = _read_varint(buf, start)
+        cls = BinaryEncoder.registry.get(type_id)
+        if cls is None:
+            raise MessageError("Message type id %d not registered" % type_id)
+        recipients,pos = self._decode_val(buf, pos)
+        excludes,pos = self._decode_val(buf, pos)
+        sender,pos = self._decode_val(buf, pos)
+        data,pos = self._decode_val(buf, pos)
+        message = cls.acquire(recipients, excludes, sender)
+        if type(data) is list:
+            message.from_values(data)
+        else:
+            message.from_dict(data)
+        return message
+
+    def _encode_val(self, out, val):
+        # checks are ordered by how common the types are in message data
+        t = type(val)
+        if t is int or t is long:
+            out.append(BinaryEncoder.TAG_INT)
+            # zigzag encoding keeps small negative numbers small
+            n = val*2 if val >= 0 else -val*2-1
+            while n >= 0x80:
+                out.append((n & 0x7f) | 0x80)
+                n >>= 7
+            out.append(n)
+        elif t is unicode:
+            b = val.encode("utf-8")
+            out.append(BinaryEncoder.TAG_STR)
+            _write_varint(out, len(b))
+            out.extend(b)
+        elif t is bytes:
+            out.append(BinaryEncoder.TAG_BYTES)
+            _write_varint(out, len(val))
+            out.extend(val)
+        elif t is dict:
+            out.append(BinaryEncoder.TAG_DICT)
+            _write_varint(out, len(val))
+            for k in val:
+                self._encode_val(out, k)
+                self._encode_val(out, val[k])
+        elif t is list or t is tuple:
+            out.append(BinaryEncoder.TAG_LIST)
+            _write_varint(out, len(val))
+            for v in val:
+                self._encode_val(out, v)
+        elif t is float:
+            out.append(BinaryEncoder.TAG_FLOAT)
+            out.extend(BinaryEncoder.FLOAT_FORMAT.pack(val))
+        elif val is None:
+            out.append(BinaryEncoder.TAG_NONE)
+        elif t is bool:
+            out.append(BinaryEncoder.TAG_TRUE if val else BinaryEncoder.TAG_FALSE)
+        else:
+            # check for subclasses of the supported types
+            for base in (bool,int,long,float,unicode,bytes,list,tuple,dict):
+                if isinstance(val, base):
+                    self._encode_val(out, base(val))
+                    break
+            else:
+                raise MessageError("Cannot encode value of type %s" % t.__name__)
+
+    def _decode_val(self, buf, pos):
+        tag = buf[pos]
+        pos += 1
+        if tag == BinaryEncoder.TAG_INT:
+            n = 0
+            shift = 0
+            while True:
+                b = buf[pos]
+                pos += 1
+                n |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            return (n >> 1 if not n & 1 else -(n >> 1)-1),pos
+        elif tag == BinaryEncoder.TAG_STR:
+            n,pos = _read_varint(buf, pos)
+            return buf[pos:pos+n].decode("utf-8"),pos+n
+        elif tag == BinaryEncoder.TAG_DICT:
+            n,pos = _read_varint(buf, pos)
+            d = {}
+            for i in range(n):
+                k,pos = self._decode_val(buf, pos)
+                d[k],pos = self._decode_val(buf, pos)
+            return d,pos
+        elif tag == BinaryEncoder.TAG_LIST:
+            n,pos = _read_varint(buf, pos)
+            l = []
+            for i in range(n):
+                v,pos = self._decode_val(buf, pos)
+                l.append(v)
+            return l,pos
+        elif tag == BinaryEncoder.TAG_FLOAT:
+            return BinaryEncoder.FLOAT_FORMAT.unpack_from(buf, pos)[0],pos+8
+        elif tag == BinaryEncoder.TAG_BYTES:
+            n,pos = _read_varint(buf, pos)
+            return bytes(buf[pos:pos+n]),pos+n
+        elif tag == BinaryEncoder.TAG_NONE:
+            return None,pos
+        elif tag == BinaryEncoder.TAG_TRUE:
+            return True,pos
+        elif tag == BinaryEncoder.TAG_FALSE:
+            return False,pos
+        else:
+            raise MessageError("Unknown value tag %d" % tag)
+
+
 class MsgPlayerConnect(Message):
     """    
     Sent by server to inform clients of a new player's arrival
     """
 
+    fields = (("player_id",int),("player_info",dict))
+
     def __init__(self, recipients, excludes, sender=-1, player_id=-1, player_info={}):
         Message.__init__(self, recipients, excludes, sender)
         self.player_id = player_id
         self.player_info = player_info
-
-    def to_dict(self):
-        return self._get_attrs(("player_id","player_info"))
         
 
 class MsgPlayerDisconnect(Message):
@@ -953,13 +3068,12 @@ class MsgPlayerDisconnect(Message):
     Sent by server to inform clients of a players' departure
     """
 
+    fields = (("player_id",int),("reason",unicode))
+
     def __init__(self, recipients, excludes, sender=-1, player_id=-1, reason=""):
         Message.__init__(self, recipients, excludes, sender)
         self.player_id = player_id
         self.reason = reason
-
-    def to_dict(self):
-        return self._get_attrs(("player_id","reason"))
         
 
 class MsgServerShutdown(Message):
@@ -967,12 +3081,11 @@ class MsgServerShutdown(Message):
     Sent by server to inform clients that the server is about to stop
     """
 
+    fields = ()
+
     def __init__(self, recipients, excludes, sender=-1):
         Message.__init__(self, recipients, excludes, sender)
 
-    def to_dict(self):
-        return self._get_attrs(())
-
 
 class MsgRequestConnect(Message):
     """    
@@ -980,29 +3093,38 @@ class MsgRequestConnect(Message):
     about the player. Server should respond with either MsgAcceptConnect
     or MsgRejectConnect. 
     """
-    
-    def __init__(self, recipients, excludes, sender=-1, player_info=None):
+
+    fields = (("player_info",dict),("udp",bool))
+
+    def __init__(self, recipients, excludes, sender=-1, player_info=None, udp=False):
         Message.__init__(self, recipients, excludes, sender)
         self.player_info = player_info
-
-    def to_dict(self):
-        return self._get_attrs(("player_info",))
+        self.udp = udp
 
 
 class MsgAcceptConnect(Message):
     """    
     Sent from server to client to confirm their acceptence into the game,
     provide their client id and provide the player with information about
-    the other players connected.
+    the other players connected. If the client asked for a UDP channel and the
+    server has one, gives the port and the token to identify the client's 
+    datagrams. If the server allows sessions to be resumed, gives the token 
+    identifying the player's session and the number of seconds for which it 
+    may be resumed after the connection drops.
     """
 
-    def __init__(self, recipients, excludes, sender=-1, player_id=-1, players_info=None):
+    fields = (("player_id",int),("players_info",dict),("udp_port",int),
+        ("udp_token",int),("session_token",int),("resume_window",float))
+
+    def __init__(self, recipients, excludes, sender=-1, player_id=-1, players_info=None,
+            udp_port=0, udp_token=0, session_token=0, resume_window=0):
         Message.__init__(self, recipients, excludes, sender)
         self.player_id = player_id
         self.players_info = players_info
-
-    def to_dict(self):
-        return self._get_attrs(("player_id","players_info"))
+        self.udp_port = udp_port
+        self.udp_token = udp_token
+        self.session_token = session_token
+        self.resume_window = resume_window
 
 
 class MsgRejectConnect(Message):
@@ -1011,39 +3133,54 @@ class MsgRejectConnect(Message):
     unsuccessful.
     """
 
+    fields = (("reason",unicode),)
+
     def __init__(self, recipients, excludes, sender=-1, reason=""):
         Message.__init__(self, recipients, excludes, sender)
         self.reason = reason
 
-    def to_dict(self):
-        return self._get_attrs(("reason",))
-
 
 class MsgPing(Message):
     """    
     Sent between client and server for calculaating network latency    
     """
 
+    priority = Message.PRIORITY_HIGH
+
+    fields = (("ping_timestamp",int),)
+
     def __init__(self, recipients, excludes, sender=-1, ping_timestamp=0):
         Message.__init__(self, recipients, excludes, sender)
         self.ping_timestamp = ping_timestamp
 
-    def to_dict(self):
-        return self._get_attrs(("ping_timestamp",))
-
 
 class MsgPong(Message):
     """    
     Sent in response to MsgPing
     """
-    
+
+    priority = Message.PRIORITY_HIGH
+
+    fields = (("ping_timestamp",int),("pong_timestamp",int))
+
     def __init__(self, recipients, excludes, sender=-1, ping_timestamp=0, pong_timestamp=0):
         Message.__init__(self, recipients, excludes, sender)
         self.ping_timestamp = ping_timestamp
         self.pong_timestamp = pong_timestamp
-        
-    def to_dict(self):
-        return self._get_attrs(("ping_timestamp","pong_timestamp"))
+
+
+class MsgTransportOptions(Message):
+    """    
+    Sent by client on connecting to request transport options, as a dictionary
+    of option names to lists of acceptable values. The reply from the client's
+    handler contains the values chosen.
+    """
+
+    fields = (("options",dict),)
+
+    def __init__(self, recipients, excludes, sender=-1, options=None):
+        Message.__init__(self, recipients, excludes, sender)
+        self.options = options if options is not None else {}
 
 
 class MsgChat(Message):
@@ -1051,12 +3188,51 @@ class MsgChat(Message):
     Sent between clients to allow players to communicate with each other    
     """
 
+    fields = (("message",unicode),)
+
     def __init__(self, recipients, excludes, sender=-1, message=""):
         Message.__init__(self, recipients, excludes, sender)
         self.message = message
 
-    def to_dict(self):
-        return self._get_attrs(("message",))
+
+for i,cls in enumerate((MsgPlayerConnect, MsgPlayerDisconnect, MsgServerShutdown,
+        MsgRequestConnect, MsgAcceptConnect, MsgRejectConnect, MsgPing, MsgPong, 
+        MsgChat, MsgTransportOptions)):
+    BinaryEncoder.register(i+1, cls)
+
+
+class MsgResumeSession(Message):
+    """    
+    Sent from client to server in place of MsgRequestConnect, after the client
+    has reconnected, to resume its session. Gives the session token and the
+    number of messages received in the session, so that the server can replay
+    those which were missed.
+    """
+
+    fields = (("session_token",int),("received_count",int))
+
+    def __init__(self, recipients, excludes, sender=-1, session_token=0, received_count=0):
+        Message.__init__(self, recipients, excludes, sender)
+        self.session_token = session_token
+        self.received_count = received_count
+
+
+class MsgSessionResumed(Message):
+    """    
+    Sent from server to client to confirm that its session has resumed, before
+    replaying the messages the client missed. The server replies with 
+    MsgRejectConnect if the session cannot be resumed.
+    """
+
+    fields = (("player_id",int),)
+
+    def __init__(self, recipients, excludes, sender=-1, player_id=-1):
+        Message.__init__(self, recipients, excludes, sender)
+        self.player_id = player_id
+
+
+BinaryEncoder.register(13, MsgResumeSession)
+BinaryEncoder.register(14, MsgSessionResumed)
 
 
 class GameFullError(Exception): pass
@@ -1087,6 +3263,80 @@ class EvtPlayerAccepted(Event):
     def __init__(self, client_id):
         Event.__init__(self)
         self.client_id = client_id
+
+
+class EvtPlayerSuspended(Event):
+    """    
+    Added to server's event queue when a player's connection drops and their
+    session is kept for them to resume
+    """
+
+    def __init__(self, client_id):
+        Event.__init__(self)
+        self.client_id = client_id
+
+
+class EvtPlayerResumed(Event):
+    """    
+    Added to the event queues of server and client when a player's session is
+    resumed over a new connection
+    """
+
+    def __init__(self, client_id):
+        Event.__init__(self)
+        self.client_id = client_id
+
+
+# messages which are no use once delayed, and so aren't replayed or held back
+# while a session is resumed
+_STALE_MESSAGES = (MsgPing, MsgPong)
+
+
+class GameSession(object):
+    """    
+    A player's session on a GameServer, which may outlive their connection. 
+    The messages sent to the player in the session which keep their order
+    (see Message.keeps_order) are numbered and kept, up to "buffer_size" of 
+    them, so that those the client missed may be replayed when it resumes the
+    session over a new connection. "handler" is the client handler currently
+    connected, if any, and "suspended" is True while the session awaits 
+    resumption.
+    """
+
+    def __init__(self, token, client_id, buffer_size):
+        self.token = token
+        self.client_id = client_id
+        self.buffer_size = buffer_size
+        # held while sending to the player, so that messages are numbered in 
+        # the order they are written
+        self.lock = threading.RLock()
+        self.handler = None
+        self.suspended = False
+        self.expiry_timer = None
+        self.sent_count = 0
+        self.buffer = collections.deque()
+        # number of the earliest message which can still be replayed
+        self.first_kept = 1
+
+    def record(self, message):
+        # others may be dropped in transit or overtake queued messages, so 
+        # aren't numbered
+        if not message.keeps_order():
+            return
+        self.sent_count += 1
+        self.buffer.append((self.sent_count, message))
+        if len(self.buffer) > self.buffer_size:
+            self.first_kept = self.buffer.popleft()[0] + 1
+
+    def can_replay(self, received_count):
+        """    
+        Returns whether all of the messages after the given number of messages
+        received by the client are available for replay
+        """
+        return self.first_kept <= received_count + 1 <= self.sent_count + 1
+
+    def get_missed(self, received_count):
+        return [m for n,m in self.buffer if n > received_count]
     
 
 class GameNode(Node):
@@ -1142,10 +3392,18 @@ class GameClientHandler(ClientHandler, StateMachineBase):
                 # record player info
                 self.machine.player_info = info
 
+                # set up udp channel if requested
+                udp_port,udp_token = 0,0
+                if message.udp:
+                    registered = self.machine.server.register_udp_client(self.machine.id)
+                    if registered is not None:
+                        udp_port,udp_token = registered
+
                 # reply with client id and info about connected players
                 other_players = self.machine.server.get_info_on_players()
-                self.machine.server.send(MsgAcceptConnect([self.machine.id],[], 
-                    Server.SERVER, self.machine.id, other_players))
+                self.machine.server.send_accept(self.machine, MsgAcceptConnect(
+                    [self.machine.id],[], Server.SERVER, self.machine.id, other_players, 
+                    udp_port, udp_token))
                 
                 # change state
                 self.machine.change_state("StateInGame")
@@ -1170,8 +3428,57 @@ class GameClientHandler(ClientHandler, StateMachineBase):
         ClientHandler.__init__(self, server, socket, id, encoder)
         StateMachineBase.__init__(self)
         self.player_info = {}
+        # udp channel details, once established
+        self.udp_token = None
+        self.udp_address = None
+        self.udp_seq = 0
+        self.udp_last_seqs = {}
+        # the player's resumable session, if any. Guarded by socket_lock
+        self.session = None
         self.change_state("StateConnecting")
 
+    def send(self, message, cache=None):
+        """    
+        Overidden from SocketListener. Unreliable messages are sent over the 
+        server's udp channel if the client has one. Messages sent in a 
+        resumable session are recorded by the session, and written to whichever
+        handler is connected to the player. Those the session counts are never
+        dropped by the outgoing limit, as the client's count of them must match.
+        """
+        if not message.reliable and self.udp_address is not None:
+            if self.server.send_datagram(self, message, cache):
+                return
+        with self.get_socket_lock():
+            session = self.session
+            if session is None:
+                SocketListener.send(self, message, cache)
+                return
+        if message.pool_size:
+            # the session keeps the message, which the server may release
+            message = copy.copy(message)
+        with session.lock:
+            session.record(message)
+            if session.handler is not None:
+                SocketListener.send(session.handler, message, cache, not message.keeps_order())
+
+    def intercept_MsgResumeSession(self, message):
+        """    
+        The client has reconnected and asks to resume its session, rather than
+        joining the game afresh
+        """
+        if self.get_state() == "StateConnecting":
+            self.server.resume_session(self, message.session_token, message.received_count)
+
+    def intercept_MsgPlayerDisconnect(self, message):
+        """    
+        The client is leaving the game. Its session is ended straight away, so 
+        that it isn't suspended when the connection closes. The message is 
+        passed on as usual.
+        """
+        if message.player_id == self.id:
+            self.server.end_session(self.id)
+        self.server.send(message)
+
     @statemethod
     def handle_MsgRequestConnect(self, message):
         pass
@@ -1186,18 +3493,42 @@ class GameServer(GameNode, Server):
     """
     
     GROUP_PLAYERS = "players"
+    REPLAY_BUFFER_SIZE = 256
+    REASON_SESSION_BUSY = "The session is still connected"
+    REASON_SESSION_EXPIRED = "The session has expired"
     
     def __init__(self, max_players=4, 
             client_factory=lambda server,socket,client_id: GameClientHandler(server,socket,client_id,JsonEncoder()), 
-            port=57810):
+            port=57810, udp=False):
         """    
         Initialises the server with default handler GameClientHandler and using
-        port 57810
+        port 57810. If "udp" is True, clients which ask for it are given a UDP 
+        channel, on the same port number, for their unreliable messages.
         """
         GameNode.__init__(self)
         Server.__init__(self, client_factory, port)
         self.max_players = max_players
         self.closed = False
+        self.udp = udp
+        self.resume_window = 0
+        self.replay_buffer_size = GameServer.REPLAY_BUFFER_SIZE
+        lockable_attrs(self,
+            udp_channel = None,
+            udp_tokens = {},
+            sessions = {}
+        )
+
+    def set_resume_window(self, window, buffer_size=None):
+        """    
+        Allows players who lose their connection to resume their session, 
+        rather than leaving the game, by reconnecting within "window" seconds.
+        Up to "buffer_size" of the reliable messages sent to each player are 
+        kept so that those the client missed can be replayed when it resumes. 
+        A window of 0, the default, disables resuming.
+        """
+        self.resume_window = window
+        if buffer_size is not None:
+            self.replay_buffer_size = buffer_size
 
     def send(self, message):
         """    
@@ -1225,11 +3556,10 @@ class GameServer(GameNode, Server):
         id = event.get_sender()
         ch = None
         with self.handlers_lock:
-            if self.handlers.has_key(id):
+            if id in self.handlers:
                 ch = self.handlers[id]
         if ch != None:
-            if hasattr(ch, handler_name):
-                getattr(ch, handler_name)(event)
+            if dispatch_event(ch, event, "handle_"):
                 return True
         else:
             # if we can't find the client handler, this shouldn't count as 
@@ -1251,30 +3581,301 @@ class GameServer(GameNode, Server):
         
     def handle_EvtPlayerRejected(self, event):
         pass
+
+    def handle_EvtPlayerSuspended(self, event):
+        pass
+
+    def handle_EvtPlayerResumed(self, event):
+        pass
         
     def disconnect_client(self, client_id):
         """    
         May be invoked to "kick" a player from the server
         """
+        if self.end_session(client_id):
+            # the player was already disconnected
+            return
         handler = None
         with self.handlers_lock:
-            if self.handlers.has_key(client_id):
+            if client_id in self.handlers:
                 handler = self.handlers[client_id]
         if handler != None:
             # stop the handler. client_departed will later be invoked
             # to clean up handler.
             self.handlers[client_id].stop()
+
+    def send_accept(self, handler, message):
+        """    
+        Sends the given MsgAcceptConnect to the handler's client. If resuming 
+        is enabled, a session is started for the player and its token given to
+        the client, and the accept message is the first message of the session.
+        """
+        if not self.resume_window:
+            self.send(message)
+            return
+        token = random.SystemRandom().getrandbits(63)
+        message.session_token = token
+        message.resume_window = self.resume_window
+        session = GameSession(token, handler.id, self.replay_buffer_size)
+        session.handler = handler
+        with self.sessions_lock:
+            self.sessions[token] = session
+        # no other message may be numbered ahead of the accept
+        with session.lock:
+            with handler.get_socket_lock():
+                handler.session = session
+            try:
+                handler.send(message)
+            except socket.error as e:
+                self.handle_network_error((handler.id,e))
+
+    def get_session(self, client_id):
+        with self.handlers_lock:
+            handler = self.handlers.get(client_id)
+        if handler is None:
+            return None
+        with handler.get_socket_lock():
+            return handler.session
+
+    def suspend_session(self, client_id):
+        """    
+        Invoked when a player's connection is lost. If they have a session, it
+        is kept for them to resume for the length of the resume window, and 
+        True is returned. The player remains in the game meanwhile, and the 
+        messages sent to them are kept for replay.
+        """
+        with self.stopping_lock:
+            if self.stopping:
+                return False
+        session = self.get_session(client_id)
+        if session is None:
+            return False
+        with session.lock:
+            if session.suspended:
+                return True
+            session.handler = None
+            session.suspended = True
+            session.expiry_timer = threading.Timer(self.resume_window, 
+                self.expire_session, (session,))
+            session.expiry_timer.daemon = True
+            session.expiry_timer.start()
+        with self.handlers_lock:
+            handler = self.handlers.get(client_id)
+        if handler is not None:
+            # the client's udp address will change too
+            handler.udp_address = None
+        self.event_queue.put(EvtPlayerSuspended(client_id))
+        return True
+
+    def resume_session(self, handler, token, received_count):
+        """    
+        Invoked when a newly connected client asks to resume the session with 
+        the given token, having received "received_count" of its messages. The 
+        new handler takes over the player's id, and the messages the client 
+        missed are replayed to it.
+        """
+        new_id = handler.id
+        with self.sessions_lock:
+            session = self.sessions.get(token)
+        reason = None
+        if session is None:
+            reason = GameServer.REASON_SESSION_EXPIRED
+        else:
+            with session.lock:
+                if not session.suspended:
+                    reason = GameServer.REASON_SESSION_BUSY
+                else:
+                    session.expiry_timer.cancel()
+                    if not session.can_replay(received_count):
+                        reason = GameServer.REASON_SESSION_EXPIRED
+                    else:
+                        session.suspended = False
+        if reason is not None:
+            if reason == GameServer.REASON_SESSION_EXPIRED and session is not None:
+                # the client can't catch up, so the player must leave
+                self.close_session(session, True)
+            self.send(MsgRejectConnect([new_id],[],Server.SERVER,reason))
+            return
+
+        player_id = session.client_id
+        with handler.get_socket_lock():
+            handler.session = session
+        # the new handler takes the place of the old
+        with self.handlers_lock:
+            old = self.handlers[player_id]
+            self.handlers[player_id] = handler
+            del(self.handlers[new_id])
+            with self.node_groups_lock:
+                self.node_groups.remove_item(new_id)
+                self.interest_grid.remove_item(new_id)
+            handler.id = player_id
+            handler.player_info = old.player_info
+            handler.udp_token = old.udp_token
+            handler.change_state("StateInGame")
+        with old.get_socket_lock():
+            old.session = None
+
+        with session.lock:
+            session.handler = handler
+            try:
+                SocketListener.send(handler, MsgSessionResumed([player_id],[],
+                    Server.SERVER,player_id))
+                for message in session.get_missed(received_count):
+                    SocketListener.send(handler, message, None, not message.keeps_order())
+            except socket.error as e:
+                self.handle_network_error((player_id,e))
+        self.event_queue.put(EvtClientDeparted(new_id))
+        self.event_queue.put(EvtPlayerResumed(player_id))
+
+    def expire_session(self, session):
+        """    
+        Invoked when a suspended session's resume window has passed without the
+        client returning. The player leaves the game.
+        """
+        with session.lock:
+            if not session.suspended:
+                return
+        self.close_session(session, True)
+
+    def end_session(self, client_id):
+        """    
+        Ends the given player's session, if any, as the player is leaving. 
+        Returns True if the session was suspended, in which case the player is 
+        removed from the game straight away.
+        """
+        session = self.get_session(client_id)
+        if session is None:
+            return False
+        with session.lock:
+            suspended = session.suspended
+            if session.expiry_timer is not None:
+                session.expiry_timer.cancel()
+        self.close_session(session, suspended)
+        return suspended
+
+    def close_session(self, session, depart):
+        """    
+        Discards the session. If "depart" is True, its player is removed from 
+        the game as when their handler stops.
+        """
+        with self.sessions_lock:
+            if self.sessions.pop(session.token, None) is None:
+                return
+        with session.lock:
+            session.suspended = False
+            handler = session.handler
+        if handler is None:
+            with self.handlers_lock:
+                handler = self.handlers.get(session.client_id)
+        if handler is not None:
+            with handler.get_socket_lock():
+                handler.session = None
+        if depart:
+            self.client_departed(session.client_id)
         
+    def get_udp_channel(self):
+        """    
+        Returns the server's udp channel, opening it on first use, or None if the
+        server doesn't use udp or the channel couldn't be opened.
+        """
+        with self.udp_channel_lock:
+            if self.udp and self.udp_channel is None:
+                channel = UdpChannel(self, (socket.gethostname(),self.port), Server.SERVER)
+                try:
+                    channel.start()
+                    self.udp_channel = channel
+                except socket.error as e:
+                    # carry on without udp
+                    self.handle_network_error((Server.SERVER,e))
+                    self.udp = False
+            return self.udp_channel
+
+    def register_udp_client(self, client_id):
+        """    
+        Allocates a token for the given client to identify its datagrams with, 
+        returning the udp port and the token, or None if udp isn't available.
+        """
+        channel = self.get_udp_channel()
+        if channel is None:
+            return None
+        token = random.SystemRandom().getrandbits(63)
+        with self.handlers_lock:
+            if client_id not in self.handlers:
+                return None
+            self.handlers[client_id].udp_token = token
+        with self.udp_tokens_lock:
+            self.udp_tokens[token] = client_id
+        return channel.get_port(),token
+
+    def datagram_received(self, kind, token, seq, payload, address):
+        """    
+        Invoked by the udp channel when a datagram arrives. The client's first
+        datagram says hello, telling the server its udp address.
+        """
+        with self.udp_tokens_lock:
+            client_id = self.udp_tokens.get(token)
+        with self.handlers_lock:
+            handler = self.handlers.get(client_id)
+        if handler is None:
+            return
+        if kind == UdpChannel.KIND_HELLO:
+            handler.udp_address = address
+            self.udp_channel.send_datagram(UdpChannel.KIND_HELLO_ACK, token, 0, b"", address)
+        elif kind == UdpChannel.KIND_MESSAGE and address == handler.udp_address:
+            start = time.time()
+            message = handler.decoder.decode(payload)
+            handler.stats.read(len(payload))
+            handler.stats.received(message.__class__, time.time()-start)
+            # drop messages older than one already received
+            key = message.__class__
+            if key in handler.udp_last_seqs and not seq_newer(seq, handler.udp_last_seqs[key]):
+                return
+            handler.udp_last_seqs[key] = seq
+            handler.received(message)
+
+    def send_datagram(self, handler, message, cache=None):
+        """    
+        Sends the message to the given handler's client over the udp channel. 
+        Returns False if the message is too large to be sent this way.
+        """
+        channel = self.udp_channel
+        if channel is None:
+            return False
+        start = time.time()
+        if cache is None:
+            data = handler.encoder.encode(message)
+        else:
+            key = handler.encoder.__class__
+            if key not in cache:
+                cache[key] = handler.encoder.encode(message)
+            data = cache[key]
+        if len(data) > UdpChannel.MAX_PAYLOAD_SIZE:
+            return False
+        with handler.get_socket_lock():
+            handler.udp_seq = (handler.udp_seq + 1) & 0xffffffff
+            seq = handler.udp_seq
+        handler.stats.sent(message.__class__, time.time()-start)
+        channel.send_datagram(UdpChannel.KIND_MESSAGE, handler.udp_token, seq, data, handler.udp_address)
+        handler.stats.wrote(len(data))
+        return True
+
     def client_departed(self, client_id):
         """    
         Overidden from Server. Invoked by client handler when a handler shuts 
         down. Removes the client from groups and removes the handler then, if the
         client was a player in the game, informs other players of their departure.
+        If the player has a session they are suspended instead, and remain in the
+        game until the session expires.
         """
+        if self.suspend_session(client_id):
+            return
+        with self.udp_tokens_lock:
+            for token in [t for t in self.udp_tokens if self.udp_tokens[t] == client_id]:
+                del(self.udp_tokens[token])
         # Client exists and had entered the game?
         send_msg = False
         with self.handlers_lock:
-            if self.handlers.has_key(client_id):
+            if client_id in self.handlers:
                 with self.node_groups_lock:            
                     if GameServer.GROUP_PLAYERS in self.node_groups.get_item_tags(client_id):
                         send_msg = True
@@ -1372,14 +3973,161 @@ class GameServer(GameNode, Server):
             self.send(MsgServerShutdown([GameServer.GROUP_CLIENTS],[],GameServer.SERVER))
         # close listener socket and stop client handlers
         Server.stop(self)
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            with session.lock:
+                if session.expiry_timer is not None:
+                    session.expiry_timer.cancel()
+        with self.udp_channel_lock:
+            if self.udp_channel is not None:
+                self.udp_channel.stop()
+
+
+class SelectorGameServer(GameServer, SelectorServer):
+    """    
+    GameServer which services all of its clients from a single thread, as
+    SelectorServer does.
+    """
+    pass
         
 
+class ClockSynchroniser(object):
+    """    
+    Estimates latency and the difference between the local and server clocks
+    from ping round trips, in the manner of NTP. Of the last few samples, the 
+    one with the shortest round trip is trusted, having been least delayed by 
+    queuing. Samples far from the median round trip are rejected, so that a 
+    lasting change in latency becomes the new norm. Clock drift is estimated 
+    by regression over the best samples. Also decides how long to wait 
+    between pings: a burst when first connected, then backing off while the 
+    estimate is stable. Times are in milliseconds, ping intervals in seconds.
+    """
+
+    WINDOW_SIZE = 5
+    OUTLIER_RATIO = 0.5
+    MIN_OUTLIER_TOLERANCE = 5
+    UNSTABLE_DELTA = 20
+    DRIFT_HISTORY = 16
+    DRIFT_MIN_SPAN = 10000
+    BURST_PINGS = 5
+    BURST_INTERVAL = 0.25
+    MIN_PING_INTERVAL = 1.0
+    MAX_PING_INTERVAL = 16.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # (round trip, local time at midpoint, local - server time)
+            self.samples = []
+            self.best = None
+            self.drift_samples = []
+            self.drift = 0.0
+            self.drift_origin = None
+            self.pings_sent = 0
+            self.ping_interval = ClockSynchroniser.MIN_PING_INTERVAL
+
+    def add_sample(self, ping_time, pong_time, recv_time):
+        """    
+        Records a ping round trip, given the local time the ping was sent, the 
+        server time it was answered and the local time the answer arrived
+        """
+        round_trip = recv_time - ping_time
+        midpoint = ping_time + round_trip/2.0
+        sample = (round_trip, midpoint, midpoint - pong_time)
+        with self.lock:
+            self.samples.append(sample)
+            if len(self.samples) > ClockSynchroniser.WINDOW_SIZE:
+                self.samples.pop(0)
+
+            # reject samples far from the median, then take the quickest
+            median = sorted([s[0] for s in self.samples])[len(self.samples)//2]
+            tolerance = max(median*ClockSynchroniser.OUTLIER_RATIO, 
+                ClockSynchroniser.MIN_OUTLIER_TOLERANCE)
+            accepted = [s for s in self.samples if abs(s[0]-median) <= tolerance]
+            best = min(accepted, key=lambda s: (s[0],-s[1]))
+
+            if self.best is not None and (sample not in accepted 
+                    or abs(best[2]-self.best[2]) > ClockSynchroniser.UNSTABLE_DELTA):
+                # estimate disturbed - ping more often again
+                self.ping_interval = ClockSynchroniser.MIN_PING_INTERVAL
+                if abs(best[2]-self.best[2]) > ClockSynchroniser.UNSTABLE_DELTA:
+                    self.drift_samples = []
+            if best is not self.best:
+                self.best = best
+                self.drift_samples.append(best[1:])
+                if len(self.drift_samples) > ClockSynchroniser.DRIFT_HISTORY:
+                    self.drift_samples.pop(0)
+                self._estimate_drift()
+
+    def _estimate_drift(self):
+        """    
+        Fits a line through the best samples' clock differences over time, if 
+        they span long enough for the slope to be meaningful
+        """
+        self.drift = 0.0
+        self.drift_origin = None
+        times = [t for t,d in self.drift_samples]
+        if len(times) < 2 or max(times)-min(times) < ClockSynchroniser.DRIFT_MIN_SPAN:
+            return
+        mean_t = sum(times) / float(len(times))
+        mean_d = sum([d for t,d in self.drift_samples]) / float(len(times))
+        var = sum([(t-mean_t)**2 for t in times])
+        cov = sum([(t-mean_t)*(d-mean_d) for t,d in self.drift_samples])
+        self.drift = cov / var
+        self.drift_origin = (mean_t, mean_d)
+
+    def get_latency(self):
+        with self.lock:
+            return self.best[0]/2.0 if self.best is not None else 0
+
+    def get_time_delta(self, now):
+        """    
+        Returns the estimated local time minus server time at the given local
+        time
+        """
+        with self.lock:
+            if self.drift_origin is not None:
+                return self.drift_origin[1] + self.drift*(now-self.drift_origin[0])
+            return self.best[2] if self.best is not None else 0
+
+    def get_drift(self):
+        """    
+        Returns the rate at which the local clock gains on the server's, in 
+        milliseconds per millisecond
+        """
+        with self.lock:
+            return self.drift
+
+    def next_ping_interval(self):
+        """    
+        Returns the time to wait before sending the next ping
+        """
+        with self.lock:
+            self.pings_sent += 1
+            if self.pings_sent < ClockSynchroniser.BURST_PINGS:
+                return ClockSynchroniser.BURST_INTERVAL
+            interval = self.ping_interval
+            self.ping_interval = min(interval*2, ClockSynchroniser.MAX_PING_INTERVAL)
+            return interval
+
+
 class GameClient(GameNode, Client, StateMachineBase):
     """    
     Basic game client for use with GameServer. Clients inform one another of 
     their arrival, maintaining their own player lists. They also maintain a 
-    synchronised clock.
+    synchronised clock, pinging the server as often as the ClockSynchroniser
+    requires. If the server offers resumable sessions, a client which loses 
+    its connection reconnects and resumes its session, the messages it missed
+    being replayed, and only reports the connection error if it can't.
     """
+
+    RECONNECT_TIMEOUT = 2.0
+    RECONNECT_INTERVAL = 0.5
     
     class StateConnecting(StateMachineBase.State):
 
@@ -1393,6 +4141,11 @@ class GameClient(GameNode, Client, StateMachineBase):
             """
             # player_id field provides the client with their designated id
             self.machine.client_id = message.player_id
+            # udp_token is given if the server has opened a udp channel for us
+            if message.udp_token and self.machine.udp_channel is not None:
+                self.machine.udp_token = message.udp_token
+                self.machine.udp_address = (self.machine.host, message.udp_port)
+                self.machine.send_udp_hello()
             # players_info field is a dictionary containing info about the 
             # players already connected
             for k in message.players_info:
@@ -1412,22 +4165,48 @@ class GameClient(GameNode, Client, StateMachineBase):
 
         pass
 
-    def __init__(self, player_info, host, port=57810, encoder=JsonEncoder()):
+    def __init__(self, player_info, host, port=57810, encoder=JsonEncoder(), 
+            transport_options=None, udp=False):
         GameNode.__init__(self)
-        Client.__init__(self, host, port, encoder)
+        Client.__init__(self, host, port, encoder, transport_options)
         StateMachineBase.__init__(self)
         self.player_list = {}
         self.player_info = player_info
-        self.latencies = []
+        self.clock = ClockSynchroniser()
+        self.ping_wakeup = threading.Event()
+        self.udp = udp
+        self.udp_channel = None
+        self.udp_token = None
+        self.udp_address = None
+        self.udp_established = False
+        self.udp_last_seqs = {}
         lockable_attrs(self,
-            latency = 0,
-            time_delta = 0
+            udp_seq = 0
         )
         self.pinger_thread = None
+        # session details, if the server offers resuming
+        self.session_token = None
+        self.resume_window = 0
+        self.received_count = 0
+        self.awaiting_resume = False
+        self.resume_reply = None
+        self.lost_error = None
+        # guarded by socket_lock
+        self.resuming = False
+        self.held_messages = []
         self.change_state("StateConnecting")
 
     def run(self):
-        Client.run(self)
+        """    
+        Overidden from Client. Resumes the session each time the connection is
+        lost, until it can't be resumed.
+        """
+        while True:
+            Client.run(self)
+            with self.socket_lock:
+                resuming = self.resuming
+            if not resuming or not self.resume_session():
+                break
     
     def run_ping_sender(self):        
         try:
@@ -1437,30 +4216,220 @@ class GameClient(GameNode, Client, StateMachineBase):
                 with self.stopping_lock:
                     if self.stopping:
                         break
-                mp = MsgPing([Server.SERVER],[],-1,self.get_timestamp())    
-                self.send(mp)            
+                try:
+                    mp = MsgPing([Server.SERVER],[],-1,self.get_timestamp())    
+                    self.send(mp)            
+
+                    # keep saying hello until the server hears it
+                    if self.udp_token is not None and not self.udp_established:
+                        self.send_udp_hello()
+
+                except socket.error as e:
+                    self.handle_network_error((self.get_connected_to(),e))
+                    # carry on pinging once the session is resumed
+                    with self.socket_lock:
+                        if not self.resuming:
+                            break
             
-                time.sleep(3.0)
-                
-        except socket.error as e:    
-            # handle socket error        
-            self.handle_network_error((self.get_connected_to(),e))
+                self.ping_wakeup.wait(self.clock.next_ping_interval())
                                 
         except:
             # handle all other errors
             self.handle_unexpected_error((self.get_connected_to(),sys.exc_info()[1]))
+
+    def received(self, message):
+        """    
+        Overidden from Client. Counts the messages received in the session, so 
+        that the server knows which to replay if it is resumed.
+        """
+        if self.awaiting_resume:
+            if isinstance(message, (MsgSessionResumed,MsgRejectConnect)):
+                self.resume_reply = message
+                self.awaiting_resume = False
+            else:
+                Client.received(self, message)
+            return
+        if isinstance(message, MsgAcceptConnect) and message.session_token:
+            self.session_token = message.session_token
+            self.resume_window = message.resume_window
+            self.received_count = 0
+        if self.session_token is not None and message.keeps_order():
+            self.received_count += 1
+        Client.received(self, message)
+
+    def handle_network_error(self, error_info):
+        """    
+        Overidden from Client. If the session can be resumed, the error is only
+        reported if resuming fails.
+        """
+        with self.stopping_lock:
+            stopping = self.stopping
+        if self.session_token is not None and not stopping:
+            with self.socket_lock:
+                if not self.resuming:
+                    self.resuming = True
+                    self.lost_error = error_info
+            return
+        Client.handle_network_error(self, error_info)
+
+    def resume_session(self):
+        """    
+        Reconnects to the server and resumes the session, retrying until the 
+        server's resume window has passed. Returns whether the session was 
+        resumed. If not, the connection error is reported.
+        """
+        deadline = time.time() + self.resume_window
+        resumed = False
+        while True:
+            with self.stopping_lock:
+                if self.stopping:
+                    break
+            try:
+                reply = self.request_resume(GameClient.RECONNECT_TIMEOUT)
+            except socket.error:
+                reply = None
+            if isinstance(reply, MsgSessionResumed):
+                resumed = True
+                break
+            if isinstance(reply, MsgRejectConnect) and reply.reason != GameServer.REASON_SESSION_BUSY:
+                break
+            with self.socket_lock:
+                if self.socket is not None:
+                    self.socket.close()
+            if time.time() >= deadline:
+                break
+            self.ping_wakeup.wait(GameClient.RECONNECT_INTERVAL)
+
+        with self.socket_lock:
+            self.resuming = False
+            held = self.held_messages
+            self.held_messages = []
+            if resumed:
+                # the server has forgotten our udp address
+                self.udp_established = False
+                try:
+                    for message in held:
+                        Client.send(self, message)
+                except socket.error as e:
+                    # lost again - the listener will resume once more
+                    self.handle_network_error((Server.SERVER,e))
+        if resumed:
+            self.event_queue.put(EvtPlayerResumed(self.client_id))
+        else:
+            with self.socket_lock:
+                if self.socket is not None:
+                    self.socket.close()
+            Client.handle_network_error(self, self.lost_error)
+        return resumed
+
+    def request_resume(self, timeout):
+        """    
+        Opens a new connection and asks the server to resume the session, 
+        returning its reply, or None if there was none within "timeout" seconds.
+        """
+        self.reset_transport()
+        self.transport_negotiated = False
+        self.connect(timeout)
+        self.resume_reply = None
+        self.awaiting_resume = True
+        try:
+            if self.transport_options:
+                self.negotiate_transport()
+            SocketListener.send(self, MsgResumeSession([Server.SERVER],[],self.client_id,
+                self.session_token,self.received_count))
+            end_time = time.time() + timeout
+            while self.awaiting_resume:
+                with self.stopping_lock:
+                    if self.stopping:
+                        break
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                if wait_for_data(self.socket, remaining, self.get_wakeup_socket()):
+                    self.receive_available()
+        finally:
+            self.awaiting_resume = False
+        return self.resume_reply
     
     def after_connect(self):
         """    
         Immediately after connecting to server, request entry into the game
         and start pinging
         """
-        self.send(MsgRequestConnect([Server.SERVER],[],-1,self.player_info))
+        if self.udp:
+            self.open_udp_channel()
+        self.send(MsgRequestConnect([Server.SERVER],[],-1,self.player_info,
+            self.udp_channel is not None))
         self.pinger_thread = threading.Thread(target=self.run_ping_sender)
         self.pinger_thread.start()
     
     def is_in_game(self):
         return self.get_state() == "StateInGame"
+
+    def send(self, message):
+        """    
+        Overidden from Client. Unreliable messages are sent over the udp 
+        channel, if established. While the session is being resumed, reliable
+        messages are held back until it has been, and others are dropped.
+        """
+        with self.socket_lock:
+            if self.resuming and not isinstance(message, MsgTransportOptions):
+                if message.keeps_order():
+                    self.held_messages.append(message)
+                return
+        if not message.reliable and self.udp_established:
+            start = time.time()
+            data = self.encoder.encode(message)
+            if len(data) <= UdpChannel.MAX_PAYLOAD_SIZE:
+                with self.udp_seq_lock:
+                    self.udp_seq = (self.udp_seq + 1) & 0xffffffff
+                    seq = self.udp_seq
+                self.stats.sent(message.__class__, time.time()-start)
+                self.udp_channel.send_datagram(UdpChannel.KIND_MESSAGE, self.udp_token, 
+                    seq, data, self.udp_address)
+                self.stats.wrote(len(data))
+                return
+        Client.send(self, message)
+
+    def open_udp_channel(self):
+        """    
+        Opens a udp channel on any free port. The client carries on without udp
+        if it cannot be opened.
+        """
+        channel = UdpChannel(self, ("",0), Server.SERVER)
+        try:
+            channel.start()
+            self.udp_channel = channel
+        except socket.error as e:
+            self.handle_network_error((Server.SERVER,e))
+
+    def send_udp_hello(self):
+        self.udp_channel.send_datagram(UdpChannel.KIND_HELLO, self.udp_token, 0, b"", 
+            self.udp_address)
+
+    def datagram_received(self, kind, token, seq, payload, address):
+        """    
+        Invoked by the udp channel when a datagram arrives
+        """
+        if token != self.udp_token:
+            return
+        if kind == UdpChannel.KIND_HELLO_ACK:
+            self.udp_established = True
+        elif kind == UdpChannel.KIND_MESSAGE:
+            start = time.time()
+            message = self.decoder.decode(payload)
+            self.stats.read(len(payload))
+            self.stats.received(message.__class__, time.time()-start)
+            # drop messages older than one already received
+            key = message.__class__
+            if key in self.udp_last_seqs and not seq_newer(seq, self.udp_last_seqs[key]):
+                return
+            self.udp_last_seqs[key] = seq
+            # datagrams aren't counted, not being replayed
+            Client.received(self, message)
+
+    def is_udp_established(self):
+        return self.udp_established
     
     def stop(self):
         """    
@@ -1482,21 +4451,28 @@ class GameClient(GameNode, Client, StateMachineBase):
                     
         # shut down client
         Client.stop(self)
+        if self.udp_channel is not None:
+            self.udp_channel.stop()
+
+    def signal_stop(self):
+        """    
+        Overidden from Client. Also wakes the ping sender.
+        """
+        Client.signal_stop(self)
+        self.ping_wakeup.set()
     
     def get_latency(self):
         """    
-        Returns the average one-way time between client and server, in milliseconds 
+        Returns the one-way time between client and server, in milliseconds 
         """
-        with self.latency_lock:
-            return self.latency
+        return self.clock.get_latency()
         
     def get_time_delta(self):
         """    
         Returns an estimate of the difference between the client's clock and the
         server's clock, in milliseconds
         """
-        with self.time_delta_lock:
-            return self.time_delta
+        return self.clock.get_time_delta(self.get_timestamp())
     
     def get_server_time(self):
         """    
@@ -1514,7 +4490,7 @@ class GameClient(GameNode, Client, StateMachineBase):
         self.register_player(message.player_id, message.player_info)        
 
     def _player_disconnected(self, message):
-        if self.player_list.has_key(message.player_id):
+        if message.player_id in self.player_list:
             self.deregister_player(message.player_id)
 
     def intercept_MsgPong(self, message):
@@ -1524,26 +4500,8 @@ class GameClient(GameNode, Client, StateMachineBase):
         latency information    
         """
         recv_time = self.get_timestamp()
-        round_time = recv_time - message.ping_timestamp
-        latn = round_time/2        
-        
-        self.latencies.append(latn)
-        if len(self.latencies) > 5:
-            self.latencies.pop(0)
-                
-        # get the current average latency - ignore if more than 1 sd from mean
-        av_latn = mean( filter(lambda x: deviation(self.latencies,x) < 1.0, 
-            self.latencies) )
-                
-        # find difference between local clock and server clock
-        server_time = message.pong_timestamp + av_latn
-        delta = recv_time - server_time
-        
-        # update values
-        with self.latency_lock:
-            self.latency = av_latn
-        with self.time_delta_lock:
-            self.time_delta = delta
+        self.clock.add_sample(message.ping_timestamp, message.pong_timestamp, recv_time)
+        self.stats.round_trip((recv_time - message.ping_timestamp)/2.0)
 
     @statemethod
     def handle_MsgPlayerConnect(self, message):
@@ -1566,5 +4524,241 @@ class GameClient(GameNode, Client, StateMachineBase):
     def handle_MsgRejectConnect(self, message):
         pass
 
+    def handle_EvtPlayerResumed(self, event):
+        pass
+
+
+class TickLoop(object):
+    """    
+    Fixed rate game loop for a node, typically a GameServer. Each tick 
+    processes waiting events, passing them to "handler" as "process_events" 
+    does, invokes "update" with the tick number and the fixed timestep in 
+    seconds, then writes any batched messages. Event processing may be limited
+    to "max_events" events or "max_time" seconds per tick, the rest being 
+    carried over, so that a burst of messages can't stall a tick. Ticks which 
+    overrun their time are counted and, if the loop falls more than 
+    MAX_CATCH_UP ticks behind, the missed ticks are skipped rather than run 
+    back to back. "run" runs the loop in the calling thread until "stop" is 
+    invoked, which may be done from another thread, even before "run" begins.
+    """
+
+    MAX_CATCH_UP = 5
+    TICK_TIME_BOUNDS = (1, 2, 5, 10, 16, 20, 33, 50, 100, 250)
+
+    def __init__(self, node, rate=30, handler=None, update=None, max_events=None,
+            max_time=None):
+        self.node = node
+        self.interval = 1.0/rate
+        self.handler = handler
+        self.update = update
+        self.max_events = max_events
+        self.max_time = max_time
+        self.tick_count = 0
+        self.stop_event = threading.Event()
+        self.tick_times = Histogram(TickLoop.TICK_TIME_BOUNDS)
+        self.overruns = 0
+        self.skipped = 0
+        self.carried = 0
+
+    def tick(self):
+        """    
+        Runs a single tick, returning the time it took in seconds
+        """
+        start = time.time()
+        self.node.dispatch_events(self.handler, self.max_events, self.max_time)
+        if self.update is not None:
+            self.update(self.tick_count, self.interval)
+        # messages sent while handling events or updating go out together
+        self.node.flush()
+        if self.node.has_events():
+            self.carried += 1
+        self.tick_count += 1
+        elapsed = time.time() - start
+        self.tick_times.add(elapsed*1000)
+        return elapsed
+
+    def run(self):
+        next_tick = time.time()
+        while not self.stop_event.is_set():
+            elapsed = self.tick()
+            if elapsed > self.interval:
+                self.overruns += 1
+            next_tick += self.interval
+            behind = time.time() - next_tick
+            if behind > self.interval*TickLoop.MAX_CATCH_UP:
+                # too far behind to catch up - drop the missed ticks
+                missed = int(behind/self.interval)
+                self.skipped += missed
+                next_tick += missed*self.interval
+            if behind < 0:
+                self.stop_event.wait(-behind)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_stats(self):
+        """    
+        Returns a dictionary of statistics about the ticks run so far: tick 
+        durations in milliseconds, the number of ticks which overran, were 
+        skipped, or left events to be carried over.
+        """
+        return {
+            "ticks" : self.tick_count,
+            "tick_ms" : self.tick_times.snapshot(),
+            "overruns" : self.overruns,
+            "skipped" : self.skipped,
+            "carried" : self.carried
+        }
+
 
+# ----- Benchmarks -------------------------------------------------------------
+if __name__ == "__main__":
+    import gc
 
+    def benchmark_encoders(encoders, messages, iterations=2000):
+        """    
+        Encodes and decodes each message with each encoder the given number of 
+        times, printing the throughput and the encoded size.
+        """
+        for enc in encoders:
+            data = [enc.encode(m) for m in messages]
+            start = time.time()
+            for i in range(iterations):
+                for m in messages:
+                    enc.encode(m)
+            enc_time = time.time() - start
+            start = time.time()
+            for i in range(iterations):
+                for d in data:
+                    enc.decode(d)
+            dec_time = time.time() - start
+            count = iterations*len(messages)
+            print("%-14s encode %8.0f msg/s  decode %8.0f msg/s  avg size %4d bytes" % (
+                enc.__class__.__name__, count/enc_time, count/dec_time, 
+                sum([len(d) for d in data])//len(data)))
+
+    def benchmark_receive(encoder, messages, iterations=200):
+        """    
+        Feeds a burst of framed messages through a SocketListener in 4KB chunks,
+        printing the number of messages parsed and decoded per second.
+        """
+        listener = SocketListener(encoder)
+        burst = b""
+        for m in messages:
+            data = encoder.encode(m)
+            burst += listener._encode_data_length(len(data)) + data
+        burst = burst*50
+        start = time.time()
+        for i in range(iterations):
+            for j in range(0, len(burst), 4096):
+                listener.feed_data(burst[j:j+4096])
+        count = iterations*len(messages)*50
+        print("%-14s receive %8.0f msg/s" % (encoder.__class__.__name__, count/(time.time()-start)))
+
+    class NullListener(SocketListener):
+        lock = threading.RLock()
+        def get_socket_lock(self):
+            return NullListener.lock
+        def write_data(self, data):
+            pass
+
+    def benchmark_broadcast(encoder, messages, recipients=64, iterations=200):
+        """    
+        Sends each message to the given number of listeners, encoding it once 
+        for each listener and then once for all of them, printing the number 
+        of broadcasts per second.
+        """
+        listeners = [NullListener(encoder) for i in range(recipients)]
+        for shared in (False, True):
+            start = time.time()
+            for i in range(iterations):
+                for m in messages:
+                    cache = {} if shared else None
+                    for l in listeners:
+                        l.send(m, cache)
+            count = iterations*len(messages)
+            print("%-14s %3d recipients %-12s %8.0f msg/s" % (encoder.__class__.__name__, 
+                recipients, "encode once" if shared else "encode each", count/(time.time()-start)))
+
+    class CapturingListener(NullListener):
+        def write_data(self, data):
+            self.captured.append(data)
+
+    def benchmark_compression(encoder, messages, iterations=500):
+        """    
+        Sends the messages with each kind of compression and feeds them back 
+        through another listener, printing the bytes written per message and 
+        the round trip throughput, to weigh bandwidth against CPU time.
+        """
+        for compression in (None,) + SocketListener.SUPPORTED_COMPRESSION:
+            sender = CapturingListener(encoder)
+            receiver = NullListener(encoder)
+            sender.compression = receiver.compression = compression
+            start = time.time()
+            for i in range(iterations):
+                sender.captured = []
+                for m in messages:
+                    sender.send(m)
+                for d in sender.captured:
+                    receiver.feed_data(d)
+            count = iterations*len(messages)
+            print("%-14s %-10s %8.0f msg/s  avg size %4d bytes" % (encoder.__class__.__name__,
+                compression or "none", count/(time.time()-start), 
+                sender.get_stats()["bytes_out"]//count))
+
+    class ChatHandler(object):
+        def handle_MsgChat(self, event):
+            pass
+
+    def benchmark_pooling(encoder, message, burst=1000, iterations=50):
+        """    
+        Decodes a burst of copies of the message into a node's event queue and 
+        then processes them, as a tick of a game loop would, repeatedly - 
+        without and then with pooling of the message's class. Prints the 
+        throughput and the number of garbage collections run, which are only 
+        counted from python 3.4.
+        """
+        data = encoder.encode(message)
+        node = Node()
+        handler = ChatHandler()
+        cls = message.__class__
+        for size in (0, burst):
+            cls.pool_size = size
+            before = [g["collections"] for g in gc.get_stats()] if hasattr(gc, "get_stats") else None
+            start = time.time()
+            for i in range(iterations):
+                for j in range(burst):
+                    node.received(encoder.decode(data))
+                node.process_events(handler)
+            rate = iterations*burst/(time.time()-start)
+            if before is not None:
+                after = [g["collections"] for g in gc.get_stats()]
+                collected = "%d gen0 collections" % (after[0]-before[0])
+            else:
+                collected = ""
+            print("%-14s %-10s %8.0f msg/s  %s" % (encoder.__class__.__name__,
+                "pooled" if size else "unpooled", rate, collected))
+        cls.pool_size = 0
+
+    benchmark_messages = [
+        MsgPing([Server.SERVER],[],3,1288345678901),
+        MsgChat([GameServer.GROUP_PLAYERS],[3],3,"Hello everyone"),
+        MsgPlayerConnect([GameServer.GROUP_PLAYERS],[4],Server.SERVER,4,
+            {"name":"dave","colour":[255,128,0],"score":1250}),
+        MsgAcceptConnect([4],[],Server.SERVER,4,dict([(i,{"name":"player%d" % i,
+            "colour":[i,i*2,i*3],"score":i*100}) for i in range(16)]))
+    ]
+    print("Encoder throughput:")
+    benchmark_encoders([JsonEncoder(), BinaryEncoder()], benchmark_messages)
+    print("Receive throughput:")
+    for enc in (JsonEncoder(), BinaryEncoder()):
+        benchmark_receive(enc, benchmark_messages)
+    print("Broadcast throughput:")
+    for enc in (JsonEncoder(), BinaryEncoder()):
+        benchmark_broadcast(enc, benchmark_messages)
+    print("Compression:")
+    for enc in (JsonEncoder(), BinaryEncoder()):
+        benchmark_compression(enc, benchmark_messages)
+    print("Pooling:")
+    for enc in (JsonEncoder(), BinaryEncoder()):
+        benchmark_pooling(enc, benchmark_messages[1])
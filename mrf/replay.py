@@ -0,0 +1,278 @@
+"""
+Copyright (c) 2010 Mark Frimston
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+---------------------
+
+Replay Module
+
+Records the messages arriving at a Node so that they may be fed back into a
+node's game loop later, for example to test the performance of game logic
+under real traffic:
+
+    recorder = MessageRecorder(server, "game.rec")
+    recorder.start()
+    ...
+    recorder.stop()
+
+    player = MessagePlayer("game.rec")
+    player.play(GameServer(), MyHandler())
+
+The recorder is passed each message the node places in its event queue, after
+any interceptor methods, and appends it to the recording with the time it
+arrived. A recording is a file beginning with a magic number, followed by
+records of the form:
+
+    kind (1 byte) - KIND_SESSION or KIND_MESSAGE
+    KIND_SESSION: start time (8 byte float)
+    KIND_MESSAGE: microseconds since previous record (varint),
+                  data length (varint), encoded message
+
+Each time a recorder is started it appends a session record, so a file may hold
+several recordings one after another. Files cut short, such as by a crash, can
+still be played up to the last complete record, and a recorder started on one
+first removes the incomplete record. Messages are encoded with the recorder's
+encoder - the player must be given the same kind. Messages the encoder cannot
+handle are left out of the recording and counted, rather than interrupting
+delivery.
+"""
+
+import os
+import struct
+import threading
+import time
+
+from mrf.network import BinaryEncoder, _write_varint, _read_varint
+
+
+class RecordingError(Exception): pass
+
+
+def _check_magic(header, path):
+    if bytes(header) != MessageRecorder.MAGIC:
+        raise RecordingError("%s is not a message recording" % path)
+
+
+def _read_record(buf, pos):
+    """
+    Reads the record at the given position of bytearray "buf". Returns the
+    record's kind, the time delta, the start of its data and its end, or None
+    if the record is incomplete.
+    """
+    kind = buf[pos]
+    if kind == MessageRecorder.KIND_SESSION:
+        end = pos + 1 + MessageRecorder.TIME_FORMAT.size
+        if end > len(buf):
+            return None
+        return kind,0,pos+1,end
+    elif kind == MessageRecorder.KIND_MESSAGE:
+        try:
+            delta,pos = _read_varint(buf, pos+1)
+            length,pos = _read_varint(buf, pos)
+        except IndexError:
+            return None
+        if pos + length > len(buf):
+            return None
+        return kind,delta,pos,pos+length
+    else:
+        raise RecordingError("Unknown record kind %d at %d" % (kind,pos))
+
+
+class MessageRecorder(object):
+    """
+    Appends the messages queued by "node" to the recording file at "path",
+    encoding them with "encoder", or a BinaryEncoder by default. "start" begins
+    recording and "stop" ends it. Messages may also be passed to "record"
+    directly. "skipped" counts the messages which could not be encoded.
+    """
+
+    MAGIC = b"MRFREC\x01"
+    KIND_SESSION = 0
+    KIND_MESSAGE = 1
+    TIME_FORMAT = struct.Struct(">d")
+
+    def __init__(self, node, path, encoder=None):
+        self.node = node
+        self.path = path
+        self.encoder = encoder if encoder is not None else BinaryEncoder()
+        self.lock = threading.Lock()
+        self.file = None
+        # time of the last record in microseconds
+        self.last_time = 0
+        self.count = 0
+        self.skipped = 0
+
+    def start(self):
+        with self.lock:
+            self.repair()
+            self.file = open(self.path, "ab")
+            self.file.seek(0, os.SEEK_END)
+            if self.file.tell() == 0:
+                self.file.write(MessageRecorder.MAGIC)
+            now = time.time()
+            self.file.write(bytes(bytearray([MessageRecorder.KIND_SESSION]))
+                + MessageRecorder.TIME_FORMAT.pack(now))
+            self.last_time = int(now*1000000)
+            self.count = 0
+            self.skipped = 0
+        if self.node is not None:
+            self.node.recorder = self
+
+    def repair(self):
+        """
+        Checks the existing recording, if any, and cuts off an incomplete
+        record left at its end, so that more can be appended
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as f:
+            buf = bytearray(f.read())
+            magic = MessageRecorder.MAGIC
+            if len(buf) < len(magic) and magic.startswith(bytes(buf)):
+                # cut short while writing the header
+                end = 0
+            else:
+                end = len(magic)
+                _check_magic(buf[:end], self.path)
+                while end < len(buf):
+                    record = _read_record(buf, end)
+                    if record is None:
+                        break
+                    end = record[3]
+            if end < len(buf):
+                f.truncate(end)
+
+    def stop(self):
+        if self.node is not None and self.node.recorder is self:
+            self.node.recorder = None
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def record(self, message, timestamp=None):
+        """
+        Appends the message to the recording, as arriving at the given time or
+        now. Ignored if the recorder isn't started. The message is encoded
+        straight away, so may be reused afterwards. A message which cannot be
+        encoded, such as one not registered with a BinaryEncoder, is skipped.
+        """
+        try:
+            data = self.encoder.encode(message)
+        except Exception:
+            with self.lock:
+                if self.file is not None:
+                    self.skipped += 1
+            return
+        with self.lock:
+            if self.file is None:
+                return
+            if timestamp is None:
+                timestamp = time.time()
+            # clock may have gone backwards
+            delta = max(0, int(timestamp*1000000) - self.last_time)
+            self.last_time += delta
+            out = bytearray()
+            out.append(MessageRecorder.KIND_MESSAGE)
+            _write_varint(out, delta)
+            _write_varint(out, len(data))
+            out.extend(data)
+            self.file.write(bytes(out))
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+
+class MessagePlayer(object):
+    """
+    Feeds the messages in the recording at "path" into a node's event queue,
+    decoding them with "encoder", or a BinaryEncoder by default
+    """
+
+    def __init__(self, path, encoder=None):
+        self.path = path
+        self.encoder = encoder if encoder is not None else BinaryEncoder()
+
+    def load(self):
+        """
+        Reads and decodes the whole recording. Returns a list of (offset,
+        message) pairs, the offset being the time in seconds since the start
+        of the recording at which the message arrived. Time between sessions
+        is left out, so that each follows on from the last.
+        """
+        with open(self.path, "rb") as f:
+            buf = bytearray(f.read())
+        pos = len(MessageRecorder.MAGIC)
+        _check_magic(buf[:pos], self.path)
+        records = []
+        session_base = 0.0
+        elapsed = 0
+        while pos < len(buf):
+            record = _read_record(buf, pos)
+            if record is None:
+                break
+            kind,delta,start,pos = record
+            if kind == MessageRecorder.KIND_SESSION:
+                if len(records) > 0:
+                    session_base = records[-1][0]
+                elapsed = 0
+            else:
+                elapsed += delta
+                message = self.encoder.decode_buffer(buf, start, pos)
+                records.append((session_base + elapsed/1000000.0, message))
+        return records
+
+    def play(self, node, handler=None, speed=None, tick=None):
+        """
+        Plays the recording into the node, invoking its "process_events" with
+        "handler" after queueing each message. If "tick" is given, the messages
+        arriving within each "tick" seconds are queued together instead, as
+        happens in a TickLoop. Plays at "speed" times real time, or as fast as
+        possible if "speed" is None. The recording is decoded before playing
+        begins. Returns the number of events processed.
+        """
+        records = self.load()
+        start = time.time()
+        count = 0
+        i = 0
+        while i < len(records):
+            if tick is None:
+                j = i + 1
+                due = records[i][0]
+            else:
+                due = (int(records[i][0]/tick)+1)*tick
+                j = i
+                while j < len(records) and records[j][0] < due:
+                    j += 1
+            if speed is not None:
+                delay = start + due/speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            for offset,message in records[i:j]:
+                node.event_queue.put(message)
+            count += node.process_events(handler)
+            i = j
+        return count
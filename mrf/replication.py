@@ -0,0 +1,275 @@
+"""
+Copyright (c) 2010 Mark Frimston
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+---------------------
+
+State Replication Module
+
+Synchronises a world state - a dictionary of entity ids to dictionaries of
+entity fields - from a game server to its players. Each time the server
+publishes the state, each player is sent only those fields which have changed
+since the last state the player acknowledged:
+
+    ReplicatingGameServer                         ReplicatingGameClient
+        set_entity / remove_entity
+        publish_state ------ MsgStateUpdate ------->
+                                                    applies changes to the
+                                                    acknowledged base state
+                      <----- MsgStateAck ----------
+        records the
+        acknowledged state
+
+A player with no acknowledged state - a newly connected one, or one which has
+lost its base state - is sent a full snapshot instead. The update messages are
+registered with BinaryEncoder, which should be used for the connections for
+the most compact updates.
+
+The replicating classes may be combined with SelectorServer in the same way
+as GameServer, e.g. "class MyServer(ReplicatingGameServer, SelectorServer)"
+"""
+
+from mrf.network import (Server, GameServer, GameClient, GameClientHandler,
+    BinaryEncoder, Message)
+
+
+def make_delta(base, current):
+    """
+    Compares two states, returning a dictionary of the changed fields for each
+    entity which is new or changed, and a list of the ids of entities which
+    have been removed.
+    """
+    changes = {}
+    for id in current:
+        fields = current[id]
+        if id not in base:
+            changes[id] = dict(fields)
+        elif fields is not base[id]:
+            old = base[id]
+            changed = {}
+            for k in fields:
+                if k not in old or old[k] != fields[k]:
+                    changed[k] = fields[k]
+            if len(changed) > 0:
+                changes[id] = changed
+    removed = [id for id in base if id not in current]
+    return changes,removed
+
+
+def apply_delta(base, changes, removed):
+    """
+    Returns a new state made by applying the given changes and removals to the
+    base state. The base state is not modified.
+    """
+    state = dict(base)
+    for id in removed:
+        if id in state:
+            del(state[id])
+    for id in changes:
+        fields = dict(state.get(id, {}))
+        fields.update(changes[id])
+        state[id] = fields
+    return state
+
+
+class MsgStateUpdate(Message):
+    """
+    Sent by the server to update a player's copy of the world state. Contains
+    the changes since the state numbered "base_seq", or a full snapshot if
+    "base_seq" is -1.
+    """
+
+    fields = (("seq",int),("base_seq",int),("changes",dict),("removed",list))
+
+    def __init__(self, recipients, excludes, sender=-1, seq=0, base_seq=-1,
+            changes=None, removed=None):
+        Message.__init__(self, recipients, excludes, sender)
+        self.seq = seq
+        self.base_seq = base_seq
+        self.changes = changes if changes is not None else {}
+        self.removed = removed if removed is not None else []
+
+
+class MsgStateAck(Message):
+    """
+    Sent by a player to acknowledge the state numbered "seq", or with "seq" -1
+    to request a full snapshot.
+    """
+
+    fields = (("seq",int),)
+
+    def __init__(self, recipients, excludes, sender=-1, seq=-1):
+        Message.__init__(self, recipients, excludes, sender)
+        self.seq = seq
+
+
+BinaryEncoder.register(11, MsgStateUpdate)
+BinaryEncoder.register(12, MsgStateAck)
+
+
+class ReplicatingGameServer(GameServer):
+    """
+    GameServer which replicates a world state to its players. The state should
+    be modified using "set_entity" and "remove_entity" and then published to
+    the players, typically once per tick, using "publish_state". These should
+    all be invoked from the game loop, as should "process_events".
+    """
+
+    HISTORY_SIZE = 32
+
+    def __init__(self, max_players=4,
+            client_factory=lambda server,socket,client_id: GameClientHandler(server,socket,client_id,BinaryEncoder()),
+            port=57810):
+        GameServer.__init__(self, max_players, client_factory, port)
+        self.entities = {}
+        self.state_seq = 0
+        # published states by sequence number
+        self.state_history = {}
+        # latest state acknowledged by each player
+        self.acked = {}
+
+    def set_entity(self, id, fields):
+        """
+        Updates the given fields of the entity with the given id, adding the
+        entity if it doesn't exist.
+        """
+        # replace rather than modify, as published states share field dicts
+        new_fields = dict(self.entities.get(id, {}))
+        new_fields.update(fields)
+        self.entities[id] = new_fields
+
+    def remove_entity(self, id):
+        if id in self.entities:
+            del(self.entities[id])
+
+    def get_entity(self, id):
+        return self.entities.get(id)
+
+    def get_entities(self):
+        return self.entities
+
+    def publish_state(self):
+        """
+        Records the current state and sends each player the changes since the
+        state they last acknowledged. Players with the same acknowledged state
+        are sent the same message. Returns the new state's sequence number.
+        """
+        self.state_seq += 1
+        # messages may be encoded later, so are given the copy rather than the
+        # live entities
+        state = dict(self.entities)
+        self.state_history[self.state_seq] = state
+        expired = self.state_seq - ReplicatingGameServer.HISTORY_SIZE
+        if expired in self.state_history:
+            del(self.state_history[expired])
+
+        by_base = {}
+        for p in self.get_players():
+            base_seq = self.acked.get(p, -1)
+            if base_seq not in self.state_history:
+                base_seq = -1
+            by_base.setdefault(base_seq, []).append(p)
+
+        for base_seq in by_base:
+            if base_seq == -1:
+                changes,removed = state,[]
+            else:
+                changes,removed = make_delta(self.state_history[base_seq], state)
+            self.send(MsgStateUpdate(by_base[base_seq], [], Server.SERVER,
+                self.state_seq, base_seq, changes, removed))
+        return self.state_seq
+
+    def handle_MsgStateAck(self, message):
+        """
+        Player has acknowledged a state - subsequent updates will be relative to
+        it - or has requested a full snapshot
+        """
+        sender = message.get_sender()
+        if message.seq == -1:
+            if sender in self.acked:
+                del(self.acked[sender])
+        elif message.seq in self.state_history and message.seq > self.acked.get(sender, -1):
+            self.acked[sender] = message.seq
+
+    def client_departed(self, client_id):
+        """
+        Overidden from GameServer. Forgets the departed player's acknowledged
+        state.
+        """
+        GameServer.client_departed(self, client_id)
+        if client_id in self.acked:
+            del(self.acked[client_id])
+
+
+class ReplicatingGameClient(GameClient):
+    """
+    GameClient which keeps a copy of the world state replicated by a
+    ReplicatingGameServer. The state is updated as "process_events" dispatches
+    MsgStateUpdate messages, which are then passed on to the application's
+    handler as usual.
+    """
+
+    HISTORY_SIZE = 32
+
+    def __init__(self, player_info, host, port=57810, encoder=BinaryEncoder(),
+            transport_options=None):
+        GameClient.__init__(self, player_info, host, port, encoder, transport_options)
+        self.entities = {}
+        self.state_seq = -1
+        # received states which the server may base updates on
+        self.state_history = {}
+
+    def handle_MsgStateUpdate(self, message):
+        """
+        Applies the state update to the base state it refers to, acknowledging
+        the new state. If the base state is unknown, requests a full snapshot.
+        """
+        if message.seq <= self.state_seq:
+            # stale update
+            return
+        if message.base_seq == -1:
+            state = apply_delta({}, message.changes, [])
+        elif message.base_seq in self.state_history:
+            state = apply_delta(self.state_history[message.base_seq],
+                message.changes, message.removed)
+        else:
+            self.send(MsgStateAck([Server.SERVER],[],-1,-1))
+            return
+
+        self.entities = state
+        self.state_seq = message.seq
+        self.state_history[message.seq] = state
+        # the server won't use a base older than the one just used
+        for seq in list(self.state_history.keys()):
+            if seq < message.base_seq or seq <= message.seq - ReplicatingGameClient.HISTORY_SIZE:
+                del(self.state_history[seq])
+        self.send(MsgStateAck([Server.SERVER],[],-1,message.seq))
+
+    def get_entity(self, id):
+        return self.entities.get(id)
+
+    def get_entities(self):
+        return self.entities
+
+    def get_state_seq(self):
+        return self.state_seq
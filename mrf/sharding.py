@@ -0,0 +1,352 @@
+"""
+Copyright (c) 2010 Mark Frimston
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+---------------------
+
+Sharding Module
+
+Spreads the clients of a game server across several worker processes, so that
+the server can make use of more than one core. The ShardedGameServer opens the
+listening socket and then forks a process for each shard, each running a
+ShardGameServer which accepts clients from the shared socket:
+
+    ShardedGameServer
+        |
+        +-- shard 0: ShardGameServer - clients 0, 2, 4 ...
+        |       ^
+        |       |  ShardBus
+        |       v
+        +-- shard 1: ShardGameServer - clients 1, 3, 5 ...
+
+Client ids are allocated so that the shard owning a client can be found from
+its id. Each shard delivers a message to its own clients, and passes it over
+the ShardBus to any other shards which may have recipients - the owners of the
+client ids it is addressed to, or every other shard for groups and areas -
+where it is delivered to their clients in turn. Node groups and areas are
+resolved by each shard against its own clients, so addressing works as it does
+for a single GameServer. Players joining and leaving are tracked across shards
+so that player lists remain complete, though the player limit may be briefly
+exceeded if players join different shards at the same moment.
+
+Messages addressed to the server are handled by the shard which received them,
+so each shard runs the game logic for its own clients. The shards' game loops
+are run by a TickLoop in each worker process. Requires a platform which can
+fork processes.
+"""
+
+import copy
+import multiprocessing
+import socket
+import sys
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from mrf.network import (NetworkThread, Server, GameServer, GameClientHandler,
+    JsonEncoder, TickLoop, MsgPlayerConnect, MsgPlayerDisconnect, open_listen_socket)
+
+
+if hasattr(multiprocessing, "get_context"):
+    _multiprocessing = multiprocessing.get_context("fork")
+else:
+    _multiprocessing = multiprocessing
+
+
+class ShardBus(object):
+    """
+    Carries messages between shard processes, using a multiprocessing queue as
+    the inbox of each shard. Messages are pickled in transit.
+    """
+
+    def __init__(self, num_shards):
+        self.inboxes = [_multiprocessing.Queue() for i in range(num_shards)]
+
+    def get_num_shards(self):
+        return len(self.inboxes)
+
+    def post(self, shard, message):
+        self.inboxes[shard].put(message)
+
+    def receive(self, shard, timeout):
+        """
+        Returns the next message posted to the given shard, or None if there is
+        none within "timeout" seconds
+        """
+        try:
+            return self.inboxes[shard].get(True, timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.close()
+
+
+class ShardBusListener(NetworkThread):
+    """
+    Thread which passes messages arriving on the bus to its shard
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, shard):
+        NetworkThread.__init__(self)
+        self.shard = shard
+
+    def signal_stop(self):
+        """
+        Overidden from NetworkThread. Wakes the listener with an empty message.
+        """
+        NetworkThread.signal_stop(self)
+        self.shard.bus.post(self.shard.shard_index, None)
+
+    def run(self):
+        while True:
+            with self.stopping_lock:
+                if self.stopping:
+                    break
+            message = self.shard.bus.receive(self.shard.shard_index, ShardBusListener.POLL_INTERVAL)
+            if message is None:
+                continue
+            try:
+                self.shard.bus_received(message)
+            except:
+                self.shard.handle_unexpected_error((Server.SERVER,sys.exc_info()[1]))
+
+
+class ShardGameServer(GameServer):
+    """
+    GameServer running as one shard of a ShardedGameServer. Accepts clients
+    from the shared listening socket, giving them ids "shard_index" plus a
+    multiple of "num_shards", and exchanges messages with the other shards over
+    the bus. Shards don't offer UDP channels.
+    """
+
+    def __init__(self, shard_index, num_shards, bus, listen_socket, max_players=4,
+            client_factory=lambda server,socket,client_id: GameClientHandler(server,socket,client_id,JsonEncoder())):
+        GameServer.__init__(self, max_players, client_factory, listen_socket.getsockname()[1])
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.bus = bus
+        self.shared_socket = listen_socket
+        self.bus_listener = None
+        self.forwarding = True
+        # players connected to other shards, by id
+        self.remote_players = {}
+
+    def open_listen_socket(self):
+        """
+        Overidden from Server. Uses the socket shared by all of the shards.
+        """
+        return self.shared_socket
+
+    def make_client_id(self):
+        """
+        Overidden from Server. The shard owning a client is its id modulo the
+        number of shards.
+        """
+        id = self.next_id*self.num_shards + self.shard_index
+        self.next_id += 1
+        return id
+
+    def get_shard_of(self, client_id):
+        return client_id % self.num_shards
+
+    def start(self):
+        """
+        Overidden from GameServer. Also starts listening to the bus.
+        """
+        GameServer.start(self)
+        self.remote_players = {}
+        self.forwarding = True
+        self.bus_listener = ShardBusListener(self)
+        self.bus_listener.start()
+
+    def stop(self):
+        """
+        Overidden from GameServer. Also stops listening to the bus. The other
+        shards' clients are left alone.
+        """
+        self.forwarding = False
+        GameServer.stop(self)
+        if self.bus_listener is not None:
+            self.bus_listener.stop()
+
+    def send(self, message):
+        """
+        Overidden from GameServer. Delivers the message to this shard's
+        recipients and posts it to the other shards which may have recipients.
+        """
+        if not self.forwarding:
+            GameServer.send(self, message)
+            return
+        # the bus pickles the message later, by which time it may be reused
+        posted = copy.copy(message) if message.pool_size else message
+        GameServer.send(self, message)
+        for shard in self.get_remote_shards(posted):
+            self.bus.post(shard, posted)
+
+    def get_remote_shards(self, message):
+        """
+        Returns the other shards which may have recipients of the message - the
+        owners of client ids it is addressed to, or all of them if it is
+        addressed to a group or area.
+        """
+        shards = set()
+        for r in message.get_recipients():
+            if r == Server.SERVER:
+                continue
+            if isinstance(r, int):
+                shards.add(self.get_shard_of(r))
+            else:
+                return [s for s in range(self.num_shards) if s != self.shard_index]
+        shards.discard(self.shard_index)
+        return sorted(shards)
+
+    def bus_received(self, message):
+        """
+        Invoked by the bus listener when another shard passes on a message. The
+        message is delivered to this shard's client recipients only, having
+        been handled by the server already.
+        """
+        self.track_remote_player(message)
+        recips = self.resolve_message_recipients(message)
+        self.send_to_handlers(message, recips)
+
+    def track_remote_player(self, message):
+        """
+        Keeps track of players joining and leaving other shards
+        """
+        if isinstance(message, MsgPlayerConnect) and message.sender == Server.SERVER:
+            if self.get_shard_of(message.player_id) != self.shard_index:
+                with self.node_groups_lock:
+                    self.remote_players[message.player_id] = message.player_info
+        elif isinstance(message, MsgPlayerDisconnect) and message.sender == Server.SERVER:
+            with self.node_groups_lock:
+                self.remote_players.pop(message.player_id, None)
+
+    def get_num_players(self):
+        """
+        Overidden from GameServer. Includes players on other shards.
+        """
+        with self.node_groups_lock:
+            return GameServer.get_num_players(self) + len(self.remote_players)
+
+    def get_player_names(self):
+        """
+        Overidden from GameServer. Includes players on other shards.
+        """
+        with self.node_groups_lock:
+            remote = [info["name"] for info in self.remote_players.values()]
+        return GameServer.get_player_names(self) + remote
+
+    def get_info_on_players(self):
+        """
+        Overidden from GameServer. Includes players on other shards.
+        """
+        info = GameServer.get_info_on_players(self)
+        with self.node_groups_lock:
+            info.update(self.remote_players)
+        return info
+
+
+class ShardedGameServer(object):
+    """
+    Runs a game server as "num_shards" worker processes sharing one listening
+    socket. Each worker creates its ShardGameServer using "shard_factory",
+    which is passed the shard index, the number of shards, the bus and the
+    listening socket, and then runs it in a TickLoop at "rate" ticks per
+    second. If given, "handler_factory" is invoked with the shard's server to
+    create the handler object passed to the TickLoop, and "update_factory"
+    likewise to create its update function. "start" forks the workers; "stop"
+    stops them.
+    """
+
+    LISTEN_BACKLOG = 128
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, num_shards=None,
+            shard_factory=lambda index,num,bus,sock: ShardGameServer(index,num,bus,sock),
+            port=57810, rate=30, handler_factory=None, update_factory=None):
+        self.num_shards = num_shards or multiprocessing.cpu_count()
+        self.shard_factory = shard_factory
+        self.port = port
+        self.rate = rate
+        self.handler_factory = handler_factory
+        self.update_factory = update_factory
+        self.listen_socket = None
+        self.bus = None
+        self.processes = []
+        self.stop_event = None
+
+    def start(self):
+        self.listen_socket = open_listen_socket(self.port, ShardedGameServer.LISTEN_BACKLOG)
+        self.bus = ShardBus(self.num_shards)
+        self.stop_event = _multiprocessing.Event()
+        self.processes = []
+        for i in range(self.num_shards):
+            process = _multiprocessing.Process(target=self.run_shard, args=(i,))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def run_shard(self, shard_index):
+        """
+        Invoked in each worker process. Runs the shard until the server stops.
+        """
+        server = self.shard_factory(shard_index, self.num_shards, self.bus, self.listen_socket)
+        handler = self.handler_factory(server) if self.handler_factory else None
+        update = self.update_factory(server) if self.update_factory else None
+        loop = TickLoop(server, self.rate, handler, update)
+        def wait_for_stop():
+            self.stop_event.wait()
+            loop.stop()
+        waiter = threading.Thread(target=wait_for_stop)
+        waiter.daemon = True
+        waiter.start()
+        server.start()
+        try:
+            loop.run()
+        finally:
+            server.stop()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        for process in self.processes:
+            process.join(ShardedGameServer.STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+            self.listen_socket = None
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+
+    def is_alive(self):
+        return len(self.processes) > 0 and all([p.is_alive() for p in self.processes])
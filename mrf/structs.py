@@ -104,7 +104,10 @@ class IntrospectType(type):
 class TagLookup(object):    
     """    
     Collection allowing groups of items to be associated with 
-    multiple different keys and looked up using them.
+    multiple different keys and looked up using them. Immutable snapshots of
+    the groups are cached until the group changes, and "version" is increased
+    on every change, so that results derived from the groups may be cached 
+    too.
     """
 
     def __init__(self):
@@ -134,22 +137,31 @@ class TagLookup(object):
             self.add_tag(tag)
         self.items[item].add(tag)
         self.groups[tag].add(item)
+        self._changed(tag)
 
     def untag_item(self, item, tag):
         if self.has_item(item) and self.has_tag(tag):
             self.items[item].remove(tag)
             self.groups[tag].remove(item)
+            self._changed(tag)
 
     def add_tag(self, tag):
         if self.has_tag(tag):
             self.remove_tag(tag)
         self.groups[tag] = set()
+        self._changed(tag)
 
     def remove_tag(self, tag):
         if self.has_tag(tag):            
             for item in self.get_tag_items(tag):
                 self.untag_item(item, tag)
             del(self.groups[tag])
+            self._changed(tag)
+
+    def _changed(self, tag):
+        self.version += 1
+        if tag in self.snapshots:
+            del(self.snapshots[tag])
             
     def get_items(self):
         return set(self.items.keys())
@@ -169,9 +181,22 @@ class TagLookup(object):
         else:
             return set()
 
+    def get_tag_snapshot(self, tag):
+        """    
+        Returns the items with the given tag as a frozenset, which is reused
+        until the group changes.
+        """
+        snapshot = self.snapshots.get(tag)
+        if snapshot is None:
+            snapshot = frozenset(self.groups.get(tag, ()))
+            self.snapshots[tag] = snapshot
+        return snapshot
+
     def clear(self):
         self.items = {}
         self.groups = {}
+        self.snapshots = {}
+        self.version = getattr(self, "version", 0) + 1
     
     def __getitem__(self, key):
         # index can be used to retrieve tag groups
@@ -182,6 +207,82 @@ class TagLookup(object):
         return self.has_item(key)
 
 
+class SpatialGrid(object):
+    """    
+    Collection of items with 2D positions, bucketed into square cells of the 
+    given size so that the items near a point can be found without checking
+    every item. Moving an item only updates the grid if it changes cell.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.clear()
+
+    def _cell(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def has_item(self, item):
+        return item in self.positions
+
+    def set_position(self, item, x, y):
+        cell = self._cell(x, y)
+        old_cell = self.item_cells.get(item)
+        if cell != old_cell:
+            if old_cell is not None:
+                self._remove_from_cell(item, old_cell)
+            if not cell in self.cells:
+                self.cells[cell] = set()
+            self.cells[cell].add(item)
+            self.item_cells[item] = cell
+        self.positions[item] = (x, y)
+
+    def get_position(self, item):
+        return self.positions.get(item)
+
+    def remove_item(self, item):
+        if self.has_item(item):
+            self._remove_from_cell(item, self.item_cells[item])
+            del(self.item_cells[item])
+            del(self.positions[item])
+
+    def _remove_from_cell(self, item, cell):
+        self.cells[cell].discard(item)
+        if len(self.cells[cell]) == 0:
+            del(self.cells[cell])
+
+    def get_items(self):
+        return set(self.positions.keys())
+
+    def get_items_within(self, x, y, radius):
+        """    
+        Returns the set of items no further than "radius" from the given point
+        """
+        found = set()
+        min_cx,min_cy = self._cell(x-radius, y-radius)
+        max_cx,max_cy = self._cell(x+radius, y+radius)
+        rsq = radius*radius
+        if (max_cx-min_cx+1)*(max_cy-min_cy+1) > len(self.cells):
+            # fewer occupied cells than cells in range - check them all instead
+            cells = [c for c in self.cells if min_cx <= c[0] <= max_cx and min_cy <= c[1] <= max_cy]
+        else:
+            cells = [(cx,cy) for cx in range(min_cx, max_cx+1) for cy in range(min_cy, max_cy+1)
+                if (cx,cy) in self.cells]
+        for cell in cells:
+            for item in self.cells[cell]:
+                ix,iy = self.positions[item]
+                if (ix-x)*(ix-x) + (iy-y)*(iy-y) <= rsq:
+                    found.add(item)
+        return found
+
+    def clear(self):
+        self.positions = {}
+        self.item_cells = {}
+        self.cells = {}
+
+    def __contains__(self, item):
+        return self.has_item(item)
+
+
 class ResourceBundle(object):
 
     class FilesystemStrategy(object):
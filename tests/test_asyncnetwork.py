@@ -0,0 +1,211 @@
+from mrf.network import *
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+if asyncio is not None:
+    from mrf.asyncnetwork import *
+
+
+class EventHandler(object):
+
+    def __init__(self):
+        self.messages = []
+        self.errors = []
+
+    def handle_EvtClientArrived(self, event):
+        pass
+
+    def handle_EvtClientDeparted(self, event):
+        pass
+
+    def handle_EvtConnectionError(self, event):
+        self.errors.append(event)
+
+    def handle_EvtPlayerAccepted(self, event):
+        self.messages.append(event)
+
+    def handle_EvtPlayerResumed(self, event):
+        self.messages.append(event)
+
+    def handle_MsgChat(self, event):
+        self.messages.append(event)
+
+    def handle_MsgAcceptConnect(self, event):
+        self.messages.append(event)
+
+    def handle_MsgPlayerConnect(self, event):
+        self.messages.append(event)
+
+    def handle_MsgPlayerDisconnect(self, event):
+        self.messages.append(event)
+
+    def handle_MsgServerShutdown(self, event):
+        self.messages.append(event)
+
+
+@unittest.skipIf(asyncio is None, "asyncio not available")
+class TestAsyncClientServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_loop(self, aw):
+        return self.loop.run_until_complete(aw)
+
+    def pump(self, nodes, handlers):
+        for i in range(3):
+            for node,handler in zip(nodes,handlers):
+                self.run_loop(node.process_events(handler, timeout=0.05))
+
+    def pump_until(self, server, handler, client, condition, timeout=3):
+        # for a client running in its own thread
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.run_loop(server.process_events(handler, timeout=0.05))
+            client.process_events(EventHandler())
+
+    def make_client_handler(self,server,socket,client_id):
+        return ClientHandler(server,socket,client_id,JsonEncoder())
+
+    def test_message_delivery(self):
+        server = AsyncServer(self.make_client_handler,4452)
+        self.run_loop(server.start())
+        clientA = AsyncClient("localhost",4452,JsonEncoder())
+        clientB = AsyncClient("localhost",4452,JsonEncoder())
+        self.run_loop(clientA.start())
+        self.run_loop(clientB.start())
+
+        server_handler = EventHandler()
+        clientA_handler = EventHandler()
+        clientB_handler = EventHandler()
+        nodes = (server,clientA,clientB)
+        handlers = (server_handler,clientA_handler,clientB_handler)
+        self.pump(nodes, handlers)
+        self.assertEquals(2, server.get_num_clients())
+
+        self.run_loop(clientA.send(MsgChat([1],[],None,"Hi client B")))
+        self.pump(nodes, handlers)
+        self.assertEquals(1, len(clientB_handler.messages))
+        self.assertEquals("Hi client B", clientB_handler.messages[-1].message)
+        self.assertEquals(0, clientB_handler.messages[-1].sender)
+
+        self.run_loop(server.send(MsgChat([Server.GROUP_ALL],[],Server.SERVER,"Hi all")))
+        self.pump(nodes, handlers)
+        self.assertEquals(1, len(server_handler.messages))
+        self.assertEquals(1, len(clientA_handler.messages))
+        self.assertEquals(2, len(clientB_handler.messages))
+
+        self.run_loop(clientB.stop())
+        self.pump(nodes, handlers)
+        self.assertEquals(1, server.get_num_clients())
+
+        self.run_loop(clientA.stop())
+        self.run_loop(server.stop())
+        self.assertEquals(0, server.get_num_clients())
+
+    def test_game_server(self):
+        server = AsyncGameServer(4,port=4453)
+        self.run_loop(server.start())
+        clientA = AsyncGameClient({"name":"testerA"},"localhost",4453)
+        clientB = AsyncGameClient({"name":"testerB"},"localhost",4453)
+        server_handler = EventHandler()
+        clientA_handler = EventHandler()
+        clientB_handler = EventHandler()
+
+        self.run_loop(clientA.start())
+        self.pump((server,clientA),(server_handler,clientA_handler))
+        self.run_loop(clientB.start())
+        self.pump((server,clientA,clientB),(server_handler,clientA_handler,clientB_handler))
+
+        self.assertEquals(2, server.get_num_players())
+        self.assertTrue(clientA.is_in_game())
+        self.assertTrue(clientB.is_in_game())
+        self.assertEquals(MsgPlayerConnect, clientA_handler.messages[-1].__class__)
+        self.assertEquals("testerB", clientA_handler.messages[-1].player_info["name"])
+        self.assertEquals(MsgAcceptConnect, clientB_handler.messages[-1].__class__)
+        # ping sent on connect should have been answered
+        self.assertTrue(clientA.get_latency() >= 0)
+
+        self.run_loop(clientA.stop())
+        self.pump((server,clientB),(server_handler,clientB_handler))
+        self.assertEquals(1, server.get_num_players())
+        self.assertEquals(MsgPlayerDisconnect, clientB_handler.messages[-1].__class__)
+
+        self.run_loop(server.stop())
+        self.pump((clientB,),(clientB_handler,))
+        self.assertEquals(MsgServerShutdown, clientB_handler.messages[-1].__class__)
+        self.run_loop(clientB.stop())
+
+    def test_game_client_reports_lost_connection(self):
+        server = AsyncGameServer(4,port=4480)
+        server.set_resume_window(5)
+        self.run_loop(server.start())
+        client = AsyncGameClient({"name":"tester"},"localhost",4480)
+        server_handler = EventHandler()
+        client_handler = EventHandler()
+        self.run_loop(client.start())
+        self.pump((server,client),(server_handler,client_handler))
+        self.assertTrue(client.session_token is not None)
+
+        # drop the connection without the client leaving
+        server.protocols[client.client_id].listener.get_socket().close()
+        self.pump((server,client),(server_handler,client_handler))
+        self.assertEquals(1, len(client_handler.errors))
+        self.assertFalse(client.resuming)
+
+        self.run_loop(client.stop())
+        self.run_loop(server.stop())
+
+    def test_session_resumed(self):
+        server = AsyncGameServer(4,port=4481)
+        server.set_resume_window(5)
+        self.run_loop(server.start())
+        server_handler = EventHandler()
+        client = GameClient({"name":"tester"},"localhost",4481,JsonEncoder())
+        try:
+            client.start()
+            self.pump_until(server, server_handler, client, client.is_in_game)
+            self.assertEquals(1, server.get_num_players())
+            player_id = client.client_id
+
+            # drop the connection, which the client resumes under a new one
+            server.protocols[player_id].listener.get_socket().close()
+            self.pump_until(server, server_handler, client, lambda: EvtPlayerResumed
+                in [e.__class__ for e in server_handler.messages])
+            self.pump((server,),(server_handler,))
+            self.assertFalse(client.resuming)
+            self.assertEquals(1, len(server.protocols))
+            self.assertEquals(1, server.get_num_players())
+            self.assertEquals(player_id, client.client_id)
+
+            client.stop()
+            self.pump((server,),(server_handler,))
+            self.assertEquals({}, server.protocols)
+            self.assertEquals(0, server.get_num_clients())
+        finally:
+            client.stop()
+            self.run_loop(server.stop())
+
+    def test_transport_options(self):
+        server = AsyncServer(self.make_client_handler,4458)
+        self.run_loop(server.start())
+        client = AsyncClient("localhost",4458,JsonEncoder(),{"envelope":["long"]})
+        self.run_loop(client.start())
+        self.assertEquals(SocketListener.ENVELOPE_LONG, client.envelope)
+
+        server_handler = EventHandler()
+        client_handler = EventHandler()
+        big = "x"*100000
+        self.run_loop(client.send(MsgChat([Server.SERVER],[],None,big)))
+        self.pump((server,client),(server_handler,client_handler))
+        self.assertEquals(big, server_handler.messages[-1].message)
+
+        self.run_loop(client.stop())
+        self.run_loop(server.stop())
+
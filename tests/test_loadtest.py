@@ -0,0 +1,68 @@
+from mrf.network import *
+from mrf.loadtest import *
+import unittest
+import threading
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def start_server(self, server):
+        server.start()
+        loop = TickLoop(server, 50)
+        thread = threading.Thread(target=loop.run)
+        thread.start()
+        return loop
+
+    def stop_server(self, server, loop):
+        loop.stop()
+        server.stop()
+
+    def testPlayersExchangeMessages(self):
+        server = GameServer(max_players=5, port=4468)
+        loop = self.start_server(server)
+        try:
+            test = LoadTest("localhost", 4468, num_clients=5, ping_rate=10, chat_rate=10,
+                broadcast_rate=5)
+            report = test.run(1.0)
+        finally:
+            self.stop_server(server, loop)
+        self.assertEquals(5, report["joined"])
+        self.assertEquals(0, report["failed"] + report["rejected"] + report["disconnected"])
+        self.assertTrue(report["ping_ms"]["count"] > 0)
+        self.assertTrue(report["chat_ms"]["count"] > 0)
+        self.assertEquals(5, report["join_ms"]["count"])
+        self.assertTrue(report["messages_out"] > 0)
+        self.assertTrue(report["messages_in"] > report["ping_ms"]["count"])
+        self.assertFalse("server" in report)
+        self.assertTrue(len(format_report(report)) > 0)
+
+    def testRejectedPlayers(self):
+        server = SelectorGameServer(max_players=2, port=4469)
+        loop = self.start_server(server)
+        try:
+            test = LoadTest("localhost", 4469, num_clients=4, ping_rate=0, chat_rate=0,
+                broadcast_rate=0)
+            report = test.run(0.5)
+        finally:
+            self.stop_server(server, loop)
+        self.assertEquals(2, report["joined"])
+        self.assertEquals(2, report["rejected"])
+        self.assertEquals(0, report["disconnected"])
+        self.assertEquals(0, report["ping_ms"]["count"])
+
+    def testLocalServer(self):
+        local = LocalServer(lambda: SelectorGameServer(max_players=3, port=4470), 50)
+        local.start()
+        try:
+            test = LoadTest("localhost", 4470, num_clients=3, ping_rate=10, chat_rate=0,
+                broadcast_rate=10, transport_options={"envelope":["varint"]}, server=local)
+            report = test.run(1.0)
+        finally:
+            local.stop()
+        self.assertEquals(3, report["joined"])
+        self.assertEquals(3, report["server"]["num_clients"])
+        self.assertTrue(report["server"]["cpu_percent"] >= 0)
+        self.assertTrue(report["server"]["messages_in"] > 0)
+        self.assertTrue(report["server"]["tick_ms"]["count"] > 0)
+        self.assertTrue(report["chat_ms"]["count"] > 0)
+        self.assertTrue("Server CPU" in format_report(report))
@@ -1,5 +1,8 @@
 from mrf.network import *
+import mrf.network
 import unittest
+import random
+import pickle
 
 
 class TestMessage(Message):
@@ -16,6 +19,18 @@ class TestMessage(Message):
         return d
 
 
+class MsgPosition(Message):
+    reliable = False
+
+    def __init__(self, recipients, excludes, sender=Server.SERVER, x=0, y=0):
+        Message.__init__(self, recipients, excludes, sender)
+        self.x = x
+        self.y = y
+
+    def to_dict(self):
+        return self._get_attrs(("x","y"))
+
+
 class JsonTest(unittest.TestCase):
 
     def setUp(self):
@@ -35,6 +50,242 @@ class JsonTest(unittest.TestCase):
         self.assertEquals(123.5, m2.weight)
 
 
+BinaryEncoder.register(100, TestMessage)
+
+
+class BinaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = BinaryEncoder()
+
+    def testEncodeDecode(self):
+        m = TestMessage(["c1","c2","c3"],[],"c1","Frank", 25, 123.5)
+        data = self.encoder.encode(m)
+        m2 = self.encoder.decode(data)
+        self.assertEquals(TestMessage, m2.__class__)
+        self.assertEquals(["c1","c2","c3"],m2.get_recipients())
+        self.assertEquals([],m2.get_excludes())
+        self.assertEquals("c1",m2.get_sender())
+        self.assertEquals("Frank", m2.name)
+        self.assertEquals(25, m2.age)
+        self.assertEquals(123.5, m2.weight)
+
+    def testValues(self):
+        for val in (0, 1, -1, 63, -64, 127, 128, -129, 1<<40, -(1<<62), 1<<70, 
+                0.5, -1e300, True, False, None, "", "foo", u"\u00e9t\u00e9", 
+                b"\x00\xff", [1,[2,"three"]], {"a":{1:[None]},2:"b"}):
+            m = TestMessage([1],[2],3,val,0,0.0)
+            m2 = self.encoder.decode(self.encoder.encode(m))
+            self.assertEquals(val, m2.name)
+            self.assertEquals(type(val), type(m2.name))
+
+    def testTuplesDecodedAsLists(self):
+        m = TestMessage([1],[],3,(1,2),0,0.0)
+        self.assertEquals([1,2], self.encoder.decode(self.encoder.encode(m)).name)
+
+    def testSmallerThanJson(self):
+        m = MsgPlayerConnect(["players"],[2],-1,2,{"name":"dave","age":21})
+        self.assertTrue(len(self.encoder.encode(m)) < len(JsonEncoder().encode(m)))
+
+    def testUnregisteredMessage(self):
+        class Unregistered(Message):
+            pass
+        self.assertRaises(MessageError, self.encoder.encode, Unregistered([],[]))
+        self.assertRaises(MessageError, self.encoder.decode, b"\x7f\x07\x00")
+
+    def testRegisterConflict(self):
+        BinaryEncoder.register(100, TestMessage)
+        self.assertRaises(MessageError, BinaryEncoder.register, 100, MsgChat)
+
+    def testUnsupportedValue(self):
+        m = TestMessage([1],[],3,object(),0,0.0)
+        self.assertRaises(MessageError, self.encoder.encode, m)
+
+
+class MsgSlotted(Message):
+    __slots__ = ("x","y","label")
+    fields = (("x",int),("y",int),("label",unicode))
+
+    def __init__(self, recipients, excludes, sender=Server.SERVER, x=0, y=0, label=""):
+        Message.__init__(self, recipients, excludes, sender)
+        self.x = x
+        self.y = y
+        self.label = label
+
+
+BinaryEncoder.register(101, MsgSlotted)
+
+
+class MsgChatColour(MsgChat):
+
+    def __init__(self, recipients, excludes, sender=Server.SERVER, message="", colour=""):
+        MsgChat.__init__(self, recipients, excludes, sender, message)
+        self.colour = colour
+
+    def to_dict(self):
+        return self._get_attrs(("message","colour"))
+
+
+BinaryEncoder.register(103, MsgChatColour)
+
+
+class TestMessageFields(unittest.TestCase):
+
+    def testGeneratedFunctions(self):
+        m = MsgSlotted([1],[],2,3,4,"five")
+        self.assertEquals({"x":3,"y":4,"label":"five"}, m.to_dict())
+        self.assertEquals([3,4,"five"], m.to_values())
+        m.from_dict({"y":7})
+        self.assertEquals([3,7,"five"], m.to_values())
+        m.from_values([8,9,"ten"])
+        self.assertEquals({"x":8,"y":9,"label":"ten"}, m.to_dict())
+
+    def testSlots(self):
+        m = MsgSlotted([1],[],2)
+        self.assertFalse(hasattr(m, "__dict__"))
+        self.assertRaises(AttributeError, setattr, m, "z", 1)
+
+    def testPickle(self):
+        for m in (MsgSlotted([1],[2],3,4,5,"six"), MsgChat([1],[2],3,"hi")):
+            for protocol in range(3):
+                m2 = pickle.loads(pickle.dumps(m, protocol))
+                self.assertEquals(m.to_dict(), m2.to_dict())
+                self.assertEquals(([1],[2],3), (m2.recipients,m2.excludes,m2.sender))
+
+    def testEncodeDecode(self):
+        for encoder in (JsonEncoder(), BinaryEncoder()):
+            m = encoder.decode(encoder.encode(MsgSlotted([1],[2],3,4,-5,"six")))
+            self.assertEquals(MsgSlotted, m.__class__)
+            self.assertEquals(([1],[2],3), (m.recipients,m.excludes,m.sender))
+            self.assertEquals([4,-5,"six"], m.to_values())
+
+    def testBinaryDecodesDictData(self):
+        encoder = BinaryEncoder()
+        out = bytearray(b"\x65")
+        for val in ([1],[],3,{"x":1,"label":"two"}):
+            encoder._encode_val(out, val)
+        m = encoder.decode(bytes(out))
+        self.assertEquals([1,0,"two"], m.to_values())
+
+    def testBinaryOmitsNames(self):
+        m = MsgPlayerConnect(["players"],[2],-1,2,{"name":"dave"})
+        self.assertFalse(b"player_id" in BinaryEncoder().encode(m))
+
+    def testImplementedFunctionsKept(self):
+        class MsgCustom(Message):
+            fields = (("a",int),)
+            def to_dict(self):
+                return {"b":self.a}
+        m = MsgCustom([],[])
+        m.from_values([1])
+        self.assertEquals({"b":1}, m.to_dict())
+
+    def testSubclassImplementingToDict(self):
+        self.assertFalse(MsgChatColour.encodes_values)
+        self.assertTrue(MsgChat.encodes_values)
+        for encoder in (JsonEncoder(), BinaryEncoder()):
+            m = encoder.decode(encoder.encode(MsgChatColour([1],[],2,"hi","red")))
+            self.assertEquals(MsgChatColour, m.__class__)
+            self.assertEquals(("hi","red"), (m.message,m.colour))
+
+    def testValuesFromToDict(self):
+        m = MsgPosition([1],[],2,3,4)
+        self.assertEquals([3,4], m.to_values())
+        m.from_values([5,6])
+        self.assertEquals((5,6), (m.x,m.y))
+        m = MsgChatColour([1],[],2,"hi","red")
+        self.assertEquals(["red","hi"], m.to_values())
+        m.from_values(["blue","bye"])
+        self.assertEquals(("bye","blue"), (m.message,m.colour))
+
+    def testInvalidFields(self):
+        def define(fields):
+            return type("MsgBad", (Message,), {"fields":fields})
+        self.assertRaises(MessageError, define, (("a",int),("a",int)))
+        self.assertRaises(MessageError, define, (("a b",int),))
+        self.assertRaises(MessageError, define, (("class",int),))
+        self.assertRaises(MessageError, define, (("a","int"),))
+        self.assertEquals([], define(())([],[]).to_values())
+
+
+class MsgPooled(Message):
+    pool_size = 2
+    fields = (("text",unicode),)
+
+    def __init__(self, recipients, excludes, sender=Server.SERVER, text=""):
+        Message.__init__(self, recipients, excludes, sender)
+        self.text = text
+        self.resets = getattr(self, "resets", 0)
+
+    def reset(self):
+        self.resets += 1
+
+
+BinaryEncoder.register(102, MsgPooled)
+
+
+class EvtPooled(Event):
+    pool_size = 1
+
+    def __init__(self, value):
+        self.value = value
+
+
+class TestPooling(unittest.TestCase):
+
+    def setUp(self):
+        mrf.network._event_pools.clear()
+
+    class PooledHandler(object):
+        def __init__(self):
+            self.texts = []
+        def handle_MsgPooled(self, event):
+            self.texts.append(event.text)
+
+    def testAcquireReusesReleased(self):
+        e = EvtPooled.acquire(1)
+        self.assertEquals(1, e.value)
+        e.release()
+        e2 = EvtPooled.acquire(2)
+        self.assertTrue(e is e2)
+        self.assertEquals(2, e2.value)
+        self.assertFalse(EvtPooled.acquire(3) is e2)
+
+    def testPoolSizeLimit(self):
+        events = [EvtPooled.acquire(i) for i in range(3)]
+        for e in events:
+            e.release()
+        reused = [EvtPooled.acquire(i) for i in range(3)]
+        self.assertEquals(1, len([e for e in reused if e in events]))
+
+    def testUnpooledNotReused(self):
+        e = EvtClientArrived.acquire(1)
+        e.release()
+        self.assertFalse(EvtClientArrived.acquire(2) is e)
+
+    def testResetOnRelease(self):
+        m = MsgPooled.acquire([1],[],2,"hi")
+        m.release()
+        self.assertEquals(1, m.resets)
+        self.assertTrue(MsgPooled.acquire([3],[],4,"ho") is m)
+        self.assertEquals(([3],[],4,"ho"), (m.recipients,m.excludes,m.sender,m.text))
+
+    def testDecodersReuseProcessedMessages(self):
+        for encoder in (JsonEncoder(), BinaryEncoder()):
+            node = Node()
+            handler = TestPooling.PooledHandler()
+            data = [encoder.encode(MsgPooled([1],[],2,t)) for t in ("a","b")]
+            first = encoder.decode(data[0])
+            node.received(first)
+            node.process_events(handler)
+            second = encoder.decode(data[1])
+            self.assertTrue(first is second)
+            self.assertEquals("b", second.text)
+            node.received(second)
+            node.process_events(handler)
+            self.assertEquals(["a","b"], handler.texts)
+
+
 class TestMessages(unittest.TestCase):
     
     encoder = JsonEncoder()
@@ -71,6 +322,873 @@ class TestMessages(unittest.TestCase):
             recipients=[7,7], excludes=[5], sender=3, message="hi thar")
 
 
+class TestBinaryMessages(TestMessages):
+
+    encoder = BinaryEncoder()
+
+
+class CollectingListener(SocketListener):
+
+    def __init__(self, encoder):
+        SocketListener.__init__(self, encoder)
+        self.messages = []
+        self.written = []
+        self.socket_lock = threading.RLock()
+
+    def received(self, message):
+        self.messages.append(message)
+
+    def get_socket_lock(self):
+        return self.socket_lock
+
+    def write_data(self, data):
+        self.written.append(data)
+
+
+class TestReceiveBuffer(unittest.TestCase):
+
+    def frame(self, listener, message):
+        data = listener.encoder.encode(message)
+        return listener._encode_data_length(len(data)) + data
+
+    def testManyMessagesInOneChunk(self):
+        for encoder in (JsonEncoder(), BinaryEncoder()):
+            l = CollectingListener(encoder)
+            data = b"".join([self.frame(l, MsgChat([1],[],2,"msg %d" % i)) for i in range(50)])
+            l.feed_data(data)
+            self.assertEquals(["msg %d" % i for i in range(50)], [m.message for m in l.messages])
+            self.assertEquals(0, l.read_end)
+
+    def testMessageSplitAcrossChunks(self):
+        for encoder in (JsonEncoder(), BinaryEncoder()):
+            l = CollectingListener(encoder)
+            data = self.frame(l, MsgChat([1],[],2,"first")) + self.frame(l, MsgChat([1],[],2,"second"))
+            for i in range(len(data)):
+                l.feed_data(data[i:i+1])
+            self.assertEquals(["first","second"], [m.message for m in l.messages])
+
+    def testBufferGrowsAndCompacts(self):
+        l = CollectingListener(BinaryEncoder())
+        l.read_buffer = bytearray(16)
+        big = self.frame(l, MsgChat([1],[],2,"x"*100))
+        small = self.frame(l, MsgChat([1],[],2,"y"))
+        data = small + big + small + big
+        for i in range(0, len(data), 7):
+            l.feed_data(data[i:i+7])
+        self.assertEquals(["y","x"*100,"y","x"*100], [m.message for m in l.messages])
+        self.assertTrue(len(l.read_buffer) >= len(big))
+
+    def testBufferShrinksWhenDrained(self):
+        l = CollectingListener(BinaryEncoder())
+        l.envelope = SocketListener.ENVELOPE_LONG
+        data = l.encoder.encode(MsgChat([1],[],2,"x"*200000))
+        data = l._encode_envelope(len(data), SocketListener.FRAME_WHOLE) + data
+        for i in range(0, len(data), 4096):
+            l.feed_data(data[i:i+4096])
+            if i + 4096 < len(data):
+                self.assertTrue(len(l.read_buffer) > SocketListener.READ_BUFFER_SIZE)
+        self.assertEquals(["x"*200000], [m.message for m in l.messages])
+        self.assertEquals(SocketListener.READ_BUFFER_SIZE, len(l.read_buffer))
+
+
+class TestEnvelopes(unittest.TestCase):
+
+    def roundtrip(self, envelope, messages):
+        sender = CollectingListener(BinaryEncoder())
+        receiver = CollectingListener(BinaryEncoder())
+        sender.envelope = envelope
+        receiver.envelope = envelope
+        for m in messages:
+            sender.send(m)
+        data = b"".join(sender.written)
+        for i in range(0, len(data), 1000):
+            receiver.feed_data(data[i:i+1000])
+        return sender,receiver
+
+    def testEnvelopeModes(self):
+        for envelope in SocketListener.SUPPORTED_ENVELOPES:
+            s,r = self.roundtrip(envelope, [MsgChat([1],[],2,"msg %d" % i) for i in range(20)])
+            self.assertEquals(["msg %d" % i for i in range(20)], [m.message for m in r.messages])
+
+    def testShortEnvelopeLimit(self):
+        l = CollectingListener(BinaryEncoder())
+        self.assertRaises(MessageError, l.send, MsgChat([1],[],2,"x"*70000))
+
+    def testLargeMessagesAreFragmented(self):
+        for envelope in (SocketListener.ENVELOPE_LONG, SocketListener.ENVELOPE_VARINT):
+            big = "x"*(SocketListener.FRAGMENT_SIZE*3+5)
+            s,r = self.roundtrip(envelope, [MsgChat([1],[],2,big), MsgChat([1],[],2,"small")])
+            self.assertEquals(5, len(s.written))
+            self.assertEquals([big,"small"], [m.message for m in r.messages])
+            self.assertEquals([], r.read_fragments)
+
+    def testMessagesBetweenFragments(self):
+        sender = CollectingListener(BinaryEncoder())
+        receiver = CollectingListener(BinaryEncoder())
+        sender.envelope = receiver.envelope = SocketListener.ENVELOPE_VARINT
+        big = "y"*(SocketListener.FRAGMENT_SIZE*2)
+        sender.send(MsgChat([1],[],2,big))
+        sender.send(MsgChat([1],[],2,"small"))
+        # deliver the small message between the fragments
+        w = sender.written
+        receiver.feed_data(w[0] + w[-1] + b"".join(w[1:-1]))
+        self.assertEquals(["small",big], [m.message for m in receiver.messages])
+
+    def testMaxMessageSize(self):
+        l = CollectingListener(BinaryEncoder())
+        l.envelope = SocketListener.ENVELOPE_LONG
+        header = l._encode_envelope(SocketListener.MAX_MESSAGE_SIZE+1, SocketListener.FRAME_WHOLE)
+        self.assertRaises(MessageError, l.feed_data, header)
+
+    def testChooseOptions(self):
+        l = CollectingListener(BinaryEncoder())
+        self.assertEquals({"envelope":"long"}, 
+            l.choose_transport_options({"envelope":["huge","long","varint"]}))
+        self.assertEquals({}, l.choose_transport_options({"envelope":["huge"]}))
+        self.assertEquals({}, l.choose_transport_options({}))
+        self.assertEquals({"compression":"zlib"}, 
+            l.choose_transport_options({"compression":["lzma","zlib"]}))
+
+    def testCompression(self):
+        big = " ".join(["player%d" % i for i in range(100)])
+        for compression in SocketListener.SUPPORTED_COMPRESSION:
+            for encoder in (JsonEncoder(), BinaryEncoder()):
+                sender = CollectingListener(encoder)
+                receiver = CollectingListener(encoder)
+                sender.compression = receiver.compression = compression
+                sender.send(MsgChat([1],[],2,big))
+                sender.send(MsgChat([1],[],2,"small"))
+                plain = encoder.encode(MsgChat([1],[],2,big))
+                self.assertTrue(len(sender.written[0]) < len(plain)//2)
+                # small message sent as it is, after the flag byte
+                self.assertEquals(len(encoder.encode(MsgChat([1],[],2,"small")))+3, 
+                    len(sender.written[1]))
+                for data in sender.written:
+                    receiver.feed_data(data)
+                self.assertEquals([big,"small"], [m.message for m in receiver.messages])
+
+    def testCompressedFragments(self):
+        sender = CollectingListener(BinaryEncoder())
+        receiver = CollectingListener(BinaryEncoder())
+        sender.envelope = receiver.envelope = SocketListener.ENVELOPE_VARINT
+        sender.compression = receiver.compression = SocketListener.COMPRESSION_ZLIB
+        big = "".join([chr(32+random.randint(0,90)) for i in range(SocketListener.FRAGMENT_SIZE*2)])
+        sender.send(MsgChat([1],[],2,big))
+        self.assertTrue(len(sender.written) > 1)
+        receiver.feed_data(b"".join(sender.written))
+        self.assertEquals(big, receiver.messages[0].message)
+
+    def testCompressedCacheShared(self):
+        listeners = [CollectingListener(JsonEncoder()) for i in range(3)]
+        listeners[1].compression = listeners[2].compression = SocketListener.COMPRESSION_ZLIB
+        cache = {}
+        for l in listeners:
+            l.send(MsgChat([1],[],2,"x"*500), cache)
+        self.assertTrue(listeners[1].written[0] is listeners[2].written[0])
+        self.assertNotEquals(listeners[0].written[0], listeners[1].written[0])
+
+    def testMalformedCompression(self):
+        l = CollectingListener(BinaryEncoder())
+        l.compression = SocketListener.COMPRESSION_ZLIB
+        self.assertRaises(MessageError, l._decompress, b"\x01not zlib")
+        self.assertRaises(MessageError, l._decompress, b"\x07")
+
+
+class SlowListener(CollectingListener):
+    """    
+    Listener whose socket takes only "capacity" bytes until drained
+    """
+
+    def __init__(self, encoder, capacity):
+        CollectingListener.__init__(self, encoder)
+        self.capacity = capacity
+
+    def write_available(self, data):
+        n = min(len(data), self.capacity)
+        self.capacity -= n
+        self.written.append(data[:n])
+        return n
+
+    def received_by_peer(self):
+        r = CollectingListener(self.encoder)
+        r.envelope = self.envelope
+        r.feed_data(b"".join(self.written))
+        return r.messages
+
+
+class OfferCountingListener(SlowListener):
+    """    
+    Listener which keeps the size of each write offered to the socket
+    """
+
+    def __init__(self, encoder, capacity):
+        SlowListener.__init__(self, encoder, capacity)
+        self.offered = []
+
+    def write_available(self, data):
+        self.offered.append(len(data))
+        return SlowListener.write_available(self, data)
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.sent = []
+        self.stopped = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def handler_stopped(self, client_id):
+        self.stopped.append(client_id)
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def testTokenBucket(self):
+        bucket = TokenBucket(10, 3)
+        self.assertEquals([True,True,True,False], [bucket.consume() for i in range(4)])
+        bucket.last -= 0.25
+        self.assertEquals([True,True,False], [bucket.consume() for i in range(3)])
+        bucket.last -= 10
+        self.assertEquals(3, len([i for i in range(10) if bucket.consume()]))
+
+    def testRateLimit(self):
+        a,b = socket.socketpair()
+        try:
+            server = FakeServer()
+            handler = ClientHandler(server, a, 5, JsonEncoder())
+            handler.set_rate_limit(100, 5)
+            for i in range(20):
+                handler.received(MsgChat([0],[],-1,"spam"))
+            self.assertEquals(5, len(server.sent))
+            self.assertEquals(5, server.sent[0].sender)
+            self.assertEquals(15, handler.get_stats()["throttled_in"])
+            handler.set_rate_limit(None)
+            handler.received(MsgChat([0],[],-1,"ok"))
+            self.assertEquals(6, len(server.sent))
+        finally:
+            a.close()
+            b.close()
+
+    def testLongQueueWrittenInBatches(self):
+        l = OfferCountingListener(JsonEncoder(), 0)
+        l.set_outgoing_limit(10000000)
+        text = "x"*1000
+        for i in range(200):
+            l.send(MsgChat([1],[],2,text))
+        # each write offers a batch, not the whole queue
+        self.assertTrue(max(l.offered) < SocketListener.MAX_BATCH_SIZE + 2000)
+        l.capacity = 1000000
+        del(l.offered[:])
+        l.flush()
+        self.assertTrue(len(l.offered) > 1)
+        self.assertTrue(max(l.offered) < SocketListener.MAX_BATCH_SIZE + 2000)
+        self.assertEquals(0, l.get_stats()["outgoing_queue"])
+        self.assertEquals(200, len(l.received_by_peer()))
+
+    def testWritesWhatSocketTakes(self):
+        l = SlowListener(JsonEncoder(), 30)
+        l.set_outgoing_limit(10000)
+        for i in range(5):
+            l.send(MsgChat([1],[],2,"message %d" % i))
+        self.assertEquals(30, sum([len(d) for d in l.written]))
+        self.assertEquals(5, l.get_stats()["outgoing_queue"])
+        l.capacity = 100000
+        l.flush()
+        self.assertEquals(0, l.get_stats()["outgoing_queue"])
+        self.assertEquals(["message %d" % i for i in range(5)], 
+            [m.message for m in l.received_by_peer()])
+
+    def testDropOldest(self):
+        l = SlowListener(JsonEncoder(), 10)
+        size = len(JsonEncoder().encode(MsgChat([1],[],2,"message 0"))) + 2
+        l.set_outgoing_limit(size*3)
+        for i in range(6):
+            l.send(MsgChat([1],[],2,"message %d" % i))
+        l.capacity = 100000
+        l.flush()
+        # the partly written message is kept
+        self.assertEquals(["message 0","message 4","message 5"],
+            [m.message for m in l.received_by_peer()])
+        self.assertEquals(3, l.get_stats()["dropped_out"])
+
+    def testCoalesce(self):
+        l = SlowListener(JsonEncoder(), 0)
+        l.set_outgoing_limit(10000, SocketListener.OVERFLOW_COALESCE)
+        for i in range(5):
+            l.send(MsgPosition([1],[],2,i,i))
+            l.send(MsgPosition([1],[],3,i,-i))
+            l.send(MsgChat([1],[],2,"chat %d" % i))
+        l.capacity = 100000
+        l.flush()
+        received = l.received_by_peer()
+        self.assertEquals(["chat %d" % i for i in range(5)], 
+            [m.message for m in received if isinstance(m, MsgChat)])
+        self.assertEquals([(2,4),(3,-4)], 
+            [(m.sender,m.y) for m in received if isinstance(m, MsgPosition)])
+
+    def testFragmentsNotDropped(self):
+        l = SlowListener(BinaryEncoder(), 0)
+        l.envelope = SocketListener.ENVELOPE_VARINT
+        l.set_outgoing_limit(100)
+        big = "x"*(SocketListener.FRAGMENT_SIZE*2)
+        l.send(MsgChat([1],[],2,big))
+        l.send(MsgChat([1],[],2,"small"))
+        l.capacity = 1000000
+        l.flush()
+        self.assertEquals([big], [m.message for m in l.received_by_peer()])
+
+    def testDisconnect(self):
+        a,b = socket.socketpair()
+        try:
+            server = FakeServer()
+            handler = ClientHandler(server, a, 5, BinaryEncoder())
+            handler.set_outgoing_limit(4096, SocketListener.OVERFLOW_DISCONNECT)
+            def flood():
+                while True:
+                    handler.send(MsgChat([5],[],Server.SERVER,"x"*1000))
+            start = time.time()
+            self.assertRaises(socket.error, flood)
+            self.assertTrue(time.time() - start < 1.0)
+            self.assertEquals([5], server.stopped)
+            handler.send(MsgChat([5],[],Server.SERVER,"ignored"))
+        finally:
+            a.close()
+            b.close()
+
+    def testServerAppliesLimits(self):
+        a,b = socket.socketpair()
+        try:
+            server = Server(lambda s,sock,cid: ClientHandler(s,sock,cid,JsonEncoder()), 4466)
+            server.set_rate_limit(50)
+            server.set_outgoing_limit(1000, SocketListener.OVERFLOW_COALESCE)
+            handler = server.create_handler(a, 0)
+            self.assertEquals(50, handler.rate_limit.burst)
+            self.assertEquals(1000, handler.max_outgoing)
+            self.assertEquals(SocketListener.OVERFLOW_COALESCE, handler.overflow_policy)
+        finally:
+            a.close()
+            b.close()
+
+    def testSlowReceiverDoesNotBlock(self):
+        a,b = socket.socketpair()
+        try:
+            handler = ClientHandler(FakeServer(), a, 5, BinaryEncoder())
+            handler.set_outgoing_limit(4096)
+            start = time.time()
+            for i in range(2000):
+                handler.send(MsgChat([5],[],Server.SERVER,"%d %s" % (i,"x"*1000)))
+            self.assertTrue(time.time() - start < 1.0)
+            self.assertTrue(handler.get_stats()["dropped_out"] > 0)
+            # once the receiver catches up, the latest messages arrive intact
+            receiver = CollectingListener(BinaryEncoder())
+            b.setblocking(False)
+            for i in range(100):
+                handler.flush()
+                try:
+                    while True:
+                        receiver.feed_data(b.recv(65536))
+                except socket.error:
+                    pass
+                if handler.get_stats()["outgoing_queue"] == 0:
+                    break
+            self.assertEquals(0, handler.get_stats()["outgoing_queue"])
+            self.assertTrue(receiver.messages[-1].message.startswith("1999 "))
+        finally:
+            a.close()
+            b.close()
+
+
+class TestPriority(unittest.TestCase):
+
+    def chats(self, listener):
+        return [m.message for m in listener.received_by_peer() if isinstance(m, MsgChat)]
+
+    def testQueueTakesTurns(self):
+        q = OutgoingQueue((2,1))
+        for i in range(5):
+            q.append("a%d" % i, 0)
+        for i in range(3):
+            q.append("b%d" % i, 1)
+        order = ["a0","a1","b0","a2","a3","b1","a4","b2"]
+        self.assertEquals(order, list(q))
+        self.assertEquals(order, [q.popleft() for i in range(8)])
+        self.assertEquals(0, len(q))
+
+    def testPinnedHead(self):
+        q = OutgoingQueue((1,1))
+        q.append("low", 1)
+        q.pin()
+        q.append("high", 0)
+        self.assertEquals(["low","high"], list(q))
+        self.assertEquals(["high"], q.discard(lambda entry: True))
+        self.assertEquals(["low"], list(q))
+
+    def testMessagePriority(self):
+        m = MsgChat([1],[],2,"hi")
+        self.assertEquals(Message.PRIORITY_NORMAL, m.get_priority())
+        self.assertEquals(Message.PRIORITY_HIGH, MsgPong([1],[],2).get_priority())
+        m.set_priority(Message.PRIORITY_LOW)
+        self.assertEquals(Message.PRIORITY_LOW, m.get_priority())
+        self.assertEquals(Message.PRIORITY_LOW, pickle.loads(pickle.dumps(m)).get_priority())
+
+    def testUrgentOvertakesBacklog(self):
+        l = SlowListener(JsonEncoder(), 0)
+        l.set_outgoing_limit(100000)
+        for i in range(3):
+            l.send(MsgChat([1],[],2,"x"*1000))
+        l.send(MsgPong([1],[],2,1,2))
+        l.capacity = 100000
+        l.flush()
+        received = l.received_by_peer()
+        self.assertTrue(isinstance(received[0], MsgPong))
+        self.assertEquals(4, len(received))
+
+    def testPartlyWrittenNotOvertaken(self):
+        l = SlowListener(JsonEncoder(), 10)
+        l.set_outgoing_limit(100000)
+        l.send(MsgChat([1],[],2,"first"))
+        l.send(MsgPong([1],[],2,1,2))
+        l.capacity = 100000
+        l.flush()
+        received = l.received_by_peer()
+        self.assertEquals("first", received[0].message)
+        self.assertTrue(isinstance(received[1], MsgPong))
+
+    def testLowPriorityNotStarved(self):
+        l = SlowListener(JsonEncoder(), 0)
+        l.set_outgoing_limit(100000)
+        low = MsgChat([1],[],2,"low")
+        low.set_priority(Message.PRIORITY_LOW)
+        l.send(low)
+        for i in range(20):
+            l.send(MsgPing([1],[],2,i))
+        l.capacity = 100000
+        l.flush()
+        received = l.received_by_peer()
+        self.assertEquals(21, len(received))
+        self.assertEquals(SocketListener.LANE_WEIGHTS[0],
+            [i for i,m in enumerate(received) if isinstance(m, MsgChat)][0])
+
+    def testDropLowestPriorityFirst(self):
+        l = SlowListener(JsonEncoder(), 0)
+        size = len(JsonEncoder().encode(MsgChat([1],[],2,"msg 0"))) + 2
+        l.set_outgoing_limit(size*3)
+        low = MsgPosition([1],[],2,1,1)
+        low.set_priority(Message.PRIORITY_LOW)
+        l.send(low)
+        for i in range(3):
+            l.send(MsgChat([1],[],2,"msg %d" % i))
+        l.capacity = 100000
+        l.flush()
+        self.assertEquals(["msg 0","msg 1","msg 2"], self.chats(l))
+        self.assertEquals(3, len(l.received_by_peer()))
+
+    def testOrderedMessagesNotReordered(self):
+        l = SlowListener(BinaryEncoder(), 0)
+        l.envelope = SocketListener.ENVELOPE_VARINT
+        l.set_outgoing_limit(1000000)
+        big = "x"*(SocketListener.FRAGMENT_SIZE*2)
+        l.send(MsgChat([1],[],2,big))
+        urgent = MsgChat([1],[],2,"urgent")
+        urgent.set_priority(Message.PRIORITY_HIGH)
+        l.send(urgent)
+        l.send(MsgChat([1],[],2,"later"))
+        l.send(MsgPong([1],[],2,1,2))
+        l.capacity = 1000000
+        l.flush()
+        received = l.received_by_peer()
+        self.assertTrue(isinstance(received[0], MsgPong))
+        self.assertEquals([big,"urgent","later"], self.chats(l))
+
+    def testUrgentSkipsBatchWindow(self):
+        l = CollectingListener(BinaryEncoder())
+        l.set_batch_window(60)
+        l.send(MsgChat([1],[],2,"hello"))
+        self.assertEquals(0, len(l.written))
+        l.send(MsgPing([1],[],2,5))
+        self.assertEquals(1, len(l.written))
+
+    def testTransportChangeWritesQueued(self):
+        l = SlowListener(BinaryEncoder(), 0)
+        l.set_outgoing_limit(100000)
+        l.send(MsgChat([1],[],2,"before"))
+        l.capacity = 100000
+        l.apply_transport_options({"envelope":SocketListener.ENVELOPE_VARINT})
+        self.assertEquals(0, l.get_stats()["outgoing_queue"])
+        l.envelope = SocketListener.ENVELOPE_SHORT
+        self.assertEquals(["before"], self.chats(l))
+
+
+class CountingEncoder(JsonEncoder):
+
+    encoded = 0
+
+    def encode(self, message):
+        CountingEncoder.encoded += 1
+        return JsonEncoder.encode(self, message)
+
+
+class TestEncodeOnce(unittest.TestCase):
+
+    def testCacheIsShared(self):
+        CountingEncoder.encoded = 0
+        listeners = [CollectingListener(CountingEncoder()) for i in range(5)]
+        listeners[4].envelope = SocketListener.ENVELOPE_VARINT
+        cache = {}
+        for l in listeners:
+            l.send(MsgChat([1],[],2,"hello"), cache)
+        self.assertEquals(1, CountingEncoder.encoded)
+        self.assertTrue(listeners[0].written[0] is listeners[3].written[0])
+        self.assertNotEquals(listeners[0].written[0], listeners[4].written[0])
+        for l in listeners:
+            r = CollectingListener(JsonEncoder())
+            r.envelope = l.envelope
+            r.feed_data(l.written[0])
+            self.assertEquals("hello", r.messages[0].message)
+
+
+class TestEventDispatch(unittest.TestCase):
+
+    def testEventQueue(self):
+        q = EventQueue()
+        self.assertTrue(q.empty())
+        for i in range(3):
+            q.put(i)
+        self.assertEquals(3, q.qsize())
+        self.assertEquals([0,1,2], list(q.take_all()))
+        self.assertTrue(q.empty())
+        self.assertEquals([], list(q.take_all()))
+
+    def testDispatch(self):
+        class Base(object):
+            def __init__(self):
+                self.got = []
+            def handle_MsgChat(self, event):
+                self.got.append(event)
+        class Derived(Base):
+            pass
+        d = Derived()
+        m = MsgChat([],[],-1,"hi")
+        self.assertTrue(dispatch_event(d, m, "handle_"))
+        self.assertEquals([m], d.got)
+        self.assertFalse(dispatch_event(d, m, "intercept_"))
+        self.assertFalse(dispatch_event(d, MsgPing([],[]), "handle_"))
+
+    def testDispatchDynamicAttributes(self):
+        class Dynamic(object):
+            def __init__(self):
+                self.got = []
+            def __getattr__(self, name):
+                if name == "handle_MsgChat":
+                    return self.got.append
+                raise AttributeError(name)
+        d = Dynamic()
+        self.assertTrue(dispatch_event(d, MsgChat([],[],-1,"hi"), "handle_"))
+        self.assertEquals(1, len(d.got))
+        self.assertFalse(dispatch_event(d, MsgPing([],[]), "handle_"))
+
+    def testDispatchInstanceAttributes(self):
+        class Plain(object):
+            def handle_MsgPing(self, event):
+                pass
+        d = Plain()
+        m = MsgChat([],[],-1,"hi")
+        self.assertFalse(dispatch_event(d, m, "handle_"))
+        got = []
+        d.handle_MsgChat = got.append
+        d.handle_MsgPing = got.append
+        self.assertTrue(dispatch_event(d, m, "handle_"))
+        self.assertTrue(dispatch_event(d, MsgPing([],[]), "handle_"))
+        self.assertEquals(2, len(got))
+        self.assertFalse(dispatch_event(Plain(), m, "handle_"))
+
+    def testProcessEvents(self):
+        node = Node()
+        handler = EventHandler()
+        node.received(MsgChat([],[],-1,"one"))
+        node.received(MsgChat([],[],-1,"two"))
+        node.process_events(handler)
+        self.assertEquals(["one","two"], [m.message for m in handler.messages])
+        node.received(MsgPing([],[]))
+        self.assertRaises(NoEventHandlerError, node.process_events, handler)
+
+    def testProcessEventsLimited(self):
+        node = Node()
+        handler = EventHandler()
+        for i in range(5):
+            node.received(MsgChat([],[],-1,"msg %d" % i))
+        self.assertEquals(2, node.process_events(handler, max_events=2))
+        self.assertEquals(3, node.get_stats()["event_queue"])
+        node.received(MsgChat([],[],-1,"late"))
+        self.assertEquals(3, node.process_events(handler, max_events=3))
+        self.assertEquals(["msg %d" % i for i in range(5)], [m.message for m in handler.messages])
+        self.assertTrue(node.has_events())
+        self.assertEquals(["late"], [m.message for m in node.take_events()])
+        self.assertFalse(node.has_events())
+
+    def testProcessEventsTimeLimited(self):
+        class SlowHandler(EventHandler):
+            def handle_MsgChat(self, event):
+                time.sleep(0.02)
+                EventHandler.handle_MsgChat(self, event)
+        node = Node()
+        handler = SlowHandler()
+        for i in range(10):
+            node.received(MsgChat([],[],-1,"msg %d" % i))
+        processed = node.process_events(handler, max_time=0.05)
+        self.assertTrue(1 <= processed < 10)
+        self.assertEquals(10-processed, node.process_events(handler))
+
+
+class TestTickLoop(unittest.TestCase):
+
+    def testTicks(self):
+        node = Node()
+        handler = EventHandler()
+        ticks = []
+        def update(tick, dt):
+            ticks.append((tick, dt))
+            node.received(MsgChat([],[],-1,"tick %d" % tick))
+            if tick == 4:
+                loop.stop()
+        loop = TickLoop(node, 100, handler, update)
+        start = time.time()
+        loop.run()
+        self.assertTrue(time.time() - start >= 0.035)
+        self.assertEquals([(i,0.01) for i in range(5)], ticks)
+        self.assertEquals(["tick %d" % i for i in range(4)], [m.message for m in handler.messages])
+        self.assertEquals(5, loop.get_stats()["ticks"])
+
+    def testCarryOver(self):
+        node = Node()
+        handler = EventHandler()
+        for i in range(5):
+            node.received(MsgChat([],[],-1,"msg %d" % i))
+        loop = TickLoop(node, 100, handler, max_events=2)
+        for i in range(3):
+            loop.tick()
+        self.assertEquals(5, len(handler.messages))
+        self.assertEquals(2, loop.get_stats()["carried"])
+
+    def testFlushesOncePerTick(self):
+        class FlushCountingNode(Node):
+            flushes = 0
+            def flush(self):
+                self.flushes += 1
+        node = FlushCountingNode()
+        node.received(MsgChat([],[],-1,"hi"))
+        loop = TickLoop(node, 100, EventHandler())
+        for i in range(3):
+            loop.tick()
+        self.assertEquals(3, node.flushes)
+
+    def testOverrunsAndSkips(self):
+        node = Node()
+        def update(tick, dt):
+            if tick == 0:
+                time.sleep(0.1)
+            elif tick == 3:
+                loop.stop()
+        loop = TickLoop(node, 100, None, update)
+        loop.run()
+        stats = loop.get_stats()
+        self.assertEquals(1, stats["overruns"])
+        self.assertTrue(stats["skipped"] >= 4)
+        self.assertEquals(4, stats["ticks"])
+
+    def testStopBeforeRun(self):
+        loop = TickLoop(Node(), 100)
+        loop.stop()
+        thread = threading.Thread(target=loop.run)
+        thread.daemon = True
+        thread.start()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(0, loop.get_stats()["ticks"])
+
+
+class TestRecipients(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(None, 4463)
+        for i in range(5):
+            self.server.node_groups.tag_item(i, Server.GROUP_CLIENTS)
+            self.server.set_client_position(i, i*10, 0)
+
+    def testAreaRecipients(self):
+        m = MsgChat([Server.area(0,0,15)],[],Server.SERVER,"hi")
+        self.assertEquals(set([0,1]), self.server.resolve_message_recipients(m))
+        m = MsgChat([Server.area(40,0,5),2],[],Server.SERVER,"hi")
+        self.assertEquals(set([2,4]), self.server.resolve_message_recipients(m))
+
+    def testAreaExcludes(self):
+        m = MsgChat([Server.GROUP_CLIENTS],[Server.area(0,0,15)],Server.SERVER,"hi")
+        self.assertEquals(set([2,3,4]), self.server.resolve_message_recipients(m))
+
+    def testClientsMove(self):
+        self.server.set_client_position(4, 0, 5)
+        self.assertEquals(set([0,1,4]), self.server.get_clients_within(0,0,10))
+        self.server.node_groups.tag_item(Server.SERVER, Server.GROUP_ALL)
+        self.server.handlers[4] = None
+        self.server.client_departed(4)
+        self.assertEquals(set([0,1]), self.server.get_clients_within(0,0,10))
+
+    def testGroupResolutionRemembered(self):
+        m = MsgChat([Server.GROUP_CLIENTS],[1],Server.SERVER,"hi")
+        resolved = self.server.resolve_message_recipients(m)
+        self.assertEquals(frozenset([0,2,3,4]), resolved)
+        self.assertTrue(resolved is self.server.resolve_message_recipients(
+            MsgChat([Server.GROUP_CLIENTS],[1],Server.SERVER,"again")))
+        self.server.node_groups.tag_item(5, Server.GROUP_CLIENTS)
+        self.assertEquals(frozenset([0,2,3,4,5]), self.server.resolve_message_recipients(m))
+
+    def testSingleGroupUsesSnapshot(self):
+        m = MsgChat([Server.GROUP_CLIENTS],[],Server.SERVER,"hi")
+        self.assertTrue(self.server.resolve_message_recipients(m) 
+            is self.server.node_groups.get_tag_snapshot(Server.GROUP_CLIENTS))
+
+    def testAreasEncode(self):
+        m = MsgChat([Server.area(1.5,2,10)],[Server.area(0,0,1)],3,"hi")
+        for enc in (JsonEncoder(), BinaryEncoder()):
+            d = enc.decode(enc.encode(m))
+            self.assertEquals([{"x":1.5,"y":2,"radius":10}], d.recipients)
+            self.assertEquals([{"x":0,"y":0,"radius":1}], d.excludes)
+
+
+class TestBatching(unittest.TestCase):
+
+    def testWritesWhenFlushed(self):
+        l = CollectingListener(BinaryEncoder())
+        l.set_batch_window(0)
+        for i in range(10):
+            l.send(MsgChat([1],[],2,"msg %d" % i))
+        # zero window means write as soon as anything is sent
+        self.assertEquals(10, len(l.written))
+
+        l.set_batch_window(60)
+        for i in range(10):
+            l.send(MsgChat([1],[],2,"msg %d" % i))
+        self.assertEquals(10, len(l.written))
+        l.flush()
+        self.assertEquals(11, len(l.written))
+        r = CollectingListener(BinaryEncoder())
+        r.feed_data(l.written[-1])
+        self.assertEquals(["msg %d" % i for i in range(10)], [m.message for m in r.messages])
+        l.flush()
+        self.assertEquals(11, len(l.written))
+
+    def testMaxBatchSize(self):
+        l = CollectingListener(BinaryEncoder())
+        l.set_batch_window(60)
+        l.send(MsgChat([1],[],2,"x"*(SocketListener.MAX_BATCH_SIZE//2)))
+        self.assertEquals(0, len(l.written))
+        l.send(MsgChat([1],[],2,"x"*(SocketListener.MAX_BATCH_SIZE//2)))
+        self.assertEquals(1, len(l.written))
+
+    def testDisablingFlushes(self):
+        l = CollectingListener(BinaryEncoder())
+        l.set_batch_window(60)
+        l.send(MsgChat([1],[],2,"hello"))
+        l.set_batch_window(None)
+        self.assertEquals(1, len(l.written))
+        l.send(MsgChat([1],[],2,"hello"))
+        self.assertEquals(2, len(l.written))
+
+
+class TestStats(unittest.TestCase):
+
+    def testHistogram(self):
+        h = Histogram((1,10,100))
+        for v in (0.5, 2, 3, 50, 500):
+            h.add(v)
+        snap = h.snapshot()
+        self.assertEquals(5, snap["count"])
+        self.assertEquals(0.5, snap["min"])
+        self.assertEquals(500, snap["max"])
+        self.assertEquals({"le_1":1,"le_10":2,"le_100":1,"inf":1}, snap["buckets"])
+        self.assertEquals(10, h.percentile(50))
+        self.assertEquals(500, h.percentile(99))
+        h.clear()
+        self.assertEquals(0, h.snapshot()["count"])
+
+    def testCountsTraffic(self):
+        sender = CollectingListener(BinaryEncoder())
+        receiver = CollectingListener(BinaryEncoder())
+        for i in range(3):
+            sender.send(MsgChat([1],[],2,"msg %d" % i))
+        sender.send(MsgPing([1],[],2,0))
+        for data in sender.written:
+            receiver.feed_data(data)
+        sent = sender.get_stats()
+        self.assertEquals(4, sent["messages_out"])
+        self.assertEquals(sum([len(d) for d in sender.written]), sent["bytes_out"])
+        self.assertEquals(3, sent["types"]["MsgChat"]["out"])
+        self.assertEquals(4, sent["lock_wait_ms"]["count"])
+        received = receiver.get_stats()
+        self.assertEquals(4, received["messages_in"])
+        self.assertEquals(sent["bytes_out"], received["bytes_in"])
+        self.assertEquals(1, received["types"]["MsgPing"]["in"])
+
+    def testLatencyAndJitter(self):
+        stats = NetworkStats()
+        for latn in (20, 30, 25):
+            stats.round_trip(latn)
+        snap = stats.snapshot()
+        self.assertEquals(3, snap["latency_ms"]["count"])
+        self.assertEquals(2, snap["jitter_ms"]["count"])
+        self.assertEquals(5, snap["jitter_ms"]["min"])
+        self.assertEquals(10, snap["jitter_ms"]["max"])
+
+    def testServerTotals(self):
+        server = Server(None, 4464)
+        for i in range(2):
+            server.handlers[i] = CollectingListener(BinaryEncoder())
+            server.handlers[i].send(MsgChat([1],[],2,"hi"))
+        server.received(MsgChat([1],[],2,"hi"))
+        stats = server.get_stats()
+        self.assertEquals(1, stats["event_queue"])
+        self.assertEquals(2, stats["messages_out"])
+        self.assertEquals(1, stats["clients"][0]["messages_out"])
+
+
+class TestClockSynchroniser(unittest.TestCase):
+
+    def testQuickestSampleTrusted(self):
+        clock = ClockSynchroniser()
+        for send,rtt in ((0,130),(1000,100),(2000,120)):
+            clock.add_sample(send, send+rtt/2-500, send+rtt)
+        self.assertEquals(50, clock.get_latency())
+        self.assertEquals(500, clock.get_time_delta(2500))
+
+    def testDriftEstimated(self):
+        clock = ClockSynchroniser()
+        # local clock gains 1ms every second
+        for i in range(8):
+            send = i*5000
+            clock.add_sample(send, send+50-i*5, send+100)
+        self.assertAlmostEquals(0.001, clock.get_drift(), places=6)
+        self.assertAlmostEquals(100, clock.get_time_delta(100000), delta=0.5)
+
+    def testPingBurstThenBackOff(self):
+        clock = ClockSynchroniser()
+        intervals = [clock.next_ping_interval() for i in range(10)]
+        burst = ClockSynchroniser.BURST_PINGS-1
+        self.assertEquals([ClockSynchroniser.BURST_INTERVAL]*burst, intervals[:burst])
+        self.assertEquals([1.0,2.0,4.0,8.0,16.0,16.0], intervals[burst:])
+
+    def testDisturbanceResetsPingInterval(self):
+        clock = ClockSynchroniser()
+        for i in range(7):
+            clock.next_ping_interval()
+        clock.add_sample(0, 50, 100)
+        clock.add_sample(1000, 1050, 1100)
+        self.assertEquals(8.0, clock.next_ping_interval())
+        clock.add_sample(2000, 1600, 2500)
+        self.assertEquals(ClockSynchroniser.MIN_PING_INTERVAL, clock.next_ping_interval())
+
+
 class EventHandler(object):
 
     messages = []
@@ -212,24 +1330,232 @@ class TestClientServer(unittest.TestCase):
         
             self.assertEquals(1, len(server_handler.messages))
             self.assertEquals("Hi server!", server_handler.messages[-1].message)
-            self.assertEquals(0, server_handler.messages[-1].sender)
-        
+            self.assertEquals(0, server_handler.messages[-1].sender)
+        
+            server.send(MsgChat([0],[],Server.SERVER,"Hello client!"))
+            time.sleep(0.1)
+        
+            server.process_events(server_handler)
+            client.process_events(client_handler)
+        
+            self.assertEquals(1, len(client_handler.messages))
+            self.assertEquals("Hello client!", client_handler.messages[-1].message)
+            self.assertEquals(Server.SERVER, client_handler.messages[-1].sender)
+        
+        finally:
+            if client:
+                client.stop()        
+            if server:
+                server.stop()
+        
+    def testMessageBurst(self):
+        """    
+        Test that a burst of messages written at once all arrive in order
+        """
+        server = None
+        client = None
+        try:
+            server_handler = EventHandler()
+            server = Server(self.make_client_handler,4456)
+            server.start()
+            time.sleep(0.1)
+
+            client = Client("localhost", 4456, JsonEncoder())
+            client.start()
+            time.sleep(0.1)
+
+            data = b""
+            for i in range(500):
+                m = JsonEncoder().encode(MsgChat([Server.SERVER],[],None,"burst %d" % i))
+                data += client._encode_data_length(len(m)) + m
+            client.write_data(data)
+            time.sleep(0.3)
+            server.process_events(server_handler)
+
+            self.assertEquals(["burst %d" % i for i in range(500)],
+                [m.message for m in server_handler.messages])
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
+
+    def testBroadcastEncodedOnce(self):
+        """    
+        Test that a message sent to many clients is only encoded once
+        """
+        server = None
+        clients = []
+        try:
+            server = Server(lambda s,sock,cid: ClientHandler(s,sock,cid,CountingEncoder()),4460)
+            server.start()
+            time.sleep(0.1)
+
+            for i in range(4):
+                clients.append(Client("localhost", 4460, JsonEncoder()))
+                clients[-1].start()
+            time.sleep(0.2)
+
+            CountingEncoder.encoded = 0
+            server.send(MsgChat([Server.GROUP_CLIENTS],[],Server.SERVER,"Hello all"))
+            self.assertEquals(1, CountingEncoder.encoded)
+            time.sleep(0.1)
+            for c in clients:
+                handler = EventHandler()
+                c.process_events(handler)
+                self.assertEquals("Hello all", handler.messages[-1].message)
+
+        finally:
+            for c in clients:
+                c.stop()
+            if server:
+                server.stop()
+
+    def testBatchedSend(self):
+        """    
+        Test that batched messages are delivered once the server processes its 
+        events
+        """
+        server = None
+        client = None
+        try:
+            server_handler = EventHandler()
+            server = Server(self.make_client_handler,4459)
+            server.set_batch_window(60)
+            server.start()
+            time.sleep(0.1)
+
+            client_handler = EventHandler()
+            client = Client("localhost", 4459, JsonEncoder())
+            client.start()
+            time.sleep(0.1)
+
+            for i in range(50):
+                server.send(MsgChat([0],[],Server.SERVER,"batch %d" % i))
+            time.sleep(0.1)
+            client.process_events(client_handler)
+            self.assertEquals(0, len(client_handler.messages))
+
+            server.process_events(server_handler)
+            time.sleep(0.1)
+            client.process_events(client_handler)
+            self.assertEquals(["batch %d" % i for i in range(50)],
+                [m.message for m in client_handler.messages])
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
+
+    def testLargeMessages(self):
+        """    
+        Test that messages too large for the default envelope can be sent once 
+        a larger envelope has been negotiated
+        """
+        server = None
+        client = None
+        try:
+            server_handler = EventHandler()
+            server = Server(lambda s,sock,cid: ClientHandler(s,sock,cid,BinaryEncoder()),4457)
+            server.start()
+            time.sleep(0.1)
+
+            client_handler = EventHandler()
+            client = Client("localhost", 4457, BinaryEncoder(), {"envelope":["varint"]})
+            client.start()
+            self.assertEquals(SocketListener.ENVELOPE_VARINT, client.envelope)
+            time.sleep(0.1)
+
+            big = "z"*200000
+            client.send(MsgChat([Server.SERVER],[], None, big))
+            time.sleep(0.3)
+            server.process_events(server_handler)
+            self.assertEquals(big, server_handler.messages[-1].message)
+
+            server.send(MsgChat([0],[],Server.SERVER,big))
+            time.sleep(0.3)
+            client.process_events(client_handler)
+            self.assertEquals(big, client_handler.messages[-1].message)
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
+
+    def testCompression(self):
+        """    
+        Test that compression can be negotiated and used in both directions
+        """
+        server = None
+        client = None
+        try:
+            server_handler = EventHandler()
+            server = Server(lambda s,sock,cid: ClientHandler(s,sock,cid,JsonEncoder()),4465)
+            server.start()
+            time.sleep(0.1)
+
+            client_handler = EventHandler()
+            client = Client("localhost", 4465, JsonEncoder(), 
+                {"compression":SocketListener.SUPPORTED_COMPRESSION})
+            client.start()
+            self.assertEquals(SocketListener.SUPPORTED_COMPRESSION[0], client.compression)
+            time.sleep(0.1)
+
+            text = "all work and no play makes jack a dull boy "*20
+            client.send(MsgChat([Server.SERVER],[], None, text))
+            client.send(MsgChat([Server.SERVER],[], None, "hi"))
+            time.sleep(0.2)
+            server.process_events(server_handler)
+            self.assertEquals([text,"hi"], [m.message for m in server_handler.messages[-2:]])
+            self.assertTrue(client.get_stats()["bytes_out"] < len(text))
+
+            server.send(MsgChat([0],[],Server.SERVER,text))
+            time.sleep(0.2)
+            client.process_events(client_handler)
+            self.assertEquals(text, client_handler.messages[-1].message)
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
+
+    def testBinaryEncoder(self):
+        """    
+        Test that the binary encoder can be used in place of the json encoder
+        """
+        server = None
+        client = None
+        try:
+            server_handler = EventHandler()
+            server = Server(lambda s,sock,cid: ClientHandler(s,sock,cid,BinaryEncoder()),4455)
+            server.start()
+            time.sleep(0.1)
+
+            client_handler = EventHandler()
+            client = Client("localhost", 4455, BinaryEncoder())
+            client.start()
+            time.sleep(0.1)
+
+            client.send(MsgChat([Server.SERVER],[], None, "Hi server!"))
+            time.sleep(0.1)
+            server.process_events(server_handler)
+            self.assertEquals("Hi server!", server_handler.messages[-1].message)
+
             server.send(MsgChat([0],[],Server.SERVER,"Hello client!"))
             time.sleep(0.1)
-        
-            server.process_events(server_handler)
             client.process_events(client_handler)
-        
-            self.assertEquals(1, len(client_handler.messages))
             self.assertEquals("Hello client!", client_handler.messages[-1].message)
-            self.assertEquals(Server.SERVER, client_handler.messages[-1].sender)
-        
+
         finally:
             if client:
-                client.stop()        
+                client.stop()
             if server:
                 server.stop()
-        
+
     def testMessageDelivery(self):
         """    
         Test that messages are send to correct recipients
@@ -353,6 +1679,16 @@ class TestClientServer(unittest.TestCase):
                 server.stop()
 
 
+class PositionHandler(EventHandler):
+
+    def __init__(self):
+        EventHandler.__init__(self)
+        self.positions = []
+
+    def handle_MsgPosition(self, event):
+        self.positions.append(event)
+
+
 class TestGameClientServer(unittest.TestCase):
 
     def pong_test(self,round_trips,offset,expected_latency,expected_delta):
@@ -380,6 +1716,60 @@ class TestGameClientServer(unittest.TestCase):
     def make_client_handler(self,server,socket,client_id):
         return GameClientHandler(server,socket,client_id,JsonEncoder())
 
+    def test_udp_drops_stale_messages(self):
+        client = GameClient({"name":"tester"},"localhost",4462,JsonEncoder())
+        client.udp_token = 99
+        encoded = [JsonEncoder().encode(MsgPosition([0],[],-1,i,i)) for i in range(3)]
+        client.datagram_received(UdpChannel.KIND_MESSAGE, 99, 2, encoded[2], None)
+        client.datagram_received(UdpChannel.KIND_MESSAGE, 99, 1, encoded[1], None)
+        client.datagram_received(UdpChannel.KIND_MESSAGE, 12, 3, encoded[0], None)
+        client.datagram_received(UdpChannel.KIND_MESSAGE, 99, 0xffffffff, encoded[0], None)
+        client.datagram_received(UdpChannel.KIND_MESSAGE, 99, 2, encoded[2], None)
+        self.assertEquals([2], [m.x for m in client.take_events()])
+        self.assertTrue(seq_newer(0, 0xffffffff))
+        self.assertFalse(seq_newer(0xffffffff, 0))
+
+    def test_udp_channel(self):
+        """    
+        Test that unreliable messages are sent over udp once established
+        """
+        server = None
+        client = None
+        try:
+            server_handler = PositionHandler()
+            server = GameServer(2,self.make_client_handler,4462,udp=True)
+            server.start()
+            time.sleep(0.1)
+
+            client_handler = PositionHandler()
+            client = GameClient({"name":"tester"},"localhost",4462,JsonEncoder(),udp=True)
+            client.start()
+            for i in range(3):
+                time.sleep(0.1)
+                server.process_events(server_handler)
+                client.process_events(client_handler)
+            self.assertTrue(client.is_in_game())
+            self.assertTrue(client.is_udp_established())
+
+            client.send(MsgPosition([Server.SERVER],[],None,1,2))
+            time.sleep(0.1)
+            server.process_events(server_handler)
+            self.assertEquals((1,2), (server_handler.positions[-1].x,server_handler.positions[-1].y))
+            self.assertEquals(0, server_handler.positions[-1].sender)
+
+            server.send(MsgPosition([0],[],Server.SERVER,3,4))
+            time.sleep(0.1)
+            client.process_events(client_handler)
+            self.assertEquals(3, client_handler.positions[-1].x)
+            with server.handlers_lock:
+                self.assertEquals(1, server.handlers[0].udp_seq)
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
+
     def test_player_connection(self):
         """    
         Test that GameClient can (or cant) connect to the game accordingly
@@ -599,3 +1989,477 @@ class TestGameClientServer(unittest.TestCase):
                 clientB.stop()
             if server:
                 server.stop()
+
+class TestShutdown(unittest.TestCase):
+
+    def make_client_handler(self,server,socket,client_id):
+        return ClientHandler(server,socket,client_id,JsonEncoder())
+
+    def testSignalStopWakesThread(self):
+        channel = UdpChannel(None, ("",0), Server.SERVER)
+        channel.start()
+        self.assertTrue(channel.get_wakeup_socket() is not None)
+        start = time.time()
+        channel.signal_stop()
+        channel.join(UdpChannel.READ_POLL_INTERVAL)
+        self.assertFalse(channel.is_alive())
+        self.assertTrue(time.time() - start < UdpChannel.READ_POLL_INTERVAL)
+        channel.stop()
+        self.assertEquals(None, channel.get_wakeup_socket())
+
+    def testServerStopsPromptly(self):
+        server = Server(self.make_client_handler,4471)
+        socks = []
+        try:
+            server.start()
+            time.sleep(0.1)
+            for i in range(20):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect(("localhost",4471))
+                socks.append(sock)
+            time.sleep(0.2)
+            self.assertEquals(20, server.get_num_clients())
+            start = time.time()
+            server.stop()
+            self.assertTrue(time.time() - start < Server.ACCEPT_POLL_INTERVAL)
+            self.assertFalse(server.is_alive())
+        finally:
+            for sock in socks:
+                sock.close()
+
+    def testSelectorServerStopsPromptly(self):
+        server = SelectorServer(self.make_client_handler,4472)
+        server.start()
+        time.sleep(0.1)
+        start = time.time()
+        server.stop()
+        self.assertTrue(time.time() - start < Server.ACCEPT_POLL_INTERVAL)
+
+    def testClientStopsPromptly(self):
+        server = Server(self.make_client_handler,4473)
+        client = None
+        try:
+            server.start()
+            time.sleep(0.1)
+            client = Client("localhost", 4473, JsonEncoder())
+            client.start()
+            time.sleep(0.1)
+            start = time.time()
+            client.stop()
+            self.assertTrue(time.time() - start < SocketListener.READ_POLL_INTERVAL)
+            self.assertFalse(client.is_alive())
+        finally:
+            if client:
+                client.stop()
+            server.stop()
+
+    def testRestartOnSamePort(self):
+        sock = open_listen_socket(4474, 1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(("localhost",4474))
+        wait_for_data(sock, 1.0)
+        conn,addr = sock.accept()
+        # closing the server's end first leaves the port in TIME_WAIT
+        conn.close()
+        sock.close()
+        client.close()
+        sock = open_listen_socket(4474, 1)
+        sock.close()
+
+
+class SessionHandler(EventHandler):
+
+    def __init__(self):
+        EventHandler.__init__(self)
+        self.events = []
+
+    def handle_EvtPlayerSuspended(self, event):
+        self.events.append(event)
+
+    def handle_EvtPlayerResumed(self, event):
+        self.events.append(event)
+
+    def handle_EvtConnectionError(self, event):
+        self.events.append(event)
+
+    def handle_MsgPlayerDisconnect(self, event):
+        self.events.append(event)
+
+
+class TestSessionResume(unittest.TestCase):
+
+    def make_client_handler(self,server,socket,client_id):
+        return GameClientHandler(server,socket,client_id,JsonEncoder())
+
+    def drop_connection(self, client, gate):
+        """    
+        Cuts the client's connection, holding back its attempt to resume until
+        "gate" is set
+        """
+        resume = client.resume_session
+        def gated_resume():
+            gate.wait()
+            return resume()
+        client.resume_session = gated_resume
+        with client.socket_lock:
+            client.socket.shutdown(socket.SHUT_RDWR)
+
+    def chat(self, handler):
+        return [m.message for m in handler.messages if isinstance(m, MsgChat)]
+
+    def process(self, nodes, handlers, times=3):
+        for i in range(times):
+            time.sleep(0.1)
+            for node,handler in zip(nodes, handlers):
+                node.process_events(handler)
+
+    def test_session_buffer(self):
+        session = GameSession(1, 0, 3)
+        for i in range(2):
+            session.record(MsgChat([0],[],Server.SERVER,"m%d" % i))
+        session.record(MsgPong([0],[],Server.SERVER,0,0))
+        session.record(MsgPosition([0],[],Server.SERVER,1,1))
+        # pongs and unreliable messages aren't counted
+        self.assertEquals(2, session.sent_count)
+        self.assertEquals(["m1"], [m.message for m in session.get_missed(1)])
+        self.assertTrue(session.can_replay(0))
+        self.assertTrue(session.can_replay(2))
+        self.assertFalse(session.can_replay(3))
+        for i in range(2,5):
+            session.record(MsgChat([0],[],Server.SERVER,"m%d" % i))
+        self.assertEquals(["m2","m3","m4"], [m.message for m in session.get_missed(2)])
+        self.assertFalse(session.can_replay(1))
+        self.assertTrue(session.can_replay(2))
+        self.assertEquals(["m3","m4"], [m.message for m in session.get_missed(3)])
+
+    def test_outgoing_limit_with_resume(self):
+        a,b = socket.socketpair()
+        try:
+            handler = GameClientHandler(FakeServer(), a, 5, JsonEncoder())
+            session = GameSession(1, 5, 10)
+            session.handler = handler
+            handler.session = session
+            handler.set_outgoing_limit(100000)
+            # socket full while the messages are sent
+            handler.write_available = lambda data: 0
+            handler.send(MsgChat([5],[],Server.SERVER,"x"*1000))
+            handler.send(MsgPong([5],[],Server.SERVER,1,2))
+            handler.send(MsgChat([5],[],Server.SERVER,"after"))
+            written = []
+            handler.write_available = lambda data: written.append(data) or len(data)
+            handler.flush()
+            peer = CollectingListener(JsonEncoder())
+            peer.feed_data(b"".join(written))
+            delivered = peer.messages
+            self.assertTrue(isinstance(delivered[0], MsgPong))
+            # wherever the connection drops, the client's count finds the rest
+            for cut in range(len(delivered)+1):
+                client = GameClient({"name":"tester"},"localhost",4478)
+                client.session_token = 1
+                for m in delivered[:cut]:
+                    client.received(m)
+                got = [m.message for m in delivered[:cut] if isinstance(m, MsgChat)]
+                got.extend([m.message for m in session.get_missed(client.received_count)])
+                self.assertEquals(["x"*1000,"after"], got)
+        finally:
+            a.close()
+            b.close()
+
+    def test_overflow_with_resume(self):
+        for policy in (SocketListener.OVERFLOW_DROP_OLDEST, SocketListener.OVERFLOW_COALESCE):
+            a,b = socket.socketpair()
+            try:
+                handler = GameClientHandler(FakeServer(), a, 5, JsonEncoder())
+                session = GameSession(1, 5, 10)
+                session.handler = handler
+                handler.session = session
+                handler.set_outgoing_limit(2500, policy)
+                handler.write_available = lambda data: 0
+                for i in range(5):
+                    handler.send(MsgChat([5],[],Server.SERVER,"m%d" % i + "x"*1000))
+                    handler.send(MsgPosition([5],[],Server.SERVER,i,i))
+                written = []
+                handler.write_available = lambda data: written.append(data) or len(data)
+                handler.flush()
+                peer = CollectingListener(JsonEncoder())
+                peer.feed_data(b"".join(written))
+                # unreliable messages may go, but not those the session counts
+                self.assertEquals(["m%d" % i for i in range(5)], 
+                    [m.message[:2] for m in peer.messages if isinstance(m, MsgChat)])
+                client = GameClient({"name":"tester"},"localhost",4478)
+                client.session_token = 1
+                for m in peer.messages:
+                    client.received(m)
+                self.assertEquals(session.sent_count, client.received_count)
+                self.assertEquals([], session.get_missed(client.received_count))
+            finally:
+                a.close()
+                b.close()
+
+    def test_resume_replays_missed_messages(self):
+        server = None
+        clients = []
+        gate = threading.Event()
+        try:
+            server_handler = SessionHandler()
+            server = GameServer(2,self.make_client_handler,4475)
+            server.set_resume_window(5)
+            server.start()
+            time.sleep(0.1)
+            handlers = []
+            for name in ("testerA","testerB"):
+                clients.append(GameClient({"name":name},"localhost",4475,JsonEncoder()))
+                clients[-1].start()
+                handlers.append(SessionHandler())
+            clientA,clientB = clients
+            self.process([server]+clients, [server_handler]+handlers)
+            self.assertTrue(clientA.is_in_game() and clientB.is_in_game())
+            player_id = clientA.client_id
+
+            self.drop_connection(clientA, gate)
+            self.process([server]+clients, [server_handler]+handlers)
+            self.assertEquals(EvtPlayerSuspended, server_handler.events[-1].__class__)
+            self.assertEquals(2, server.get_num_players())
+
+            clientB.send(MsgChat([player_id],[],None,"while you were away"))
+            self.process([server]+clients, [server_handler]+handlers)
+            self.assertEquals([], self.chat(handlers[0]))
+
+            gate.set()
+            self.process([server]+clients, [server_handler]+handlers, 5)
+            self.assertEquals(EvtPlayerResumed, server_handler.events[-1].__class__)
+            self.assertEquals(player_id, server_handler.events[-1].client_id)
+            self.assertEquals([EvtPlayerResumed], [e.__class__ for e in handlers[0].events])
+            self.assertEquals(["while you were away"], self.chat(handlers[0]))
+            self.assertEquals(2, server.get_num_players())
+            self.assertEquals(2, server.get_num_clients())
+            self.assertEquals([], handlers[1].events)
+
+            clientA.send(MsgChat([clientB.client_id],[],None,"I'm back"))
+            self.process([server]+clients, [server_handler]+handlers)
+            self.assertEquals(["I'm back"], self.chat(handlers[1]))
+            self.assertEquals(player_id, handlers[1].messages[-1].sender)
+
+        finally:
+            gate.set()
+            for c in clients:
+                c.stop()
+            if server:
+                server.stop()
+
+    def test_session_expires(self):
+        server = None
+        clients = []
+        gate = threading.Event()
+        try:
+            server_handler = SessionHandler()
+            server = GameServer(2,self.make_client_handler,4476)
+            server.set_resume_window(0.3)
+            server.start()
+            time.sleep(0.1)
+            handlers = []
+            for name in ("testerA","testerB"):
+                clients.append(GameClient({"name":name},"localhost",4476,JsonEncoder()))
+                clients[-1].start()
+                handlers.append(SessionHandler())
+            clientA,clientB = clients
+            self.process([server]+clients, [server_handler]+handlers)
+            player_id = clientA.client_id
+
+            self.drop_connection(clientA, gate)
+            self.process([server]+clients, [server_handler]+handlers, 6)
+            self.assertEquals(1, server.get_num_players())
+            self.assertEquals(MsgPlayerDisconnect, handlers[1].events[-1].__class__)
+            self.assertEquals(player_id, handlers[1].events[-1].player_id)
+
+            # too late to resume - the client reports the lost connection
+            gate.set()
+            self.process([server]+clients, [server_handler]+handlers)
+            self.assertEquals([EvtConnectionError], [e.__class__ for e in handlers[0].events])
+            self.assertFalse(clientA.is_alive())
+            self.assertEquals(1, server.get_num_clients())
+
+        finally:
+            gate.set()
+            for c in clients:
+                c.stop()
+            if server:
+                server.stop()
+
+    def test_leaving_ends_session(self):
+        server = None
+        client = None
+        try:
+            server_handler = SessionHandler()
+            server = GameServer(2,self.make_client_handler,4477)
+            server.set_resume_window(5)
+            server.start()
+            time.sleep(0.1)
+            client = GameClient({"name":"tester"},"localhost",4477,JsonEncoder())
+            client.start()
+            self.process([server,client], [server_handler,SessionHandler()])
+            self.assertEquals(1, len(server.sessions))
+
+            client.stop()
+            self.process([server], [server_handler])
+            self.assertFalse(EvtPlayerSuspended in [e.__class__ for e in server_handler.events])
+            self.assertEquals(0, server.get_num_players())
+            self.assertEquals({}, server.sessions)
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
+
+
+class TestSelectorServer(unittest.TestCase):
+
+    def make_client_handler(self,server,socket,client_id):
+        return ClientHandler(server,socket,client_id,JsonEncoder())
+
+    def make_game_client_handler(self,server,socket,client_id):
+        return GameClientHandler(server,socket,client_id,JsonEncoder())
+
+    def test_handlers_are_not_threaded(self):
+        server = None
+        try:
+            server = SelectorServer(self.make_client_handler,4449)
+            server.start()
+            time.sleep(0.1)
+
+            socks = []
+            for i in range(5):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect(("localhost",4449))
+                socks.append(sock)
+            time.sleep(0.2)
+            server.process_events(EventHandler())
+
+            self.assertEquals(5, server.get_num_clients())
+            for handler in server.handlers.values():
+                self.assertFalse(handler.is_alive())
+
+            for sock in socks:
+                sock.close()
+            time.sleep(0.2)
+            server.process_events(EventHandler())
+
+            self.assertEquals(0, server.get_num_clients())
+
+        finally:
+            if server:
+                server.stop()
+
+    def test_message_delivery(self):
+        server = None
+        clientA = None
+        clientB = None
+        try:
+            server_handler = EventHandler()
+            server = SelectorServer(self.make_client_handler,4450)
+            server.start()
+            time.sleep(0.1)
+
+            encoder = JsonEncoder()
+            clientA_handler = EventHandler()
+            clientA = Client("localhost", 4450, encoder)
+            clientA.start()
+            time.sleep(0.1)
+
+            clientB_handler = EventHandler()
+            clientB = Client("localhost", 4450, encoder)
+            clientB.start()
+            time.sleep(0.1)
+
+            clientA.send(MsgChat([1],[],None,"Hi client B"))
+            time.sleep(0.1)
+            server.process_events(server_handler)
+            clientB.process_events(clientB_handler)
+
+            self.assertEquals(1, len(clientB_handler.messages))
+            self.assertEquals("Hi client B", clientB_handler.messages[-1].message)
+            self.assertEquals(0, clientB_handler.messages[-1].sender)
+
+            clientB.send(MsgChat([Server.GROUP_ALL],[1],None,"Hi everyone"))
+            time.sleep(0.1)
+            server.process_events(server_handler)
+            clientA.process_events(clientA_handler)
+            clientB.process_events(clientB_handler)
+
+            self.assertEquals(1, len(server_handler.messages))
+            self.assertEquals(1, server_handler.messages[-1].sender)
+            self.assertEquals(1, len(clientA_handler.messages))
+            self.assertEquals("Hi everyone", clientA_handler.messages[-1].message)
+            self.assertEquals(1, len(clientB_handler.messages))
+
+        finally:
+            if clientA:
+                clientA.stop()
+            if clientB:
+                clientB.stop()
+            if server:
+                server.stop()
+
+    def test_game_server(self):
+        server = None
+        clientA = None
+        clientB = None
+        try:
+            server_handler = EventHandler()
+            server = SelectorGameServer(8,self.make_game_client_handler,4451)
+            server.start()
+            time.sleep(0.1)
+
+            encoder = JsonEncoder()
+            clientA_handler = EventHandler()
+            clientA = GameClient({"name":"testerA"},"localhost", 4451, encoder)
+            clientA.start()
+            time.sleep(0.1)
+            for i in range(2):
+                server.process_events(server_handler)
+                clientA.process_events(clientA_handler)
+                time.sleep(0.1)
+
+            clientB_handler = EventHandler()
+            clientB = GameClient({"name":"testerB"},"localhost", 4451, encoder)
+            clientB.start()
+            time.sleep(0.1)
+            for i in range(2):
+                server.process_events(server_handler)
+                clientA.process_events(clientA_handler)
+                clientB.process_events(clientB_handler)
+                time.sleep(0.1)
+
+            self.assertEquals(2, server.get_num_players())
+            self.assertEquals(MsgPlayerConnect, clientA_handler.messages[-1].__class__)
+            self.assertEquals(1, clientA_handler.messages[-1].player_id)
+
+            # kicking a player closes their connection from the server thread
+            server.disconnect_client(0)
+            time.sleep(0.1)
+            for i in range(2):
+                server.process_events(server_handler)
+                clientB.process_events(clientB_handler)
+                time.sleep(0.1)
+
+            self.assertEquals(1, server.get_num_players())
+            self.assertEquals(1, server.get_num_clients())
+            self.assertEquals(MsgPlayerDisconnect, clientB_handler.messages[-1].__class__)
+            self.assertEquals(0, clientB_handler.messages[-1].player_id)
+
+            server.stop()
+            time.sleep(0.1)
+            clientB.process_events(clientB_handler)
+
+            self.assertEquals(MsgServerShutdown, clientB_handler.messages[-1].__class__)
+            self.assertEquals(0, server.get_num_clients())
+
+        finally:
+            if clientA:
+                clientA.stop()
+            if clientB:
+                clientB.stop()
+            if server:
+                server.stop()
+
@@ -0,0 +1,178 @@
+from mrf.network import *
+from mrf.replay import *
+import unittest
+import tempfile
+import os
+import time
+
+
+class MsgUnregistered(Message):
+
+    fields = (("text", str),)
+
+    def __init__(self, recipients=[], excludes=[], sender=None, text=""):
+        Message.__init__(self, recipients, excludes, sender)
+        self.text = text
+
+
+class InterceptingNode(Node):
+
+    def intercept_MsgPing(self, message):
+        pass
+
+
+class BatchNode(Node):
+
+    def __init__(self):
+        Node.__init__(self)
+        self.batches = []
+
+    def process_events(self, handler=None, max_events=None, max_time=None):
+        count = Node.process_events(self, handler, max_events, max_time)
+        self.batches.append(count)
+        return count
+
+
+class ChatHandler(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def handle_MsgChat(self, message):
+        self.messages.append(message.message)
+
+    def handle_MsgUnregistered(self, message):
+        self.messages.append(message.text)
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        fd,self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def chat(self, text):
+        return MsgChat([Server.SERVER],[],1,text)
+
+    def record(self, times, encoder=None):
+        recorder = MessageRecorder(None, self.path, encoder)
+        recorder.start()
+        start = recorder.last_time/1000000.0
+        for i,t in enumerate(times):
+            recorder.record(self.chat("m%d" % i), start+t)
+        recorder.stop()
+
+    def testRecordsQueuedMessages(self):
+        node = InterceptingNode()
+        recorder = MessageRecorder(node, self.path)
+        recorder.start()
+        node.received(self.chat("hello"))
+        node.received(MsgPing([Server.SERVER],[],1))
+        recorder.stop()
+        node.received(self.chat("after"))
+        self.assertEquals(1, recorder.count)
+        self.assertEquals(None, node.recorder)
+        records = MessagePlayer(self.path).load()
+        self.assertEquals(1, len(records))
+        message = records[0][1]
+        self.assertTrue(isinstance(message, MsgChat))
+        self.assertEquals("hello", message.message)
+        self.assertEquals(1, message.get_sender())
+
+    def testOffsets(self):
+        self.record([0.0, 0.25, 1.5])
+        self.assertEquals([0.0, 0.25, 1.5], [round(o,6) for o,m in MessagePlayer(self.path).load()])
+
+    def testSessionsAppended(self):
+        self.record([0.0, 0.5])
+        self.record([0.0, 0.25])
+        records = MessagePlayer(self.path).load()
+        self.assertEquals([0.0, 0.5, 0.5, 0.75], [round(o,6) for o,m in records])
+
+    def testJsonEncoder(self):
+        self.record([0.0, 0.1], JsonEncoder())
+        records = MessagePlayer(self.path, JsonEncoder()).load()
+        self.assertEquals(["m0","m1"], [m.message for o,m in records])
+
+    def testTruncatedRecording(self):
+        self.record([0.0, 0.1, 0.2])
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(size-2)
+        self.assertEquals(2, len(MessagePlayer(self.path).load()))
+
+    def testRecordAfterTruncation(self):
+        self.record([0.0, 0.1, 0.2])
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(size-4)
+        self.record([0.0, 0.5])
+        records = MessagePlayer(self.path).load()
+        self.assertEquals(["m0","m1","m0","m1"], [m.message for o,m in records])
+        self.assertEquals([0.0, 0.1, 0.1, 0.6], [round(o,3) for o,m in records])
+
+    def testRecordAfterTruncatedHeader(self):
+        with open(self.path, "wb") as f:
+            f.write(MessageRecorder.MAGIC[:3])
+        self.record([0.0])
+        self.assertEquals(1, len(MessagePlayer(self.path).load()))
+
+    def testNotARecording(self):
+        with open(self.path, "wb") as f:
+            f.write(b"rubbish")
+        self.assertRaises(RecordingError, MessagePlayer(self.path).load)
+        self.assertRaises(RecordingError, MessageRecorder(None, self.path).start)
+
+    def testPlayAsFastAsPossible(self):
+        self.record([0.0, 0.5, 1.0])
+        node = BatchNode()
+        handler = ChatHandler()
+        start = time.time()
+        self.assertEquals(3, MessagePlayer(self.path).play(node, handler))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(["m0","m1","m2"], handler.messages)
+        self.assertEquals([1,1,1], node.batches)
+
+    def testPlayInTicks(self):
+        self.record([0.0, 0.05, 0.15, 0.32, 0.35])
+        node = BatchNode()
+        MessagePlayer(self.path).play(node, ChatHandler(), tick=0.1)
+        self.assertEquals([2,1,2], node.batches)
+
+    def testPlayRealTime(self):
+        self.record([0.0, 0.4])
+        start = time.time()
+        MessagePlayer(self.path).play(Node(), ChatHandler(), speed=2.0)
+        self.assertTrue(time.time() - start >= 0.19)
+
+    def testUnencodableMessageStillDelivered(self):
+        server = Server(lambda s,sock,id: ClientHandler(s,sock,id,JsonEncoder()), 4479)
+        client = None
+        recorder = MessageRecorder(server, self.path)
+        try:
+            server.start()
+            time.sleep(0.1)
+            client = Client("localhost", 4479, JsonEncoder())
+            client.start()
+            time.sleep(0.1)
+            recorder.start()
+            client.send(MsgUnregistered([Server.SERVER],[],None,"unregistered"))
+            client.send(self.chat("registered"))
+            time.sleep(0.2)
+            handler = ChatHandler()
+            server.process_events(handler)
+            self.assertEquals(["unregistered","registered"], handler.messages)
+            self.assertEquals(1, server.get_num_clients())
+            self.assertEquals(1, recorder.skipped)
+            self.assertEquals(1, recorder.count)
+        finally:
+            recorder.stop()
+            if client:
+                client.stop()
+            server.stop()
+        self.assertEquals(["registered"], [m.message for o,m in MessagePlayer(self.path).load()])
@@ -0,0 +1,208 @@
+from mrf.network import *
+from mrf.replication import *
+import unittest
+
+
+class TestDeltas(unittest.TestCase):
+
+    def testNewEntities(self):
+        changes,removed = make_delta({}, {1:{"x":1,"y":2}})
+        self.assertEquals({1:{"x":1,"y":2}}, changes)
+        self.assertEquals([], removed)
+
+    def testChangedFieldsOnly(self):
+        base = {1:{"x":1,"y":2}, 2:{"x":5,"y":5}}
+        current = {1:{"x":1,"y":3}, 2:base[2]}
+        changes,removed = make_delta(base, current)
+        self.assertEquals({1:{"y":3}}, changes)
+        self.assertEquals([], removed)
+
+    def testRemovedEntities(self):
+        changes,removed = make_delta({1:{"x":1}, 2:{"x":2}}, {2:{"x":2}})
+        self.assertEquals({}, changes)
+        self.assertEquals([1], removed)
+
+    def testApplyDelta(self):
+        base = {1:{"x":1,"y":2}, 2:{"x":5}}
+        current = {1:{"x":1,"y":3}, 3:{"z":0}}
+        changes,removed = make_delta(base, current)
+        self.assertEquals(current, apply_delta(base, changes, removed))
+        self.assertEquals({1:{"x":1,"y":2}, 2:{"x":5}}, base)
+
+    def testMessagesRoundTrip(self):
+        m = MsgStateUpdate([1],[],-1,5,3,{1:{"x":1.5,"name":"bob"}},[2,3])
+        for enc in (JsonEncoder(), BinaryEncoder()):
+            d = enc.decode(enc.encode(m))
+            self.assertEquals(MsgStateUpdate, d.__class__)
+            self.assertEquals(5, d.seq)
+            self.assertEquals(3, d.base_seq)
+            self.assertEquals({1:{"x":1.5,"name":"bob"}}, d.changes)
+            self.assertEquals([2,3], d.removed)
+
+
+class RecordingServer(ReplicatingGameServer):
+
+    def __init__(self, players):
+        ReplicatingGameServer.__init__(self)
+        self.sent = []
+        for p in players:
+            self.node_groups.tag_item(p, GameServer.GROUP_PLAYERS)
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class RecordingClient(ReplicatingGameClient):
+
+    def __init__(self):
+        ReplicatingGameClient.__init__(self, {"name":"tester"}, "localhost")
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class TestReplication(unittest.TestCase):
+
+    def deliver(self, server, client, client_id):
+        update = server.sent[-1]
+        self.assertTrue(client_id in update.recipients)
+        client.handle_MsgStateUpdate(update)
+        ack = client.sent[-1]
+        ack.sender = client_id
+        server.handle_MsgStateAck(ack)
+
+    def testFullThenDeltas(self):
+        server = RecordingServer([0])
+        client = RecordingClient()
+        for i in range(10):
+            server.set_entity(i, {"x":i, "y":0})
+        server.publish_state()
+        self.assertEquals(-1, server.sent[-1].base_seq)
+        self.deliver(server, client, 0)
+        self.assertEquals(server.get_entities(), client.get_entities())
+
+        server.set_entity(3, {"y":1})
+        server.remove_entity(7)
+        server.publish_state()
+        update = server.sent[-1]
+        self.assertEquals(1, update.base_seq)
+        self.assertEquals({3:{"y":1}}, update.changes)
+        self.assertEquals([7], update.removed)
+        self.deliver(server, client, 0)
+        self.assertEquals(server.get_entities(), client.get_entities())
+        self.assertEquals(2, client.get_state_seq())
+
+    def testSnapshotNotChangedAfterPublishing(self):
+        server = RecordingServer([0])
+        server.set_entity(1, {"x":0})
+        server.publish_state()
+        server.set_entity(1, {"x":1})
+        server.set_entity(2, {"x":2})
+        self.assertEquals({1:{"x":0}}, server.sent[-1].changes)
+
+    def testDeltaAgainstLastAcked(self):
+        server = RecordingServer([0])
+        client = RecordingClient()
+        server.set_entity(1, {"x":0})
+        server.publish_state()
+        self.deliver(server, client, 0)
+
+        # update lost - next delta is still against state 1
+        server.set_entity(1, {"x":1})
+        server.publish_state()
+        server.set_entity(2, {"x":2})
+        server.publish_state()
+        self.assertEquals(1, server.sent[-1].base_seq)
+        self.assertEquals({1:{"x":1},2:{"x":2}}, server.sent[-1].changes)
+        self.deliver(server, client, 0)
+        self.assertEquals(server.get_entities(), client.get_entities())
+
+    def testUnknownBaseRequestsSnapshot(self):
+        server = RecordingServer([0])
+        client = RecordingClient()
+        server.set_entity(1, {"x":0})
+        server.publish_state()
+        client.handle_MsgStateUpdate(MsgStateUpdate([0],[],-1,5,4,{1:{"x":1}},[]))
+        self.assertEquals(-1, client.get_state_seq())
+        self.assertEquals(-1, client.sent[-1].seq)
+        server.acked[0] = 1
+        client.sent[-1].sender = 0
+        server.handle_MsgStateAck(client.sent[-1])
+        server.publish_state()
+        self.assertEquals(-1, server.sent[-1].base_seq)
+
+    def testStaleUpdateIgnored(self):
+        client = RecordingClient()
+        client.handle_MsgStateUpdate(MsgStateUpdate([0],[],-1,2,-1,{1:{"x":2}},[]))
+        client.handle_MsgStateUpdate(MsgStateUpdate([0],[],-1,1,-1,{1:{"x":1}},[]))
+        self.assertEquals({1:{"x":2}}, client.get_entities())
+
+    def testExpiredBaseSendsSnapshot(self):
+        server = RecordingServer([0])
+        client = RecordingClient()
+        server.set_entity(1, {"x":0})
+        server.publish_state()
+        self.deliver(server, client, 0)
+        for i in range(ReplicatingGameServer.HISTORY_SIZE):
+            server.publish_state()
+        self.assertEquals(-1, server.sent[-1].base_seq)
+
+    def testPlayersGroupedByBase(self):
+        server = RecordingServer([0,1,2])
+        clients = [RecordingClient() for i in range(3)]
+        server.set_entity(1, {"x":0})
+        server.publish_state()
+        self.assertEquals(1, len(server.sent))
+        self.assertEquals(set([0,1,2]), set(server.sent[-1].recipients))
+        for i in range(2):
+            self.deliver(server, clients[i], i)
+        server.set_entity(1, {"x":1})
+        server.publish_state()
+        self.assertEquals(3, len(server.sent))
+
+    def testDepartedPlayerForgotten(self):
+        server = RecordingServer([0])
+        client = RecordingClient()
+        server.publish_state()
+        self.deliver(server, client, 0)
+        self.assertTrue(0 in server.acked)
+        server.handlers[0] = None
+        server.client_departed(0)
+        self.assertFalse(0 in server.acked)
+
+
+class TestReplicationNetwork(unittest.TestCase):
+
+    def testReplicatesOverNetwork(self):
+        server = None
+        client = None
+        try:
+            server = ReplicatingGameServer(port=4461)
+            server.start()
+            time.sleep(0.1)
+            client = ReplicatingGameClient({"name":"tester"}, "localhost", 4461)
+            client.start()
+            time.sleep(0.1)
+            for i in range(3):
+                server.process_events()
+                client.process_events()
+                time.sleep(0.1)
+            self.assertTrue(client.is_in_game())
+
+            for tick in range(5):
+                server.set_entity("ship", {"x":tick, "y":0})
+                server.publish_state()
+                time.sleep(0.1)
+                client.process_events()
+                time.sleep(0.1)
+                server.process_events()
+            self.assertEquals({"ship":{"x":4, "y":0}}, client.get_entities())
+            self.assertEquals(5, client.get_state_seq())
+            self.assertEquals(5, server.acked[0])
+
+        finally:
+            if client:
+                client.stop()
+            if server:
+                server.stop()
@@ -0,0 +1,143 @@
+from mrf.network import *
+from mrf.sharding import *
+import unittest
+
+
+class FakeBus(object):
+
+    def __init__(self):
+        self.posted = []
+
+    def post(self, shard, message):
+        self.posted.append((shard, message))
+
+
+class FakeHandler(object):
+
+    def __init__(self, info):
+        self.sent = []
+        self.player_info = info
+
+    def send(self, message, cache=None):
+        self.sent.append(message)
+
+    def get_player_info(self):
+        return self.player_info
+
+
+class TestShardGameServer(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = open_listen_socket(0, 1)
+        self.bus = FakeBus()
+        self.server = ShardGameServer(1, 3, self.bus, self.socket)
+
+    def tearDown(self):
+        self.socket.close()
+
+    def add_player(self, client_id, name):
+        self.server.handlers[client_id] = FakeHandler({"name":name})
+        self.server.node_groups.tag_item(client_id, Server.GROUP_CLIENTS)
+        self.server.node_groups.tag_item(client_id, GameServer.GROUP_PLAYERS)
+
+    def testClientIds(self):
+        self.assertEquals([1,4,7], [self.server.make_client_id() for i in range(3)])
+        self.assertEquals(1, self.server.get_shard_of(7))
+
+    def testRemoteShards(self):
+        def shards(recipients):
+            return self.server.get_remote_shards(MsgChat(recipients,[],Server.SERVER,"hi"))
+        self.assertEquals([], shards([Server.SERVER, 1, 4]))
+        self.assertEquals([0,2], shards([3, 5, 4]))
+        self.assertEquals([0,2], shards([GameServer.GROUP_PLAYERS]))
+        self.assertEquals([0,2], shards([Server.area(0,0,10)]))
+
+    def testSendForwards(self):
+        self.add_player(1, "local")
+        m = MsgChat([GameServer.GROUP_PLAYERS],[],Server.SERVER,"hi")
+        self.server.send(m)
+        self.assertEquals([m], self.server.handlers[1].sent)
+        self.assertEquals([(0,m),(2,m)], self.bus.posted)
+
+    def testBusDeliversToClientsOnly(self):
+        self.add_player(1, "local")
+        self.server.node_groups.tag_item(Server.SERVER, GameServer.GROUP_PLAYERS)
+        m = MsgChat([GameServer.GROUP_PLAYERS],[5],5,"hi")
+        self.server.bus_received(m)
+        self.assertEquals([m], self.server.handlers[1].sent)
+        self.assertTrue(self.server.event_queue.empty())
+        self.assertEquals([], self.bus.posted)
+
+    def testRemotePlayersTracked(self):
+        self.add_player(1, "local")
+        self.server.bus_received(MsgPlayerConnect([GameServer.GROUP_PLAYERS],[3],
+            Server.SERVER,3,{"name":"remote"}))
+        self.assertEquals(2, self.server.get_num_players())
+        self.assertEquals(set(["local","remote"]), set(self.server.get_player_names()))
+        self.assertEquals({1:{"name":"local"},3:{"name":"remote"}},
+            self.server.get_info_on_players())
+        self.assertRaises(NameTakenError, self.server.player_join, 4, {"name":"remote"})
+        self.server.bus_received(MsgPlayerDisconnect([GameServer.GROUP_PLAYERS],[3],
+            Server.SERVER,3,""))
+        self.assertEquals(1, self.server.get_num_players())
+
+    def testRemotePlayersCountTowardsLimit(self):
+        for i in range(4):
+            self.server.bus_received(MsgPlayerConnect([GameServer.GROUP_PLAYERS],[],
+                Server.SERVER,i*3,{"name":"p%d" % i}))
+        self.assertRaises(GameFullError, self.server.player_join, 4, {"name":"late"})
+
+
+class ChatHandler(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def handle_MsgChat(self, message):
+        self.messages.append(message.message)
+
+    def __getattr__(self, name):
+        if name.startswith("handle_"):
+            return lambda event: None
+        raise AttributeError(name)
+
+
+class TestShardedGameServer(unittest.TestCase):
+
+    def testClientsAcrossShards(self):
+        server = ShardedGameServer(2, port=4467)
+        clients = []
+        try:
+            server.start()
+            time.sleep(0.3)
+            handlers = []
+            for i in range(4):
+                client = GameClient({"name":"player%d" % i}, "localhost", 4467)
+                client.start()
+                clients.append(client)
+                handlers.append(ChatHandler())
+                time.sleep(0.2)
+            for i in range(3):
+                time.sleep(0.2)
+                for client,handler in zip(clients, handlers):
+                    client.process_events(handler)
+            self.assertTrue(all([c.is_in_game() for c in clients]))
+            self.assertEquals(4, len(set([c.client_id for c in clients])))
+            for c in clients:
+                self.assertEquals(set([o.client_id for o in clients]), set(c.player_list.keys()))
+
+            clients[0].send(MsgChat([GameServer.GROUP_PLAYERS],[clients[0].client_id],
+                clients[0].client_id,"hello all"))
+            clients[1].send(MsgChat([clients[2].client_id, clients[3].client_id],[],
+                clients[1].client_id,"hello you"))
+            time.sleep(0.3)
+            for client,handler in zip(clients, handlers):
+                client.process_events(handler)
+            self.assertEquals([[],["hello all"],["hello all","hello you"],["hello all","hello you"]],
+                [sorted(h.messages) for h in handlers])
+
+        finally:
+            for c in clients:
+                c.stop()
+            server.stop()
+        self.assertFalse(server.is_alive())
@@ -108,6 +108,69 @@ class TestTagLookup(unittest.TestCase):
         self.assertEquals(False, "hoo" in t)
 
 
+class TestTagLookupSnapshots(unittest.TestCase):
+
+    def testSnapshotReused(self):
+        t = TagLookup()
+        t.tag_item(1, "a")
+        t.tag_item(2, "a")
+        snap = t.get_tag_snapshot("a")
+        self.assertEquals(frozenset([1,2]), snap)
+        self.assertTrue(snap is t.get_tag_snapshot("a"))
+        self.assertEquals(frozenset(), t.get_tag_snapshot("b"))
+
+    def testSnapshotInvalidated(self):
+        t = TagLookup()
+        t.tag_item(1, "a")
+        snap = t.get_tag_snapshot("a")
+        version = t.version
+        t.tag_item(2, "a")
+        self.assertEquals(frozenset([1,2]), t.get_tag_snapshot("a"))
+        self.assertEquals(frozenset([1]), snap)
+        self.assertTrue(t.version > version)
+        t.remove_item(1)
+        self.assertEquals(frozenset([2]), t.get_tag_snapshot("a"))
+        t.remove_tag("a")
+        self.assertEquals(frozenset(), t.get_tag_snapshot("a"))
+        t.tag_item(3, "a")
+        t.clear()
+        self.assertEquals(frozenset(), t.get_tag_snapshot("a"))
+
+
+class TestSpatialGrid(unittest.TestCase):
+
+    def testAddMoveRemove(self):
+        g = SpatialGrid(10)
+        g.set_position("a", 5, 5)
+        self.assertTrue("a" in g)
+        self.assertEquals((5,5), g.get_position("a"))
+        g.set_position("a", 25, -5)
+        self.assertEquals((25,-5), g.get_position("a"))
+        self.assertEquals(set([(2,-1)]), set(g.cells.keys()))
+        g.remove_item("a")
+        self.assertFalse("a" in g)
+        self.assertEquals({}, g.cells)
+        g.remove_item("a")
+
+    def testItemsWithin(self):
+        g = SpatialGrid(10)
+        g.set_position("a", 0, 0)
+        g.set_position("b", 3, 4)
+        g.set_position("c", 30, 0)
+        g.set_position("d", -6, -8)
+        self.assertEquals(set(["a","b","d"]), g.get_items_within(0, 0, 10))
+        self.assertEquals(set(["a","b"]), g.get_items_within(0, 0, 5))
+        self.assertEquals(set(["c"]), g.get_items_within(35, 0, 5))
+        self.assertEquals(set(), g.get_items_within(100, 100, 5))
+        self.assertEquals(set(["a","b","c","d"]), g.get_items_within(0, 0, 10000))
+
+    def testClear(self):
+        g = SpatialGrid(10)
+        g.set_position("a", 0, 0)
+        g.clear()
+        self.assertEquals(set(), g.get_items())
+
+
 class TestDispatcher(unittest.TestCase):
 
     def testByType(self):